@@ -2,19 +2,48 @@
 '''Communicator which handles UDP/TCP communication
 
 '''
+import asyncio
 import inspect
 import json
 import logging
 import math
+import os
+import re
+import selectors
 import socket
 import struct
 import threading
 import collections
+import errno
+import fcntl
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 
 
 TAG_SIZE = 4
-SEQ_SIZE = 2
+SEQ_SIZE = 4
+MAX_FRAME_SIZE = 2**30  # Largest TCP message (tag + data) we accept, in bytes
+ITER_MOD = 2**24  # Iterations in a tag wrap around here, see consensus.iterative.build_tag
+META = struct.Struct('<II4sBB')  # Seq. total, seq. num, tag, flags, group. See build_meta_packet
+HEADER_SIZE = META.size  # Bytes of metadata at the start of every UDP packet
+FLAG_PARITY = 0x01  # The packet holds the XOR parity of a group of data packets
+FLAG_NACK = 0x02  # The packet asks the sender to send some packets again
+FLAG_PROBE = 0x04  # Path MTU probe, ignored by receivers
+MAX_MTU = 9000  # Largest MTU used by default, i.e. jumbo frames
+PROBE_MTUS = (9000, 4352, 1500, 1492, 1280, 576)  # Tried in order when IP_MTU is missing
+# Linux socket options for path MTU discovery, which the socket module does not always export
+IP_MTU_DISCOVER = getattr(socket, 'IP_MTU_DISCOVER', 10)
+IP_PMTUDISC_DO = getattr(socket, 'IP_PMTUDISC_DO', 2)
+IP_MTU = getattr(socket, 'IP_MTU', 14)
+SHM_RING_SIZE = 2**22  # Bytes of shared memory per directed edge of a ShmCommunicator
+# Python 3.13 can keep the resource tracker away from segments which their creator unlinks
+SHM_TRACK = 'track' in inspect.signature(shared_memory.SharedMemory).parameters
+# Tag of heartbeat messages. consensus.iterative.build_tag never hands it out.
+HEARTBEAT_TAG = b'\xff\xff\xff\xff'
+HEARTBEAT = int.from_bytes(HEARTBEAT_TAG, byteorder='little')
+HEARTBEAT_PROBE = 10  # Heartbeat intervals between two heartbeats to a suspected peer
 UDP = 10
 TCP = 20
 
@@ -29,14 +58,89 @@ def get_mtu():
     Note that the 576 byte sized MTU does not account for the checksum/ip headers so
     when sending data we need to take the IP/protocol headers into account.
 
-    The current implementation just assumes the default minimum of 576.
-    We should try to implement something to actually calculate min(MTU_fh, 576)
+    This is the MTU every IPv4 host must accept, so it is used wherever the path is not known.
+    See ``discover_mtu`` for the MTU towards a given host.
 
     Returns:
         int: 576
     '''
     return 576
 
+
+def multicast_group(base, run_id):
+    '''The multicast group of a consensus run. Runs get consecutive addresses from ``base``.
+
+    Args:
+        base (str): The group of run 0, e.g. ``'239.255.77.0'``
+        run_id (int): The run id, i.e. the first byte of the tag
+
+    Returns:
+        str: The group address
+    '''
+    addr = int.from_bytes(socket.inet_aton(base), byteorder='big') + run_id
+    return socket.inet_ntoa((addr & 0xFFFFFFFF).to_bytes(4, byteorder='big'))
+
+
+def discover_mtu(addr, port, max_mtu=MAX_MTU):
+    '''Find the path MTU towards a host.
+
+    On Linux the kernel tracks the path MTU of every route (lowered by ICMP "fragmentation
+    needed" messages). We set the don't-fragment bit on a UDP socket, connect it to ``addr`` and
+    read ``IP_MTU``. If ``IP_MTU`` cannot be read we probe instead: a datagram with the
+    don't-fragment bit larger than the known path MTU fails with ``EMSGSIZE``, so the first of
+    ``PROBE_MTUS`` which can be sent is used. Probes carry ``FLAG_PROBE`` and are ignored by
+    the receiver. If the don't-fragment bit cannot be set the result is ``get_mtu()``.
+
+    Args:
+        addr (str): The hostname/ip of the peer
+        port (int): The peer's port
+        max_mtu (int): Upper bound on the result
+
+    Returns:
+        int: The path MTU in bytes, including IP and UDP headers
+    '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_DO)
+        sock.connect((addr, port))
+    except OSError as err:
+        logger.debug('Could not discover the MTU towards %s: %s', addr, err)
+        sock.close()
+        return get_mtu()
+    try:
+        return max(get_mtu(), min(sock.getsockopt(socket.IPPROTO_IP, IP_MTU), max_mtu))
+    except OSError:
+        return _probe_mtu(sock, max_mtu)
+    finally:
+        sock.close()
+
+
+def _probe_mtu(sock, max_mtu):
+    '''Send probes of shrinking size on a connected don't-fragment socket until one fits'''
+    probe = build_meta_packet(0, 0, bytes(TAG_SIZE), flags=FLAG_PROBE)
+    for mtu in PROBE_MTUS:
+        if mtu > max_mtu:
+            continue
+        try:
+            sock.send(probe + bytes(mtu - 28 - len(probe)))  # 20 byte IP, 8 byte UDP header
+            return mtu
+        except OSError as err:
+            if err.errno != errno.EMSGSIZE:
+                break
+    return get_mtu()
+
+class SendError(RuntimeError):
+    '''Sending a message to some of its addresses failed
+
+    Args:
+        failed (dict): Maps each address the message did not reach to the error message
+    '''
+
+    def __init__(self, failed):
+        super().__init__('; '.join(failed.values()))
+        self.failed = failed
+
+
 def default_log_callback(sender, tag, data):
     logger.error('MESSAGE from {}; TAG {}; DATA {}'.format(sender, tag, data))
 
@@ -84,6 +188,23 @@ def check_tag(input_tag):
     return input_tag[0:4]
 
 
+def check_callback(callback):
+    '''Checks that a receive callback takes ``(sender, tag, data)``
+
+    Args:
+        callback (func): The callback to check
+
+    Raises:
+        TypeError: if the callback is not callable
+        ValueError: if the callback does not take 3 arguments
+    '''
+    if not callable(callback):
+        raise TypeError("Callback must be a function")
+    # signature leaves out the ``self`` of bound methods
+    if len(inspect.signature(callback).parameters) != 3:
+        raise ValueError("Callback function did not have 3 arguments.")
+
+
 def get_payload(payload):
     '''Take data payload and return a byte array of the object. Should be
     structured as a dict/list object. Note this method is slightly expensive
@@ -117,47 +238,147 @@ def decode_payload(payload):
     return data
 
 
-def build_meta_packet(seq_num, seq_total, tag):
+def build_meta_packet(seq_num, seq_total, tag, flags=0, group=0):
     '''Create a bytearray which returns a sequence of bytes based on the metadata
 
     Args:
-        seq_num(int): The packet's sequence number
+        seq_num(int): The packet's sequence number, or the group number of a parity packet
         seq_total(int): The total number of sequence packets to be sent
         tag (bytes): A string or bytes object to encode as the data tag
+        flags (int): ``FLAG_PARITY``, ``FLAG_NACK`` or 0 for a data packet
+        group (int): Number of data packets per parity packet, 0 without FEC
 
     Returns:
         bytearray: A bytearray with the metadata
     '''
     if isinstance(seq_total, int) is False or isinstance(seq_num, int) is False:
         raise TypeError("Sequence number and total must be integer")
-    packet = bytearray()
-    packet += struct.pack('H', seq_total)
-    packet += struct.pack('H', seq_num)
-    packet += check_tag(tag)
+    return bytearray(META.pack(seq_total, seq_num, check_tag(tag), flags, group))
+
+
+def parse_meta_packet(packet):
+    '''Read the metadata of a packet made with ``build_meta_packet``
+
+    Args:
+        packet (bytes): The packet
+
+    Returns:
+        tuple: seq_num, seq_total, the tag as an int, flags and group
+    '''
+    seq_total, seq_num, tag, flags, group = META.unpack_from(packet)
+    return seq_num, seq_total, int.from_bytes(tag, byteorder='little'), flags, group
+
+
+def xor_parity(payloads):
+    '''XOR a group of packet payloads together.
+
+    Shorter payloads are padded with zeros. The result starts with the XOR of the payload
+    lengths (2 bytes) so that ``xor_recover`` can also rebuild the length of a short packet.
+
+    Args:
+        payloads (list): The data of the packets, without headers
+
+    Returns:
+        bytes: The parity payload
+    '''
+    size = max(len(p) for p in payloads)
+    acc = 0
+    length = 0
+    for payload in payloads:
+        acc ^= int.from_bytes(payload, byteorder='little')
+        length ^= len(payload)
+    return struct.pack('H', length) + acc.to_bytes(size, byteorder='little')
+
+
+def xor_recover(parity, payloads):
+    '''Rebuild the one missing payload of a group from the group's parity and the other
+    payloads.
+
+    Args:
+        parity (bytes): The output of ``xor_parity`` for the whole group
+        payloads (iterable): Every payload of the group except the missing one
+
+    Returns:
+        bytes: The missing payload
+    '''
+    length = struct.unpack('H', parity[0:2])[0]
+    acc = int.from_bytes(parity[2:], byteorder='little')
+    for payload in payloads:
+        acc ^= int.from_bytes(payload, byteorder='little')
+        length ^= len(payload)
+    return acc.to_bytes(len(parity) - 2, byteorder='little')[:length]
+
+def build_nack(missing, tag):
+    '''Build a NACK packet asking the sender of ``tag`` to send some packets again.
+
+    A NACK has the normal packet header with the ``FLAG_NACK`` flag. The payload is the first
+    missing sequence number (4 bytes) followed by a bitmap where bit ``i`` (least significant
+    bit first) asks for packet ``first + i``. Missing packets which do not fit in one packet are
+    left for the next NACK.
+
+    Args:
+        missing (list): Sorted sequence numbers of the missing packets
+        tag (bytes): The tag of the message
+
+    Returns:
+        bytearray: The NACK packet
+    '''
+    max_bits = 8 * (get_mtu() - 68 - HEADER_SIZE - SEQ_SIZE)
+    first = missing[0]
+    mask = 0
+    for seq in missing:
+        if seq - first >= max_bits:
+            break
+        mask |= 1 << (seq - first)
+    packet = build_meta_packet(0, 0, tag, flags=FLAG_NACK)
+    packet += struct.pack('<I', first)
+    packet += mask.to_bytes((mask.bit_length() + 7) // 8, byteorder='little')
     return packet
 
+
+def parse_nack(payload):
+    '''Get the requested sequence numbers out of the payload of a NACK packet
+
+    Args:
+        payload (bytes): The NACK packet without its header
+
+    Returns:
+        list: The sequence numbers to send again
+    '''
+    if len(payload) < SEQ_SIZE:
+        return []
+    first = struct.unpack('<I', payload[0:SEQ_SIZE])[0]
+    mask = int.from_bytes(payload[SEQ_SIZE:], byteorder='little')
+    return [first + i for i in range(mask.bit_length()) if (mask >> i) & 1]
+
+
 def recv_n_bytes(conn, num):
     '''Get a set number of bytes from a TCP connection
 
+    The bytes are read with ``recv_into`` straight into a single preallocated buffer so that
+    reading a message costs O(n) and no intermediate copies.
+
     Args:
         conn (socket): A connected TCP socket
         num (int): Number of bytes to read
 
     Returns:
-        bytes: a bytes object containing the data read. None if num < 0
+        bytearray: a buffer containing the data read. None if the connection closed or failed.
     '''
     if num < 0:
         raise ValueError("conn {} request {} bytes. Bytes must be > 0".format(conn, num))
-    bytes_left = num
-    msg_b = b''
-    while len(msg_b) < num:
+    if num > MAX_FRAME_SIZE:
+        raise ValueError("conn {} request {} bytes. Exceeds MAX_FRAME_SIZE".format(conn, num))
+    msg_b = bytearray(num)
+    view = memoryview(msg_b)
+    pos = 0
+    while pos < num:
         try:
-            bts = conn.recv(bytes_left)
-            if len(bts) <= 0: # error/socket close
+            n_read = conn.recv_into(view[pos:], num - pos)
+            if n_read <= 0: # error/socket close
                 return None
                 # break  # Empty str means closed socket
-            msg_b += bts
-            bytes_left -= len(bts)
+            pos += n_read
         except socket.timeout as err:
             # Socket timed out waiting for bytes
             pass
@@ -167,6 +388,334 @@ def recv_n_bytes(conn, num):
             return None
     return msg_b
 
+
+def frame_header(data, tag):
+    '''Build the TCP frame header for a message: the 4-byte message length followed by the tag.
+
+    Args:
+        data (bytes): The message payload. Any bytes-like object.
+        tag (bytes): A 4 byte tag, see ``check_tag``
+
+    Returns:
+        bytes: The 8 header bytes which go in front of ``data`` on the wire
+    '''
+    return struct.pack('!I', len(tag) + memoryview(data).nbytes) + tag
+
+
+def split_frame(msg):
+    '''Split a message read off a TCP connection into its tag and data.
+
+    Args:
+        msg (bytes): The tag followed by the data. Any bytes-like object.
+
+    Returns:
+        tuple: The tag as an int and a ``memoryview`` of the data, ``(None, None)`` if the
+         message is shorter than a tag
+    '''
+    if len(msg) < 4:
+        return None, None
+    msg = memoryview(msg)
+    return int.from_bytes(msg[:4], byteorder='little'), msg[4:]
+
+
+def sendmsg_all(conn, buffers):
+    '''Send every buffer in ``buffers`` over a TCP connection without joining them.
+
+    Uses scatter-gather ``sendmsg`` so a header and a large payload go out in the same system
+    call without first being concatenated. Falls back to ``sendall`` on platforms that lack
+    ``sendmsg``.
+
+    Args:
+        conn (socket): A connected TCP socket
+        buffers (iterable): bytes-like objects to send in order
+    '''
+    views = [memoryview(buf).cast('B') for buf in buffers if len(buf) > 0]
+    if not hasattr(conn, 'sendmsg'):
+        for view in views:
+            conn.sendall(view)
+        return
+    while views:
+        sent = conn.sendmsg(views)
+        while sent > 0:
+            if sent >= len(views[0]):
+                sent -= len(views[0])
+                views.pop(0)
+            else:
+                views[0] = views[0][sent:]
+                sent = 0
+
+
+class FrameReader(object):
+    '''Incrementally reads length-prefixed messages from a TCP connection.
+
+    The reader first fills a 4-byte length header, then allocates one buffer of exactly the
+    message length and fills it in place with ``recv_into`` as the socket becomes readable.
+    Complete messages are handed over as a ``memoryview`` of that buffer, so a message is never
+    copied after it leaves the kernel.
+
+    Args:
+        addr (str): The address of the peer on the other end of the connection
+    '''
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.header = bytearray(4)
+        self.buffer = None
+        self.view = memoryview(self.header)
+        self.pos = 0
+
+    def read(self, conn):
+        '''Perform a single ``recv_into`` on ``conn``.
+
+        Args:
+            conn (socket): A readable TCP connection
+
+        Returns:
+            memoryview: A complete message (tag + data). None if more bytes are needed.
+
+        Raises:
+            EOFError: if the peer closed the connection
+            ValueError: if the length header is larger than ``MAX_FRAME_SIZE``
+        '''
+        return self.advance(conn.recv_into(self.pending()))
+
+    def pending(self):
+        '''The part of the current header or message which is still missing'''
+        return self.view[self.pos:]
+
+    def advance(self, n_read):
+        '''Account for ``n_read`` bytes which were written to the start of ``pending()``.
+
+        Returns and raises like ``read``, for readers which do not own a socket.
+        '''
+        if n_read <= 0:
+            raise EOFError('Connection to {} closed'.format(self.addr))
+        self.pos += n_read
+        if self.pos < len(self.view):
+            return None
+
+        if self.buffer is None:
+            m_len = struct.unpack('!I', self.header)[0] # Get the next message length
+            if m_len > MAX_FRAME_SIZE:
+                raise ValueError('Frame of {} bytes from {} exceeds MAX_FRAME_SIZE'.format(
+                    m_len, self.addr))
+            self.buffer = bytearray(m_len)
+            self.view = memoryview(self.buffer)
+            self.pos = 0
+            if m_len > 0:
+                return None
+        msg = self.view
+        self.buffer = None
+        self.view = memoryview(self.header)
+        self.pos = 0
+        return msg
+
+
+class DataStore(object):
+    '''Complete messages waiting to be picked up, by sender and tag.
+
+    Without a ``window`` this is a plain ``{addr: {tag: data}}`` mapping whose entries are
+    removed when they are taken.
+
+    With a ``window`` the tags are read with the ``build_tag`` layout of the consensus code: the
+    low byte is the run id and the upper 24 bits are the iteration. Each sender and run id gets a
+    ring buffer of ``window`` slots indexed by iteration, and only the newest ``window``
+    iterations are kept. A message which falls out of the window before anybody took it is
+    counted in ``dropped``, and a message which arrives after its iteration already left the
+    window is discarded and counted in ``late``. Memory use is bounded by the window however long
+    a run takes.
+
+    Not thread safe, the communicators guard it with ``data_lock``.
+
+    Args:
+        window (int): Number of iterations to keep per sender and run id. ``None`` keeps
+         everything until it is taken.
+    '''
+
+    def __init__(self, window=None):
+        if window is not None and window < 1:
+            raise ValueError("window must be at least 1")
+        self.window = window
+        self.entries = {}
+        self.rings = {}
+        self.dropped = 0
+        self.late = 0
+
+    def put(self, addr, tg_int, data):
+        '''Store a message.
+
+        Returns:
+            bool: ``False`` if the message was discarded because it is late
+        '''
+        if self.window is None:
+            self.entries.setdefault(addr, {})[tg_int] = data
+            return True
+        run, num = split_tag(tg_int)
+        ring = self.rings.get((addr, run))
+        if ring is None:
+            ring = self.rings[(addr, run)] = _Ring(num, self.window)
+        behind = ring.behind(num)
+        if behind >= self.window:
+            self.late += 1
+            return False
+        if behind < 0:
+            self.dropped += ring.advance(num)
+        slot = num % self.window
+        if ring.slots[slot] is not None and ring.slots[slot][0] != num:
+            self.dropped += 1
+        ring.slots[slot] = (num, data)
+        return True
+
+    def peek(self, addr, tg_int):
+        '''Look up a message without removing it. ``None`` if there is none.'''
+        if self.window is None:
+            return self.entries.get(addr, {}).get(tg_int)
+        run, num = split_tag(tg_int)
+        ring = self.rings.get((addr, run))
+        if ring is None:
+            return None
+        entry = ring.slots[num % self.window]
+        if entry is None or entry[0] != num:
+            return None
+        return entry[1]
+
+    def take(self, addr, tg_int):
+        '''Remove and return a message. ``None`` if there is none.'''
+        data = self.peek(addr, tg_int)
+        if data is None:
+            return None
+        if self.window is None:
+            del self.entries[addr][tg_int]
+            if len(self.entries[addr]) == 0:
+                del self.entries[addr]
+        else:
+            run, num = split_tag(tg_int)
+            self.rings[(addr, run)].slots[num % self.window] = None
+        return data
+
+    def is_stale(self, addr, tg_int):
+        '''Whether a message with this tag would be discarded as late'''
+        if self.window is None:
+            return False
+        run, num = split_tag(tg_int)
+        ring = self.rings.get((addr, run))
+        return ring is not None and ring.behind(num) >= self.window
+
+    def __len__(self):
+        if self.window is None:
+            return sum(len(tags) for tags in self.entries.values())
+        return sum(1 for ring in self.rings.values() for entry in ring.slots
+                   if entry is not None)
+
+
+class _Ring(object):
+    '''The ring buffer of one sender and run id in a ``DataStore``'''
+
+    def __init__(self, head, window):
+        self.head = head
+        self.slots = [None] * window
+
+    def behind(self, num):
+        '''How many iterations ``num`` is behind the newest one, negative if it is newer.
+        Iterations wrap around at ``2**24`` like ``build_tag``.'''
+        diff = (self.head - num) % ITER_MOD
+        return diff - ITER_MOD if diff >= ITER_MOD // 2 else diff
+
+    def advance(self, num):
+        '''Make ``num`` the newest iteration and clear the slots which left the window.
+
+        Returns:
+            int: How many messages were evicted before they were taken
+        '''
+        self.head = num
+        evicted = 0
+        for i, entry in enumerate(self.slots):
+            if entry is not None and self.behind(entry[0]) >= len(self.slots):
+                self.slots[i] = None
+                evicted += 1
+        return evicted
+
+
+def split_tag(tg_int):
+    '''Split an integer tag laid out like ``build_tag`` into its run id and iteration'''
+    return tg_int & 0xFF, (tg_int >> 8) % ITER_MOD
+
+
+class FailureDetector(object):
+    '''Phi accrual failure detector[1] which suspects peers that stopped sending.
+
+    Every message from a peer, heartbeat or not, goes into ``heard``. For each peer the detector
+    keeps the mean gap between its recent messages and turns the time since its last message
+    into ``phi = elapsed / mean * log10(e)``. That is ``-log10`` of the chance that a peer which
+    sends at exponentially distributed gaps would be this quiet and still be alive. A peer is
+    suspected once ``phi`` reaches ``threshold``, or once it was quiet for ``timeout`` seconds
+    if that is set. A peer which was never heard from is timed from the moment it was watched
+    with the heartbeat interval as its mean gap. The wait for its first message is not a gap
+    between two messages and does not go into the mean.
+
+    - [1] Hayashibara, Defago, Yared, Katayama. The phi accrual failure detector. SRDS 2004.
+
+    Args:
+        interval (float): The expected gap between heartbeats, in seconds
+        threshold (float): Phi at which a peer is suspected. ``8`` means a false suspicion
+         about once every ``10**8`` checks.
+        timeout (float): Seconds of silence after which a peer is suspected. Replaces phi.
+        history (int): Number of gaps the mean is taken over
+    '''
+
+    def __init__(self, interval=1.0, threshold=8.0, timeout=None, history=100):
+        self.interval = interval
+        self.threshold = threshold
+        self.timeout = timeout
+        self.last = {}
+        self.gaps = {}
+        self.unheard = set()
+        self.history = history
+        self.lock = threading.Lock()
+
+    def watch(self, addrs, now=None):
+        '''Start timing peers which were not heard from yet'''
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            for addr in addrs:
+                if addr not in self.last:
+                    self.last[addr] = now
+                    self.unheard.add(addr)
+
+    def heard(self, addr, now=None):
+        '''Record a message from ``addr``'''
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            last = self.last.get(addr)
+            self.last[addr] = now
+            if addr in self.unheard:
+                self.unheard.discard(addr)
+            elif last is not None:
+                gaps = self.gaps.get(addr)
+                if gaps is None:
+                    gaps = self.gaps[addr] = collections.deque(maxlen=self.history)
+                gaps.append(now - last)
+
+    def phi(self, addr, now=None):
+        '''How suspicious the silence of ``addr`` is. ``0`` for peers which are not watched.'''
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            last = self.last.get(addr)
+            if last is None:
+                return 0.0
+            gaps = self.gaps.get(addr)
+            mean = sum(gaps) / len(gaps) if gaps else self.interval
+        return (now - last) / max(mean, 1e-6) * math.log10(math.e)
+
+    def suspects(self, addrs, now=None):
+        '''The addresses in ``addrs`` which are suspected to have failed'''
+        now = time.monotonic() if now is None else now
+        if self.timeout is not None:
+            with self.lock:
+                return [a for a in addrs if a in self.last and now - self.last[a] >= self.timeout]
+        return [a for a in addrs if self.phi(a, now) >= self.threshold]
+
+
 class BaseCommunicator(object):
     '''Communicators send and receive data with a specific "tag" and store it until a user
     retrieves it.
@@ -176,25 +725,48 @@ class BaseCommunicator(object):
     Possible to simply just send -> get, however you won't be able to receive connection
     attempts from other hosts
 
+    Args:
+        port (int): The port to listen on and send to
+        window (int): Number of iterations of data to keep per sender, see ``DataStore``.
+         ``None`` keeps everything until it is retrieved.
+
     '''
 
-    def __init__(self, port):
+    def __init__(self, port, window=None):
         self.connections = {}
-        self.data_store = {}
+        self.data_store = DataStore(window)
         self.listen_thread = None
         self.listen_sock = None
         self.port = check_port(port)
 
         self.is_listening = False
         self.recv_callback = None
+        self.detector = None
+        self.heartbeat_thread = None
+        self.heartbeat_stop = threading.Event()
 
         self.conn_lock = threading.Lock()
         self.data_lock = threading.Lock()
+        # Signalled every time a complete message lands in the data store
+        self.data_ready = threading.Condition(self.data_lock)
 
     def send(self, addr, data, tag):
         '''Sends a message of bytes to addr with a tag identifier'''
         raise NotImplementedError("Can't use base communicator object. Use UDP or TCP")
 
+    def broadcast(self, addrs, data, tag):
+        '''Sends the same message to every address in ``addrs``
+
+        Subclasses override this to encode the message only once.
+
+        Args:
+            addrs (iterable): The addresses to send to
+            data (bytes): Data to send
+            tag (bytes): Message identifier. Will take up to first 4 bytes
+        '''
+        for addr in addrs:
+            self.send(addr, data, tag)
+
     def listen(self):
         '''Listen for incoming messages or connection requests'''
         raise NotImplementedError("Can't use BaseCommunicator. Use UDP or TCP.")
@@ -207,45 +779,176 @@ class BaseCommunicator(object):
         '''Close all the communicator sockets'''
         raise NotImplementedError("Can't use BaseCommunicator. Use UDP or TCP.")
 
-    def get(self, ip_addr, tag):
+    def get(self, ip_addr, tag, timeout=0):
         '''Get a key/tag value from the data store.
 
         The data is only going to be located in the data store if every single packet for the given
         tag was received and able to be reassembled. Otherwise the incomplete data will reside
         in ``self.tmp_data``.
 
-        The ``self.data_store`` object has the following structure:
-
-        .. code-block:: javascript
-
-            {
-                ip_address: {
-                    tag_1: data,
-                    tag_2: data2
-                }
-            }
+        Complete messages are kept in ``self.data_store`` (a ``DataStore``) by sender and tag.
 
+        By default the call returns immediately. With a ``timeout`` the calling thread sleeps
+        until the data arrives (or the timeout expires) instead of polling.
 
         Args:
             ip (str): The ip address of the host we wish get data from
             tag (bytes/bytearray): The data tag for the message which is being received
+            timeout (float): Seconds to wait for the data. ``0`` does not wait, ``None`` waits
+             forever.
 
         Returns:
             bytes: ``None`` if complete data is not found, Otherwise if found will return the data
+             (a bytes-like ``memoryview`` for data received over TCP)
 
         '''
-        data = None
         tg_int = int.from_bytes(check_tag(tag), byteorder='little')
-        if ip_addr not in self.data_store:
-            data = None
-        elif tg_int not in self.data_store[ip_addr]:
-            data = None
-        else:
-            self.data_lock.acquire()
-            data = self.data_store[ip_addr][tg_int]
-            self.data_store[ip_addr][tg_int] = None
-            self.data_lock.release()
-        return data
+        with self.data_ready:
+            self.data_ready.wait_for(lambda: self._peek(ip_addr, tg_int) is not None, timeout)
+            return self._take(ip_addr, tg_int)
+
+    def wait_any(self, addrs, tag, timeout=0):
+        '''Block until the data for ``tag`` is available from at least one of ``addrs``.
+
+        Args:
+            addrs (iterable): The addresses to wait on
+            tag (bytes/bytearray): The data tag for the message which is being received
+            timeout (float): Seconds to wait. ``0`` (the default) does not wait, ``None`` waits
+             forever.
+
+        Returns:
+            tuple: ``(addr, data)`` for the first address with data. ``(None, None)`` on timeout.
+        '''
+        tg_int = int.from_bytes(check_tag(tag), byteorder='little')
+        addrs = list(addrs)
+
+        def ready():
+            # Wrapped in a tuple so that falsy addresses such as 0 still count as ready
+            for addr in addrs:
+                if self._peek(addr, tg_int) is not None:
+                    return (addr,)
+            return None
+
+        with self.data_ready:
+            found = self.data_ready.wait_for(ready, timeout)
+            if not found:
+                return (None, None)
+            return (found[0], self._take(found[0], tg_int))
+
+    def wait_all(self, addrs, tag, timeout=0):
+        '''Block until the data for ``tag`` is available from every address in ``addrs``.
+
+        Whatever arrived before the timeout is still returned (and removed from the data store).
+
+        Args:
+            addrs (iterable): The addresses to wait on
+            tag (bytes/bytearray): The data tag for the message which is being received
+            timeout (float): Seconds to wait. ``0`` (the default) does not wait, ``None`` waits
+             forever.
+
+        Returns:
+            dict: Maps each address to its data, or ``None`` if it did not arrive in time.
+        '''
+        tg_int = int.from_bytes(check_tag(tag), byteorder='little')
+        addrs = list(addrs)
+        with self.data_ready:
+            self.data_ready.wait_for(
+                lambda: all(self._peek(addr, tg_int) is not None for addr in addrs), timeout)
+            return {addr: self._take(addr, tg_int) for addr in addrs}
+
+    def start_heartbeat(self, addrs, interval=1.0, threshold=8.0, timeout=None):
+        '''Send a heartbeat to every address in ``addrs`` every ``interval`` seconds from a
+        background thread and start a ``FailureDetector`` on them.
+
+        Heartbeats only feed the detector and never show up in the data store. Any other message
+        from a peer counts as a heartbeat too. Every peer's heartbeat is sent from its own worker
+        thread, and a peer whose last heartbeat is still being sent is skipped, so a dead peer
+        never holds up the heartbeats of the others. A suspected peer only gets a heartbeat every
+        ``HEARTBEAT_PROBE`` intervals. That is still enough for a peer which comes back, and which
+        in turn suspected this node, to hear from it again.
+
+        Args:
+            addrs (iterable): The peers to send heartbeats to and watch
+            interval (float): Seconds between heartbeats
+            threshold (float): Phi at which a peer is suspected, see ``FailureDetector``
+            timeout (float): Seconds of silence after which a peer is suspected, instead of phi
+        '''
+        self.stop_heartbeat()
+        addrs = list(addrs)
+        self.detector = FailureDetector(interval, threshold, timeout)
+        self.detector.watch(addrs)
+        self.heartbeat_stop.clear()
+        self.heartbeat_thread = threading.Thread(target=self._run_heartbeat,
+                                                 args=(addrs, interval), daemon=True)
+        self.heartbeat_thread.start()
+
+    def stop_heartbeat(self):
+        '''Stop sending heartbeats. The failure detector keeps its state.'''
+        if self.heartbeat_thread is not None:
+            self.heartbeat_stop.set()
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+
+    def suspects(self, addrs):
+        '''The addresses in ``addrs`` which the failure detector suspects to have failed.
+        Empty without ``start_heartbeat``.'''
+        if self.detector is None:
+            return []
+        return self.detector.suspects(addrs)
+
+    def _run_heartbeat(self, addrs, interval):
+        # One worker per peer, so a send stuck on a dead peer never delays the live ones
+        pool = ThreadPoolExecutor(max_workers=max(1, len(addrs)))
+        pending = {}
+        probes = {}
+        while not self.heartbeat_stop.is_set():
+            now = time.monotonic()
+            suspects = set(self.suspects(addrs))
+            for addr in addrs:
+                if addr in pending and not pending[addr].done():
+                    continue
+                if addr in suspects:
+                    if now < probes.get(addr, now):
+                        continue
+                    probes[addr] = now + HEARTBEAT_PROBE * interval
+                pending[addr] = pool.submit(self._send_heartbeat, addr, interval)
+            self.heartbeat_stop.wait(interval)
+        pool.shutdown(wait=False)
+
+    def _send_heartbeat(self, addr, timeout):
+        '''Send one heartbeat, giving up after about ``timeout`` seconds where the
+        communicator can'''
+        try:
+            self.send(addr, b'\x00', HEARTBEAT_TAG)
+        except Exception as err:  # pylint: disable=broad-except
+            logger.debug('Heartbeat to %s failed: %s', addr, err)
+
+    def _peek(self, addr, tg_int):
+        '''Look up data in the data store without removing it. Needs ``self.data_lock``.'''
+        return self.data_store.peek(addr, tg_int)
+
+    def _take(self, addr, tg_int):
+        '''Remove and return data from the data store. Needs ``self.data_lock``.'''
+        return self.data_store.take(addr, tg_int)
+
+    def _store(self, addr, tg_int, data):
+        '''Put a complete message into the data store and wake up any waiting threads.
+
+        Every message is reported to the failure detector. Heartbeats stop there.
+
+        Returns:
+            bool: ``False`` if the message was a heartbeat or the data store discarded it as late
+        '''
+        if self.detector is not None:
+            self.detector.heard(addr)
+        if tg_int == HEARTBEAT:
+            return False
+        with self.data_ready:
+            if not self.data_store.put(addr, tg_int, data):
+                logger.debug('Discarded late message from %s with tag %s', addr, tg_int)
+                return False
+            self.data_ready.notify_all()
+        return True
 
     def register_recv_callback(self, callback):
         '''Allows one to register a callback function which is executed whenever a
@@ -260,15 +963,60 @@ class BaseCommunicator(object):
         Returns:
             N/A
         '''
-        if isinstance(callback, collections.Callable) is not True:
-            raise TypeError("Callback must be a function")
-        fullspec = inspect.getfullargspec(callback)
-        n_args = len(fullspec[0])
-        if n_args != 3:
-            raise ValueError("Callback function did not have 3 arguments.")
+        check_callback(callback)
         self.recv_callback = callback
 
 
+class LoopbackCommunicator(BaseCommunicator):
+    '''Communicator for nodes in the same process which hands messages straight to the
+    receiver's data store.
+
+    Every node of a simulated network shares one ``network`` dict, which maps addresses to the
+    objects receiving their messages. ``listen`` adds this node to it. Any object with a
+    ``deliver(src, tg_int, data)`` method can stand in for a node, e.g. to forward the
+    messages to another process.
+
+    Args:
+        addr: This node's address. Any hashable value works.
+        network (dict): Maps every address to its receiver
+        window (int): Number of iterations of data to keep per sender, see ``DataStore``
+    '''
+
+    def __init__(self, addr, network, window=None):
+        super().__init__(0, window)
+        self.addr = addr
+        self.network = network
+
+    def listen(self):
+        '''Start receiving the messages sent to ``self.addr``'''
+        self.network[self.addr] = self
+        self.is_listening = True
+
+    def close(self):
+        '''Stop receiving messages'''
+        self.stop_heartbeat()
+        if self.network.get(self.addr) is self:
+            del self.network[self.addr]
+        self.is_listening = False
+
+    def send(self, addr, data, tag):
+        '''Deliver a message to ``addr``
+
+        Returns:
+            bool: ``False`` if nothing listens on ``addr``
+        '''
+        receiver = self.network.get(addr)
+        if receiver is None:
+            return False
+        receiver.deliver(self.addr, int.from_bytes(check_tag(tag), byteorder='little'), data)
+        return True
+
+    def deliver(self, src, tg_int, data):
+        '''Store a message from ``src`` as if it had arrived over the network'''
+        if self._store(src, tg_int, data) and self.recv_callback is not None:
+            self.recv_callback(src, tg_int, data)
+
+
 class TCPCommunicator(BaseCommunicator):
     '''Communicators send and receive data with a specific "tag" and store it until a user
     retrieves it.
@@ -278,16 +1026,34 @@ class TCPCommunicator(BaseCommunicator):
     Possible to simply just send -> get, however you won't be able to receive connection
     attempts from other hosts
 
+    All of the receiving work is done by a single reactor thread (see ``_run_tcp``) which
+    multiplexes the listening socket and every peer connection with ``selectors``. Other threads
+    hand new outgoing connections to the reactor through ``self.pending`` and wake it up by
+    writing a byte to ``self.wakeup_w``.
+
+    Args:
+        port (int): The port to listen on and send to
+        window (int): Number of iterations of data to keep per sender, see ``DataStore``
+        timeout (float): Seconds a send keeps trying to connect to a peer before it fails
     '''
 
-    def __init__(self, port):
-        super().__init__(port)
+    def __init__(self, port, window=None, timeout=15):
+        super().__init__(port, window)
+        self.timeout = timeout
+        self.selector = None
+        self.wakeup_r = None
+        self.wakeup_w = None
+        self.pending = collections.deque()
+        self.send_locks = {}
+        self.send_pool = None
+        self.send_pool_size = 0
 
     def connect(self, ip_addr, timeout=None):
         '''Connect to a TCP socket at ``ip_addr:self.port``.
 
-        The connection of addr will be put into the internal connections dictionary. When the next
-        send call is initiated a new thread will start reading messages from the connection
+        The connection of addr will be put into the internal connections dictionary. If the
+        communicator is listening, the connection is handed to the reactor thread which reads
+        messages from it.
 
         The call will block until timeout seconds have passed. A socket.TimeoutError will be
         raised if the connection is not successful. Otherwise if timeout is None the call
@@ -328,11 +1094,14 @@ class TCPCommunicator(BaseCommunicator):
         if msg is not None:
             logger.info("Exception trying to connect to %s with err %s", ip_addr, msg)
 
+        if conn is not None:
+            # The connection is kept for later sends, which must not inherit a short connect
+            # timeout such as the one of a heartbeat
+            conn.settimeout(self.timeout)
         self.conn_lock.acquire()
         if conn is not None and ip_addr not in self.connections: # Brand new
             self.connections[ip_addr] = conn
-            conn_thread = threading.Thread(target=self._run_connect, args=(conn, ip_addr))
-            conn_thread.start()
+            self._add_connection(conn, ip_addr)
         elif conn is not None and ip_addr in self.connections: # Already existing
             logger.warning("Connect to ip %s requested but connection already existed", ip_addr)
             conn.close()
@@ -353,34 +1122,102 @@ class TCPCommunicator(BaseCommunicator):
         tag = check_tag(tag)
         if not isinstance(data, bytes):
             raise TypeError("data must be bytes")
-        # Create the packet with tag at the top
-        msg = bytearray()
-        msg += tag
-        msg += data
-        mlen = len(msg) # msg length
-        msg = struct.pack('!I', mlen) + msg # prepend message length to data
-        self._attempt_send_data(addr, msg, timeout=15)
+        self._attempt_send_data(addr, (frame_header(data, tag), data), timeout=self.timeout)
+
+    def _send_heartbeat(self, addr, timeout):
+        try:
+            self._attempt_send_data(addr, (frame_header(b'\x00', HEARTBEAT_TAG), b'\x00'),
+                                    timeout=min(timeout, self.timeout))
+        except RuntimeError as err:
+            logger.debug('Heartbeat to %s failed: %s', addr, err)
+
+    def broadcast(self, addrs, data, tag):
+        '''Sends the same data to every address in ``addrs``
+
+        The frame header is built once and sent together with the (shared) payload using
+        scatter-gather I/O. Each neighbor is written to from its own worker thread so the call
+        takes as long as the slowest link rather than the sum of all of them.
+
+        Args:
+            addrs (iterable): IPv4 Addresses to send to
+            data (bytes): Data to send
+            tag (bytes): Message identifier. Will take up to first 4 bytes
+
+        Raises:
+            SendError: if sending to any of the addresses failed. The others were still sent to.
+        '''
+        tag = check_tag(tag)
+        if not isinstance(data, bytes):
+            raise TypeError("data must be bytes")
+        msg = (frame_header(data, tag), data)
+        addrs = list(addrs)
+        if len(addrs) == 0:
+            return
+        if len(addrs) == 1:
+            try:
+                self._attempt_send_data(addrs[0], msg, timeout=self.timeout)
+            except RuntimeError as err:
+                raise SendError({addrs[0]: str(err)}) from err
+            return
+
+        if self.send_pool is None or self.send_pool_size < len(addrs):
+            # One worker per neighbor so that no link waits behind another
+            if self.send_pool is not None:
+                self.send_pool.shutdown()
+            self.send_pool = ThreadPoolExecutor(max_workers=len(addrs))
+            self.send_pool_size = len(addrs)
+        futures = [self.send_pool.submit(self._attempt_send_data, addr, msg, self.timeout)
+                   for addr in addrs]
+        failed = {}
+        for addr, future in zip(addrs, futures):
+            try:
+                future.result()
+            except RuntimeError as err:
+                failed[addr] = str(err)
+        if len(failed) > 0:
+            raise SendError(failed)
 
     def listen(self):
-        '''Start listening on port ``self.port``. Creates a new thread where the socket will
-        listen for incoming data
+        '''Start listening on port ``self.port``. Creates the reactor thread which accepts
+        connections and reads incoming data from every peer.
+
+        Raises:
+            OSError: if the port could not be bound
         '''
         if self.is_listening is True:
             raise RuntimeError('Cannot listen. Socket already listening.')
 
         if self.listen_thread is None:  # Create thread if not already created
             self.listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.listen_thread = threading.Thread(target=self._run_tcp,
-                                                  args=(self.listen_sock, '0.0.0.0',
-                                                        self.port))
+            try:
+                self.listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.listen_sock.bind(('0.0.0.0', self.port))
+                # Accept maximum of ten un-accepted conns before refusing
+                self.listen_sock.listen(10)
+                self.listen_sock.setblocking(False)
+            except OSError as err:
+                logger.warning("Could not bind to %s:%s, Got %s", '0.0.0.0', self.port, err)
+                self.listen_sock.close()
+                self.listen_sock = None
+                raise
+            self.selector = selectors.DefaultSelector()
+            self.wakeup_r, self.wakeup_w = socket.socketpair()
+            self.wakeup_r.setblocking(False)
+            self.listen_thread = threading.Thread(target=self._run_tcp, args=(self.listen_sock,))
 
             self.is_listening = True
+            with self.conn_lock:
+                # Connections made before listen() still need to be read from
+                for addr, conn in self.connections.items():
+                    self.pending.append((conn, addr))
             self.listen_thread.start()
 
     def close(self):
         logger.debug('Close requested on communicator %s', self)
+        self.stop_heartbeat()
         if self.listen_thread != None:
             self.is_listening = False
+            self._wakeup()
             self.listen_thread.join()
             self.listen_thread = None
         try:
@@ -388,6 +1225,12 @@ class TCPCommunicator(BaseCommunicator):
         except BaseException as err:
             logger.debug('exception closing listening socket: %s', err)
 
+        for wake_sock in (self.wakeup_r, self.wakeup_w):
+            if wake_sock is not None:
+                wake_sock.close()
+        self.wakeup_r = None
+        self.wakeup_w = None
+
         with self.conn_lock:
             for addr in self.connections:
                 try:
@@ -395,105 +1238,157 @@ class TCPCommunicator(BaseCommunicator):
                 except BaseException as err:
                     logger.debug('Closing %s, Error: %s', addr, err)
         self.connections = {}
+        self.send_locks = {}
+        self.pending.clear()
+        if self.send_pool is not None:
+            self.send_pool.shutdown()
+            self.send_pool = None
+            self.send_pool_size = 0
+
+    def _wakeup(self):
+        '''Interrupt the reactor's ``select`` call so that it notices new connections or a
+        shutdown request.
+        '''
+        try:
+            self.wakeup_w.send(b'\x00')
+        except (AttributeError, OSError):
+            pass
 
-    def _run_tcp(self, _sock, host, port, unacc_conn=10):
-        '''Method which accepts TCP connections and passes them off to run_connect
+    def _add_connection(self, conn, addr):
+        '''Queue a connection so that the reactor thread starts reading from it.
 
-        Args:
-            _sock (sockets.socket): A socket object to bind to
-            host (str): The hostname/IP that we should bind the socket to. Use empty string '' for
-            senders who wish to contact you outside the network.
-            port (int): The port as an integer
+        Must be called with ``self.conn_lock`` held.
         '''
-        _sock.settimeout(1.5)
-        _sock.bind((host, port))
-        # Accept maximum of three un-accepted conns before refusing
-        _sock.listen(unacc_conn)
-        while self.is_listening:
-            try:
-                conn, addr = _sock.accept()
-                #logger.info('Accepted new socket connection to %s', str(addr[0]))
-                self.conn_lock.acquire()
-                if addr[0] not in self.connections:
-                    self.connections[addr[0]] = conn
-                    thd = threading.Thread(target=self._run_connect,
-                                           args=(conn, addr[0]))
-                    thd.start()
-                else:
-                    logger.debug('Got new connection which was already present from %s', addr)
-                    conn.close()
-                self.conn_lock.release()
-            except socket.timeout:
-                pass
-                # logger.debug('__run_tcp__, connection accept timeout: %s', err)
-        logger.debug('Listening thread exiting')
+        if self.is_listening:
+            self.pending.append((conn, addr))
+            self._wakeup()
 
-    def _run_connect(self, connection, addr):
-        '''Worker methods which receives data from TCP connections.
+    def _run_tcp(self, _sock):
+        '''Reactor loop which accepts TCP connections and reads messages from all of them.
 
-        Must be able to convert TCP byte streams into individual messages. In order to accomplish
-        this we used a message-length prefixing strategy. Every message sent from the other end of
-        the wire is required to prefix a 4-byte message length to the very front of every message.
-        This allows us to 'chunk' the messages and read only the necessary bytes. If an invalid
-        message length arrives then we close the socket connection and log an error.
+        A single ``selectors`` selector owns the listening socket, the wakeup socket and every
+        peer connection. The thread only wakes up when one of them is readable so an idle
+        communicator uses no CPU, no matter how many neighbors it has.
 
         Args:
-            connection (connection): A TCP connection from socket.accept()
-            addr (str): The Inet(6) address representing the address of the client
+            _sock (sockets.socket): A bound, listening, non-blocking socket
         '''
+        self.selector.register(_sock, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        while self.is_listening:
+            self._register_pending()
+            for key, _ in self.selector.select():
+                if key.fileobj is _sock:
+                    self._accept(_sock)
+                elif key.fileobj is self.wakeup_r:
+                    self._drain_wakeup()
+                else:
+                    self._handle_read(key.fileobj, key.data)
+
+        for key in list(self.selector.get_map().values()):
+            self.selector.unregister(key.fileobj)
+        self.selector.close()
+        logger.debug('Listening thread exiting')
 
-        while self.is_listening: # A break from this loop indicated the connection closed
+    def _register_pending(self):
+        '''Register the connections queued by other threads with the selector'''
+        while self.pending:
+            conn, addr = self.pending.popleft()
             try:
-                # Get message length
-                len_b = recv_n_bytes(connection, 4)
-                if len_b is None:
-                    break
-                m_len = struct.unpack('!I', len_b)[0] # Get the next message length
-                if m_len < 0:
-                    # Log an error, close connection
-                    logger.warning("msg len < 0")
-                    break
-                msg_data = recv_n_bytes(connection, m_len)
-                if msg_data is not None:
-                    self.receive_tcp(msg_data, addr)
-                else:
-                    logger.warning("msgdata is None")
-                    break # Close connection if returned None
+                self.selector.register(conn, selectors.EVENT_READ, FrameReader(addr))
+            except (KeyError, ValueError, OSError) as err:
+                logger.debug('Could not register connection to %s: %s', addr, err)
 
-            except socket.timeout as err:
+    def _drain_wakeup(self):
+        try:
+            while self.wakeup_r.recv(1024):
                 pass
-            except OSError as err:
-                logger.warning('OSError on _run_tcp: %s', err)
-                break
+        except (BlockingIOError, OSError):
+            pass
 
-        self.conn_lock.acquire()
-        del self.connections[addr]  # Remove the connection
-        logger.debug("Popped connection with addr %s", addr)
-        self.conn_lock.release()
+    def _accept(self, _sock):
+        '''Accept a pending connection on the listening socket'''
+        try:
+            conn, addr = _sock.accept()
+        except (BlockingIOError, socket.timeout):
+            return
+        except OSError as err:
+            logger.warning('Error accepting connection: %s', err)
+            return
+        #logger.info('Accepted new socket connection to %s', str(addr[0]))
+        with self.conn_lock:
+            if addr[0] not in self.connections:
+                self.connections[addr[0]] = conn
+                self.selector.register(conn, selectors.EVENT_READ, FrameReader(addr[0]))
+            else:
+                logger.debug('Got new connection which was already present from %s', addr)
+                conn.close()
+
+    def _handle_read(self, connection, reader):
+        '''Read whatever is available on a connection and pass complete messages on.
+
+        Must be able to convert TCP byte streams into individual messages. In order to accomplish
+        this we used a message-length prefixing strategy. Every message sent from the other end of
+        the wire is required to prefix a 4-byte message length to the very front of every message.
+        The connection's ``FrameReader`` fills one buffer per message in place. If the peer closes
+        the connection or an error occurs we drop the connection.
+
+        Args:
+            connection (connection): A TCP connection registered with the selector
+            reader (FrameReader): The frame reader stored with the connection
+        '''
+        try:
+            msg_data = reader.read(connection)
+        except (BlockingIOError, socket.timeout):
+            return
+        except EOFError:
+            self._drop_connection(connection, reader.addr)
+            return
+        except (OSError, ValueError, MemoryError) as err:
+            logger.warning('Error reading from %s: %s', reader.addr, err)
+            self._drop_connection(connection, reader.addr)
+            return
+        if msg_data is None:
+            return
+        try:
+            self.receive_tcp(msg_data, reader.addr)
+        except Exception as err:
+            # Never let one bad message (or recv callback) take down the reactor
+            logger.exception('Error handling message from %s: %s', reader.addr, err)
+            self._drop_connection(connection, reader.addr)
+
+    def _drop_connection(self, connection, addr):
+        '''Stop reading from a connection and remove it from the connections dictionary'''
+        try:
+            self.selector.unregister(connection)
+        except (KeyError, ValueError):
+            pass
+        with self.conn_lock:
+            if self.connections.get(addr) is connection:
+                del self.connections[addr]  # Remove the connection
+                logger.debug("Popped connection with addr %s", addr)
         try:
             connection.close()
         except OSError as err:
-            logger.debug('_run_connect, error closing TCP socket: %s', err)
-        return
+            logger.debug('_drop_connection, error closing TCP socket: %s', err)
 
     def receive_tcp(self, data, addr):
         '''Stores the TCP data reveived into the data store
 
+        The payload is stored as a ``memoryview`` into ``data`` rather than a copy.
+
         Args:
-            data (bytes) : The data to store.
+            data (bytes) : The data to store. Any bytes-like object.
             addr (str): The ip address of the node.
 
         '''
-        if len(data) < 4:
+        data_tag, dat = split_frame(data)
+        if data_tag is None:
             # Log error on data
             return
-        data_tag = int.from_bytes(data[:4], byteorder='little')
-        dat = data[4:]
 
-        with self.data_lock:
-            if addr not in self.data_store:
-                self.data_store[addr] = {}
-            self.data_store[addr][data_tag] = dat
+        if not self._store(addr, data_tag, dat):
+            return
         logger.debug('Stored data at [%s][%s]', addr, data_tag)
         if self.recv_callback != None:
             # run a callback on the newly collected data.
@@ -504,31 +1399,308 @@ class TCPCommunicator(BaseCommunicator):
         '''Perform an attempt at sending data to the specified address
 
         First we check if we can access the connection in our current connections list.
-        Then if it exists, we send it or find a new
+        If it does not exist we try to make a new one. Writes to a single connection are
+        serialized with a per-connection lock so that concurrent senders never interleave frames.
 
         Args:
             addr (str): The IP address to send to
-            msg (bytes): The message in bytes to send
+            msg (tuple): The bytes-like buffers making up the message, sent in order
         '''
-        with self.conn_lock:
-            if addr in self.connections:
-                self.connections[addr].sendall(msg)
-                return
-
         try:
-            self.connect(addr, timeout=timeout)
-            # addr should now be in connections if connect() was successful
             with self.conn_lock:
-                conn_sock = self.connections[addr]
-                conn_sock.sendall(msg)
+                conn_sock = self.connections.get(addr)
+            if conn_sock is None:
+                self.connect(addr, timeout=timeout)
+                # addr should now be in connections if connect() was successful
+                with self.conn_lock:
+                    conn_sock = self.connections[addr]
+            with self.conn_lock:
+                send_lock = self.send_locks.setdefault(addr, threading.Lock())
+            with send_lock:
+                sendmsg_all(conn_sock, msg)
             logger.debug('Successfully transmitted data to %s', addr)
-        except OSError as err:
+        except (OSError, KeyError) as err:
             # Log message about how unable to send
             exception = 'Unable to send data to {}. Error: {}'.format(addr, err)
             logger.error(exception)
             raise RuntimeError(exception)
 
 
+class AsyncTCPCommunicator(object):
+    '''TCP communicator driven by an ``asyncio`` event loop instead of threads.
+
+    It uses the same wire format as ``TCPCommunicator`` (4-byte message length, 4-byte tag,
+    data) so the two can talk to each other. Every connection is read by a task on the event
+    loop, and every method which does I/O is a coroutine, so a single loop can run the
+    consensus, the neighbor I/O and anything else the node does at the same time.
+
+    Lifetime: await listen -> await send -> await get -> await close
+
+    Args:
+        port (int): The port to listen on and to connect to
+        window (int): Number of iterations of data to keep per sender, see ``DataStore``
+    '''
+
+    def __init__(self, port, window=None):
+        self.port = check_port(port)
+        self.connections = {}
+        self.data_store = DataStore(window)
+        self.server = None
+        self.readers = set()
+        self.connecting = {}
+        self.recv_callback = None
+        self.data_ready = None
+
+    async def listen(self):
+        '''Start accepting connections on ``self.port``.
+
+        Raises:
+            OSError: if the port could not be bound
+        '''
+        if self.server is not None:
+            raise RuntimeError('Cannot listen. Socket already listening.')
+        self.server = await asyncio.start_server(self._accept, '0.0.0.0', self.port,
+                                                 reuse_address=True)
+
+    async def connect(self, ip_addr, timeout=None):
+        '''Connect to ``ip_addr:self.port``, retrying until ``timeout`` seconds have passed.
+
+        Args:
+            ip_addr (str): The IP to connect to on self.port
+            timeout (float): Seconds to keep trying. ``None`` keeps trying forever.
+
+        Raises:
+            ConnectionError: if no connection could be made in time
+        '''
+        if ip_addr in self.connections:
+            logger.warning('Attempting to make a connection to %s which already exists.', ip_addr)
+            return
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        msg = None
+        while deadline is None or loop.time() < deadline:
+            remaining = None if deadline is None else deadline - loop.time()
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(ip_addr, self.port), remaining)
+            except (OSError, asyncio.TimeoutError) as err:
+                msg = str(err)
+                await asyncio.sleep(0.1)
+                continue
+            self._add_connection(reader, writer, ip_addr)
+            return
+        logger.info("Exception trying to connect to %s with err %s", ip_addr, msg)
+        raise ConnectionError('Unable to connect to {}'.format(ip_addr))
+
+    async def send(self, addr, data, tag, timeout=15):
+        '''Sends data to a host, connecting to it first if needed
+
+        Args:
+            addr (str): IPv4 Address to send to
+            data (bytes): Data to send
+            tag (bytes): Message identifier. Will take up to first 4 bytes
+            timeout (float): Seconds to keep trying to connect
+
+        Raises:
+            RuntimeError: if the data could not be sent
+        '''
+        tag = check_tag(tag)
+        if not isinstance(data, bytes):
+            raise TypeError("data must be bytes")
+        await self._send_frame(addr, frame_header(data, tag), data, timeout)
+
+    async def broadcast(self, addrs, data, tag, timeout=15):
+        '''Sends the same data to every address in ``addrs`` concurrently
+
+        Args:
+            addrs (iterable): IPv4 Addresses to send to
+            data (bytes): Data to send
+            tag (bytes): Message identifier. Will take up to first 4 bytes
+            timeout (float): Seconds to keep trying to connect to each address
+
+        Raises:
+            SendError: if sending to any of the addresses failed
+        '''
+        tag = check_tag(tag)
+        if not isinstance(data, bytes):
+            raise TypeError("data must be bytes")
+        header = frame_header(data, tag)
+        addrs = list(addrs)
+        results = await asyncio.gather(
+            *(self._send_frame(addr, header, data, timeout) for addr in addrs),
+            return_exceptions=True)
+        failed = {addr: str(res) for addr, res in zip(addrs, results)
+                  if isinstance(res, Exception)}
+        if len(failed) > 0:
+            raise SendError(failed)
+
+    async def get(self, addr, tag, timeout=0):
+        '''Get the data for ``tag`` from ``addr``, waiting for it to arrive.
+
+        Args:
+            addr (str): The ip address of the host we wish get data from
+            tag (bytes/bytearray): The data tag for the message which is being received
+            timeout (float): Seconds to wait for the data. ``0`` does not wait, ``None`` waits
+             forever.
+
+        Returns:
+            memoryview: The data, or ``None`` if it did not arrive in time
+        '''
+        tg_int = int.from_bytes(check_tag(tag), byteorder='little')
+        cond = self._condition()
+        async with cond:
+            await self._wait_for(cond, lambda: self._peek(addr, tg_int) is not None, timeout)
+            return self._take(addr, tg_int)
+
+    async def gather_round(self, neighbors, tag, timeout=None):
+        '''Wait for the data for ``tag`` from every neighbor.
+
+        Whatever arrived before the timeout is still returned (and removed from the data store).
+
+        Args:
+            neighbors (iterable): The addresses to wait on
+            tag (bytes/bytearray): The data tag for the message which is being received
+            timeout (float): Seconds to wait. ``0`` does not wait, ``None`` (the default) waits
+             forever.
+
+        Returns:
+            dict: Maps each address to its data, or ``None`` if it did not arrive in time.
+        '''
+        tg_int = int.from_bytes(check_tag(tag), byteorder='little')
+        neighbors = list(neighbors)
+        cond = self._condition()
+        async with cond:
+            await self._wait_for(
+                cond, lambda: all(self._peek(n, tg_int) is not None for n in neighbors), timeout)
+            return {n: self._take(n, tg_int) for n in neighbors}
+
+    async def close(self):
+        '''Stop listening and close every connection'''
+        logger.debug('Close requested on communicator %s', self)
+        if self.server is not None:
+            self.server.close()
+        for task in list(self.readers):
+            task.cancel()
+        await asyncio.gather(*self.readers, return_exceptions=True)
+        self.readers = set()
+        self.connections = {}
+        if self.server is not None:
+            await self.server.wait_closed()
+            self.server = None
+
+    def register_recv_callback(self, callback):
+        '''Register a function which is called with ``(sender, tag, data)`` whenever a full
+        message is received. See ``BaseCommunicator.register_recv_callback``.
+        '''
+        check_callback(callback)
+        self.recv_callback = callback
+
+    def _condition(self):
+        '''The condition signalled whenever a message lands in the data store. Created lazily
+        so that it belongs to the running loop.'''
+        if self.data_ready is None:
+            self.data_ready = asyncio.Condition()
+        return self.data_ready
+
+    @staticmethod
+    async def _wait_for(cond, predicate, timeout):
+        if timeout == 0:
+            return
+        try:
+            await asyncio.wait_for(cond.wait_for(predicate), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _peek(self, addr, tg_int):
+        return self.data_store.peek(addr, tg_int)
+
+    def _take(self, addr, tg_int):
+        return self.data_store.take(addr, tg_int)
+
+    async def _send_frame(self, addr, header, data, timeout):
+        '''Write one frame to ``addr``. ``write`` only queues the bytes, so frames from
+        concurrent senders never interleave.'''
+        try:
+            writer = self.connections.get(addr)
+            if writer is None:
+                # Senders racing to the same new address share one connection attempt
+                task = self.connecting.get(addr)
+                if task is None:
+                    task = asyncio.ensure_future(self.connect(addr, timeout))
+                    self.connecting[addr] = task
+                    task.add_done_callback(lambda _: self.connecting.pop(addr, None))
+                await asyncio.shield(task)
+                writer = self.connections[addr]
+            writer.write(header)
+            writer.write(data)
+            await writer.drain()
+            logger.debug('Successfully transmitted data to %s', addr)
+        except (OSError, KeyError) as err:
+            exception = 'Unable to send data to {}. Error: {}'.format(addr, err)
+            logger.error(exception)
+            raise RuntimeError(exception)
+
+    async def _accept(self, reader, writer):
+        addr = writer.get_extra_info('peername')[0]
+        self._add_connection(reader, writer, addr)
+
+    def _add_connection(self, reader, writer, addr):
+        '''Start reading from a connection. The first connection to an address is also the one
+        used to send to it.'''
+        if addr not in self.connections:
+            self.connections[addr] = writer
+        task = asyncio.ensure_future(self._read_frames(reader, writer, addr))
+        self.readers.add(task)
+        task.add_done_callback(self.readers.discard)
+
+    async def _read_frames(self, reader, writer, addr):
+        '''Read length-prefixed messages from a connection until it closes. A ``FrameReader``
+        splits the stream into messages like it does for ``TCPCommunicator``.'''
+        frames = FrameReader(addr)
+        try:
+            while True:
+                pending = frames.pending()
+                chunk = await reader.read(len(pending))
+                pending[:len(chunk)] = chunk
+                msg = frames.advance(len(chunk))
+                if msg is None:
+                    continue
+                try:
+                    await self.receive_tcp(msg, addr)
+                except Exception as err:
+                    logger.exception('Error handling message from %s: %s', addr, err)
+                    break
+        except EOFError:
+            pass
+        except (OSError, ValueError, MemoryError) as err:
+            logger.warning('Error reading from %s: %s', addr, err)
+        finally:
+            if self.connections.get(addr) is writer:
+                del self.connections[addr]
+            writer.close()
+
+    async def receive_tcp(self, data, addr):
+        '''Stores a received message into the data store and wakes up the waiting coroutines
+
+        Args:
+            data (bytes) : The tag followed by the data
+            addr (str): The ip address of the node.
+        '''
+        data_tag, dat = split_frame(data)
+        if data_tag is None or data_tag == HEARTBEAT:
+            # Heartbeats of a threaded peer carry no data
+            return
+        cond = self._condition()
+        async with cond:
+            if not self.data_store.put(addr, data_tag, dat):
+                logger.debug('Discarded late message from %s with tag %s', addr, data_tag)
+                return
+            cond.notify_all()
+        logger.debug('Stored data at [%s][%s]', addr, data_tag)
+        if self.recv_callback is not None:
+            self.recv_callback(addr, data_tag, dat)
+
+
 class UDPCommunicator(BaseCommunicator):
     '''This is a threaded class interface designed to send and receive messages
      'asynchronously' via python's threading interface. It was designed mainly
@@ -578,21 +1750,82 @@ class UDPCommunicator(BaseCommunicator):
     - Data segments which have not been reconstructed lie within
      ``self.tmp_data``. Reconstructed data is within ``self.data_store``
 
+    - The listener thread blocks in ``select`` until a datagram arrives or ``close`` writes to
+     ``self.wakeup_w``, so an idle communicator uses no CPU. See ``_run_listen``.
+
     Constructor Docs
 
+    Reliable mode
+
+    With ``reliable=True`` the sender keeps the packets of its last ``retransmit_size`` messages.
+    A receiver which has part of a message but got nothing new for ``nack_delay`` seconds sends
+    a NACK listing the missing packets (see ``build_nack``), at most ``max_nacks`` times, and the
+    sender sends those packets again. Both ends need reliable mode. Packets of a message which
+    was completed less than ``nack_delay * (max_nacks + 1)`` seconds ago are taken to be
+    retransmissions and ignored, so a sender should not reuse a tag within that time.
+    Without reliable mode the same holds for ``nack_delay`` seconds after an FEC message, which
+    drops the parity packets that arrive after the data they protect.
+
+    Forward error correction
+
+    With ``fec=K`` every group of ``K`` data packets is followed by a parity packet holding their
+    XOR, so a receiver can rebuild one lost packet per group without a round trip. This costs
+    one extra packet per ``K``, i.e. an overhead of ``1 / K``. The group size travels in the
+    packet header, so receivers decode FEC whatever their own setting. Both modes can be used
+    together, NACKs then only ask for the packets parity could not rebuild.
+
+    Multicast
+
+    With ``multicast`` set, ``broadcast`` sends its packets once to the multicast group of the
+    tag's run (see ``multicast_group``) instead of once per address, so a node's egress traffic
+    no longer grows with its degree. Receivers ``join`` the group of a run and should restrict
+    the senders they accept with ``filter_sources``, since every member of a group gets every
+    message, including its own. ``send`` is still unicast, as are retransmissions.
+
     Args:
         protocol (str): A string. One of 'UDP' or 'TCP' (case insensistive)
         listen_port(int): A port between 0 and 65535
         send_port(int): (Optional) Defaults to value set for listen_port, otherwise
          must be set to a valid port number.
+        window (int): Number of iterations of data to keep per sender, see ``DataStore``
+        reliable (bool): Retransmit lost packets
+        nack_delay (float): Seconds without progress on a message before asking for packets
+        max_nacks (int): Number of times to ask for the packets of a message
+        retransmit_size (int): Number of sent messages kept for retransmission
+        fec (int): Data packets per parity packet, between 1 and 255. 0 disables FEC.
+        max_mtu (int): Largest MTU to use towards any host, which is also the size of the
+         receive buffer. Every node should use the same value.
+        multicast (str): Multicast group of run 0, ``None`` to broadcast with unicast
+        multicast_ttl (int): Number of router hops the multicast packets may take
 
     '''
 
-    def __init__(self, port):
+    def __init__(self, port, window=None, reliable=False, nack_delay=0.05, max_nacks=5,
+                 retransmit_size=64, fec=0, max_mtu=MAX_MTU, multicast=None, multicast_ttl=1):
         '''Constructor calls BaseCommunicator constructor and sets up tmp data store'''
+        if not isinstance(fec, int) or fec < 0 or fec > 255:
+            raise ValueError('fec must be an integer between 0 and 255')
+        self.fec = fec
+        self.max_mtu = max(max_mtu, get_mtu())
+        self.mtus = {}
+        self.multicast = multicast
+        self.multicast_ttl = multicast_ttl
+        self.groups = set()
+        self.sources = None
+        self.selector = None
+        self.wakeup_r = None
+        self.wakeup_w = None
         self.tmp_data = {}
         self.send_sock = None
-        super().__init__(port)
+        super().__init__(port, window)
+        self.reliable = reliable
+        self.nack_delay = nack_delay
+        self.max_nacks = max_nacks
+        self.retransmit_size = retransmit_size
+        self.retransmit = collections.OrderedDict()
+        self.completed = collections.OrderedDict()
+        self.last_check = 0
+        self.recovered = 0
 
     def close(self):
         '''Closes both listening sockets and the sending sockets
@@ -607,11 +1840,18 @@ class UDPCommunicator(BaseCommunicator):
 
         '''
         logger.debug('Close requested on communicator %s', self)
+        self.stop_heartbeat()
         if self.is_listening is True:
             if self.listen_thread != None:
                 self.is_listening = False
+                self._wakeup()
                 self.listen_thread.join()
                 self.listen_thread = None
+        for wake_sock in (self.wakeup_r, self.wakeup_w):
+            if wake_sock is not None:
+                wake_sock.close()
+        self.wakeup_r = None
+        self.wakeup_w = None
         # On a close, we can still send afterwards, but we never receive anything
         try:
             self.listen_sock.close()
@@ -639,9 +1879,13 @@ class UDPCommunicator(BaseCommunicator):
         '''
         if self.listen_thread is None:  # Create thread if not already created
             self.listen_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            # Set to nonblocking in order to get our threaded server to work :) (We
-            # should investigate the performance impact of this)
+            # Nonblocking so that the listener can drain every ready datagram after a select
             self.listen_sock.setblocking(False)
+            for group in self.groups:
+                self._add_membership(group)
+            self.selector = selectors.DefaultSelector()
+            self.wakeup_r, self.wakeup_w = socket.socketpair()
+            self.wakeup_r.setblocking(False)
             self.listen_thread = threading.Thread(target=self._run_listen,
                                                   args=(self.listen_sock, '0.0.0.0',
                                                         self.port))
@@ -649,9 +1893,27 @@ class UDPCommunicator(BaseCommunicator):
             self.is_listening = True
             self.listen_thread.start()
 
+    def _wakeup(self):
+        '''Interrupt the listener's ``select`` call so that it notices a shutdown request'''
+        try:
+            self.wakeup_w.send(b'\x00')
+        except (AttributeError, OSError):
+            pass
+
+    def _drain_wakeup(self):
+        try:
+            while self.wakeup_r.recv(1024):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
     def _run_listen(self, _sock, host, port):
         '''Worker method for the threaded listener in order to retrieve incoming messages
 
+        The thread sleeps in ``select`` on the socket and the wakeup socket. In reliable mode it
+        also wakes up every ``nack_delay / 2`` seconds while messages are incomplete, to send
+        NACKs.
+
         Args:
             _sock (sockets.socket): A socket object to bind to
             host (str): The hostname/IP that we should bind the socket to. Use empty string '' for
@@ -667,20 +1929,100 @@ class UDPCommunicator(BaseCommunicator):
         except BaseException as err:
             logger.warning("Could not bind to %s:%s, Got %s", host, port, err)
             _sock.close()
+            self.selector.close()
             self.close()
             return
 
+        self.selector.register(_sock, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+        buf = bytearray(self.max_mtu)
         while self.is_listening:
-            try:
-                data, addr = _sock.recvfrom(1024)  # Receive at max 1024 bytes
-                # logger.debug('Received data from address {}'.format(addr))
-                self.receive(data, addr[0])
-            except BlockingIOError:
-                pass
+            timeout = None
+            if self.reliable and any(self.tmp_data.values()):
+                timeout = self.nack_delay / 2
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is _sock:
+                    self._drain_socket(_sock, buf)
+                else:
+                    self._drain_wakeup()
+            if self.reliable:
+                try:
+                    self._check_missing()
+                except Exception as err:
+                    logger.exception('Error sending NACKs: %s', err)
 
+        self.selector.close()
         _sock.close()
+        logger.debug('Listening thread exiting')
+
+    def _drain_socket(self, _sock, buf):
+        '''Read every datagram waiting on the socket into ``buf`` and process it.
 
-    def create_packets(self, data, tag):
+        ``buf`` is reused for every datagram, so ``receive`` must copy whatever it keeps.
+        '''
+        view = memoryview(buf)
+        while True:
+            try:
+                nbytes, addr = _sock.recvfrom_into(buf)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as err:
+                logger.debug('Error receiving datagram: %s', err)
+                return
+            if nbytes < HEADER_SIZE:
+                logger.debug('Ignoring a %s byte datagram from %s', nbytes, addr[0])
+                continue
+            if self.sources is not None and addr[0] not in self.sources:
+                continue
+            try:
+                self.receive(view[:nbytes], addr[0])
+            except Exception as err:
+                # Never let one bad datagram (or recv callback) take down the listener
+                logger.exception('Error handling datagram from %s: %s', addr[0], err)
+
+    def join(self, run_id):
+        '''Receive the multicast messages of a consensus run.
+
+        Args:
+            run_id (int): The run id, i.e. the ``tag_id`` given to the consensus algorithm
+        '''
+        if self.multicast is None:
+            raise RuntimeError('The communicator was not created with a multicast group')
+        group = multicast_group(self.multicast, run_id)
+        if group not in self.groups:
+            self.groups.add(group)
+            if self.listen_sock is not None:
+                self._add_membership(group)
+
+    def _add_membership(self, group):
+        mreq = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton('0.0.0.0'))
+        self.listen_sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+
+    def filter_sources(self, addrs):
+        '''Only accept datagrams from ``addrs``, e.g. the neighbors of this node.
+
+        Args:
+            addrs (iterable): The addresses to accept. ``None`` accepts every address.
+        '''
+        self.sources = None if addrs is None else frozenset(addrs)
+
+    def path_mtu(self, ip_addr):
+        '''The MTU towards ``ip_addr``, discovered on first use and then cached
+
+        Args:
+            ip_addr (str): The hostname/ip of the peer
+
+        Returns:
+            int: The MTU in bytes
+        '''
+        mtu = self.mtus.get(ip_addr)
+        if mtu is None:
+            mtu = discover_mtu(ip_addr, self.port, self.max_mtu)
+            logger.debug('Path MTU towards %s is %s', ip_addr, mtu)
+            self.mtus[ip_addr] = mtu
+        return mtu
+
+    def create_packets(self, data, tag, mtu=None):
         '''Segments a chunk of data (payload) into separate packets in order to send in sequence to
         the desired address.
 
@@ -689,70 +2031,65 @@ class UDPCommunicator(BaseCommunicator):
         the packet overhead (metadata) as well as subtract the IP headers in order to find the
         maximal amount of payload data we can send in a single packet.
 
-        We need to use the MTU in this case which we'll take as typically a minimum of 576 bytes.
-        According to RFC 791 the maximum IP header size is 60 bytes (typically 20), and according
-        to RFC 768, the UDP header size is 8 bytes. This leaves the bare minimum payload size to be
-        508 bytes. (576 - 60 - 8).
+        We need to use the MTU in this case, which is the path MTU towards the destination (see
+        ``path_mtu``) or a minimum of 576 bytes. According to RFC 791 the maximum IP header size
+        is 60 bytes (typically 20), and according to RFC 768, the UDP header size is 8 bytes. For
+        576 bytes this leaves the bare minimum payload size to be 508 bytes. (576 - 60 - 8).
 
-        We will structure packets as such (not including IP/UDP headers)
+        We will structure packets as such (not including IP/UDP headers), with little endian
+        integers
 
-        +---------------------+--------------------+---------------+
-        | Seq.Total (2 bytes) | Seq. Num (2 bytes) | Tag (4 bytes) |
-        +---------------------+--------------------+---------------+
-        |                      Data (500 Bytes)                    |
-        +----------------------------------------------------------+
+        +---------------------+--------------------+---------------+------------+------------+
+        | Seq.Total (4 bytes) | Seq. Num (4 bytes) | Tag (4 bytes) | Flags (1B) | Group (1B) |
+        +---------------------+--------------------+---------------+------------+------------+
+        |                           Data (494 Bytes for a 576 byte MTU)                     |
+        +-----------------------------------------------------------------------------------+
 
-        A limitation is that we can only sequence a total of 2^16 packets which, given a max data
-        size of 500 bytes gives us a maximum data transmission of (2^16)*500 ~= 33MB for a single
-        request.
+        The sequence numbers allow 2^32 packets, far more than any message we send.
 
         Also note that the Seq Num. is zero-indexed so that the maximum sequence number (and the
         sequence total) will go up to ``len(packets) - 1``. Or in other words, 1 less than the
-        number of packets.
+        number of data packets.
+
+        With FEC each group of ``self.fec`` data packets (the last group may be smaller) is
+        followed by a parity packet. It has the ``FLAG_PARITY`` flag, the group number as its
+        Seq. Num and ``xor_parity`` of the group as data, which takes two bytes more than the
+        data packets so these carry 2 bytes less.
 
         Args:
             data (bytes): The data as a string which is meant to be sent to its destination
             tag (bytes): A tag. Only the first 4 bytes are added as the tag.
+            mtu (int): The MTU towards the destination. Defaults to ``get_mtu()``
 
         Returns
             list: A list containing the payload for the packets which should be sent to the
             destination.
         '''
         packets = []
-        max_payload = get_mtu() - 68  # conservative estimate to prevent IP fragmenting on UDP
-        metadata_size = 8  # 8 bytes constant
-        data_size = len(data)
-        max_data = max_payload - metadata_size
-
-        # TWO CASES
-        # - We can send everything in 1 packet
-        # - We must break into multiple packets which will require sequencing
-        if data_size <= max_data:
-            # Assemble the packet, no sequencing
-            payload = build_meta_packet(0, 0, tag)
-            payload += data
-            packets.append(payload)
-        else:
-            total_packets = math.floor(data_size / max_payload)
-            for i in range(total_packets):  # [0, total_packets-1]
-                pkt1 = build_meta_packet(i, total_packets, tag)
-
-                # Slice data into ~500 byte packs
-                dat1 = data[i * max_data:(i + 1) * max_data]
-                pkt1 += dat1
-                packets.append(pkt1)
-            # Build the  final packet
-            pkt1 = build_meta_packet(total_packets, total_packets, tag)
-            min_bound = (total_packets) * max_data
-            dat1 = data[min_bound:]
-            pkt1 += dat1
+        mtu = get_mtu() if mtu is None else mtu
+        max_payload = mtu - 68  # conservative estimate to prevent IP fragmenting on UDP
+        max_data = max_payload - HEADER_SIZE
+        group = self.fec
+        if group > 0:
+            max_data -= 2  # Room for the XOR of the lengths in the parity packets
+
+        # Slice data into MTU sized packs, an empty message still needs one packet
+        chunks = [data[i:i + max_data] for i in range(0, len(data), max_data)] or [data]
+        seq_total = len(chunks) - 1
+        for i, chunk in enumerate(chunks):
+            pkt1 = build_meta_packet(i, seq_total, tag, group=group)
+            pkt1 += chunk
             packets.append(pkt1)
+            if group > 0 and (i % group == group - 1 or i == seq_total):
+                parity = build_meta_packet(i // group, seq_total, tag, FLAG_PARITY, group)
+                parity += xor_parity(chunks[i - i % group:i + 1])
+                packets.append(parity)
 
         return packets
 
     def send(self, ip_addr, data, tag):
         '''Send a chunk of data with a specific tag to an ip address. The packet will be
-        automatically chunked into N packets where N = ceil(bytes/(MTU-68))
+        automatically chunked into N packets where N = ceil(bytes/(MTU-68)) with the path MTU
 
         Args:
             ip (str): The hostname/ip to send to
@@ -766,12 +2103,75 @@ class UDPCommunicator(BaseCommunicator):
         if not isinstance(data, bytes):
             raise TypeError("data must be bytes")
 
-        if self.send_sock is None:
-            self.send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         # As simple as just creating the packets and sending each one
         # individually
+        packets = self.create_packets(data, tag, self.path_mtu(ip_addr))
+        self._remember(ip_addr, tag, packets)
+        return self._send_packets(packets, ip_addr)
+
+    def broadcast(self, addrs, data, tag):
+        '''Send the same data to every address in ``addrs``. The data is only split into packets
+        once, for the smallest path MTU, and the same packets are sent to each address. In
+        multicast mode they are sent only once, to the group of the tag's run, unless ``addrs``
+        holds a single address.
+
+        Args:
+            addrs (iterable): The hostnames/ips to send to
+            data (bytes): The bytes of data which will be sent to the other hosts.
+            tag (bytes): An identifier for the message
+
+        Returns:
+            bool: True if all packets were sent successfully to every address.
+        '''
+        tag = check_tag(tag)
+        if not isinstance(data, bytes):
+            raise TypeError("data must be bytes")
+        addrs = list(addrs)
+        if len(addrs) == 0:
+            return True
+        if self.multicast is not None and len(addrs) > 1:
+            # A single address gets unicast, e.g. the per-neighbor messages of
+            # corrective consensus which other group members must not see
+            group = multicast_group(self.multicast, tag[0])
+            packets = self.create_packets(data, tag, self.path_mtu(group))
+            for ip_addr in addrs:
+                # Receivers NACK with their own address
+                self._remember(ip_addr, tag, packets)
+            return self._send_packets(packets, group)
+        packets = self.create_packets(data, tag, min(self.path_mtu(a) for a in addrs))
+        ret = True
+        for ip_addr in addrs:
+            self._remember(ip_addr, tag, packets)
+            ret = self._send_packets(packets, ip_addr) and ret
+        return ret
+
+    def _remember(self, ip_addr, tag, packets):
+        '''Keep the packets of a message in the retransmit buffer in reliable mode'''
+        if not self.reliable:
+            return
+        key = (ip_addr, int.from_bytes(tag, byteorder='little'))
+        if self.fec > 0:
+            # NACKs ask for data packets by sequence number
+            packets = [p for p in packets if not parse_meta_packet(p)[3] & FLAG_PARITY]
+        with self.conn_lock:
+            self.retransmit[key] = packets
+            self.retransmit.move_to_end(key)
+            while len(self.retransmit) > self.retransmit_size:
+                self.retransmit.popitem(last=False)
+
+    def _send_packets(self, packets, ip_addr):
+        '''Send a list of packets to a single address
+
+        Returns:
+            bool: True if all packets were sent successfully.
+        '''
+        with self.conn_lock:
+            if self.send_sock is None:
+                self.send_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                if self.multicast is not None:
+                    self.send_sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL,
+                                              self.multicast_ttl)
         ret = True
-        packets = self.create_packets(data, tag)
         # logger.debug("Sending {} packet(s) to {}".format(len(packets), ip))
         for packet in packets:
             # logger.debug('Sending packet to IP: {} on port {}'.format(ip, self.send_port))
@@ -783,6 +2183,9 @@ class UDPCommunicator(BaseCommunicator):
             except OSError as err:
                 ret = False
                 logger.warning(str(err))
+                if err.errno == errno.EMSGSIZE:
+                    # The path MTU went down, find it again on the next send
+                    self.mtus.pop(ip_addr, None)
                 break
         return ret
 
@@ -798,11 +2201,16 @@ class UDPCommunicator(BaseCommunicator):
                 ip_address: {
                     tag_1: {
                         'seq_total': Max_num_packets,
+                        'group': Packets_per_parity_packet,
                         'packets' = {
                             1: packet_data_1,
                             2: packet_data_2,
                             ...
                             ...
+                        },
+                        'parity' = {
+                            group_1: parity_data_1,
+                            ...
                         }
                     },
                     tag_2: {
@@ -815,7 +2223,8 @@ class UDPCommunicator(BaseCommunicator):
             }
 
         Args:
-            data (bytes): a packet of data received over the socket to process
+            data (bytes): a packet of data received over the socket to process. A
+             ``memoryview`` may be reused once the call returns.
             addr (str): The ip address or hostname of the sending host
 
         Returns:
@@ -826,25 +2235,48 @@ class UDPCommunicator(BaseCommunicator):
             self.tmp_data[addr] = {}
 
         # disassemble the packet
-        seq_total = struct.unpack('H', data[0:2])[0]
-        seq_num = struct.unpack('H', data[2:4])[0]
-        data_tag = int.from_bytes(data[4:8], byteorder='little')
-        dat = data[8:]
+        seq_num, seq_total, data_tag, flags, group = parse_meta_packet(data)
+        dat = bytes(data[HEADER_SIZE:])
+
+        if flags & FLAG_PROBE:
+            return
+        if flags & FLAG_NACK:
+            self._handle_nack(addr, data_tag, dat)
+            return
 
         # Create an entry for data_tag
         if data_tag not in self.tmp_data[addr]:
+            with self.data_lock:
+                if self.data_store.is_stale(addr, data_tag):
+                    self.data_store.late += 1
+                    return
+            if (self.reliable or group > 0) and self._recently_completed(addr, data_tag):
+                return
+            self._evict_partial(addr)
             self.tmp_data[addr][data_tag] = {}
             self.tmp_data[addr][data_tag]['packets'] = {}
+            self.tmp_data[addr][data_tag]['parity'] = {}
             self.tmp_data[addr][data_tag]['seq_total'] = seq_total
+            self.tmp_data[addr][data_tag]['group'] = group
+            self.tmp_data[addr][data_tag]['nacks'] = 0
+        self.tmp_data[addr][data_tag]['updated'] = time.monotonic()
 
         if (seq_total != self.tmp_data[addr][data_tag]['seq_total']
                 or self.tmp_data[addr][data_tag]['seq_total'] is None):
             # If the tag existed, make sure the sequence total is equal to the
             # current, otherwise throw away any packets we've already collected
             self.tmp_data[addr][data_tag]['seq_total'] = seq_total
+            self.tmp_data[addr][data_tag]['group'] = group
             self.tmp_data[addr][data_tag]['packets'] = {}
+            self.tmp_data[addr][data_tag]['parity'] = {}
 
-        self.tmp_data[addr][data_tag]['packets'][seq_num] = dat
+        if flags & FLAG_PARITY:
+            self.tmp_data[addr][data_tag]['parity'][seq_num] = dat
+            self._fec_recover(self.tmp_data[addr][data_tag], seq_num)
+        else:
+            self.tmp_data[addr][data_tag]['packets'][seq_num] = dat
+            if group > 0:
+                self._fec_recover(self.tmp_data[addr][data_tag], seq_num // group)
 
         num_packets = len(self.tmp_data[addr][data_tag]['packets'])
         # seq_total is max index of 0-index based list.
@@ -853,15 +2285,495 @@ class UDPCommunicator(BaseCommunicator):
             reassembled = bytes()
             for i in range(num_packets):
                 reassembled += self.tmp_data[addr][data_tag]['packets'][i]
-            if addr not in self.data_store:
-                self.data_store[addr] = {}
             logger.debug("Adding reassmbled packet to data store with IP %s and tag %s",
                          addr, data_tag)
-            self.data_lock.acquire()
-            self.data_store[addr][data_tag] = reassembled
-            self.data_lock.release()
-            if self.recv_callback != None:
+            del self.tmp_data[addr][data_tag]
+            if self.reliable or group > 0:
+                self.completed[(addr, data_tag)] = time.monotonic()
+            if self._store(addr, data_tag, reassembled) and self.recv_callback != None:
                 # run a callback on the newly collected packets.
                 self.recv_callback(addr, data_tag, reassembled)
-            self.tmp_data[addr][data_tag]['packets'] = {}
-            self.tmp_data[addr][data_tag]['seq_total'] = {}
+
+    def _fec_recover(self, entry, grp):
+        '''Rebuild the missing data packet of group ``grp`` from its parity packet, if exactly
+        one is missing'''
+        parity = entry['parity'].get(grp)
+        if parity is None:
+            return
+        packets = entry['packets']
+        first = grp * entry['group']
+        seqs = range(first, min(first + entry['group'], entry['seq_total'] + 1))
+        missing = [seq for seq in seqs if seq not in packets]
+        if len(missing) == 1:
+            packets[missing[0]] = xor_recover(parity, (packets[s] for s in seqs
+                                                       if s != missing[0]))
+            self.recovered += 1
+
+    def _recently_completed(self, addr, data_tag):
+        '''Whether a message was completed so recently that its packets must be duplicates'''
+        linger = self.nack_delay * (self.max_nacks + 1) if self.reliable else self.nack_delay
+        horizon = time.monotonic() - linger
+        while self.completed and next(iter(self.completed.values())) < horizon:
+            self.completed.popitem(last=False)
+        return (addr, data_tag) in self.completed
+
+    def _check_missing(self, now=None):
+        '''Send NACKs for partly received messages which made no progress for ``nack_delay``
+        seconds. Runs on the listener thread in reliable mode.
+
+        A message which made no progress ``nack_delay`` seconds after its last NACK is given up
+        on. It is counted as dropped and its later packets are ignored like duplicates.'''
+        now = time.monotonic() if now is None else now
+        if now - self.last_check < self.nack_delay / 2:
+            return
+        self.last_check = now
+        for addr, tags in self.tmp_data.items():
+            given_up = []
+            for data_tag, entry in tags.items():
+                if now - entry['updated'] < self.nack_delay:
+                    continue
+                if entry['nacks'] >= self.max_nacks:
+                    given_up.append(data_tag)
+                    continue
+                missing = [seq for seq in range(entry['seq_total'] + 1)
+                           if seq not in entry['packets']]
+                if len(missing) == 0:
+                    continue
+                entry['nacks'] += 1
+                entry['updated'] = now
+                logger.debug('NACK %s packets of tag %s from %s', len(missing), data_tag, addr)
+                tag = data_tag.to_bytes(TAG_SIZE, byteorder='little')
+                self._send_packets([build_nack(missing, tag)], addr)
+            for data_tag in given_up:
+                logger.debug('Giving up on tag %s from %s', data_tag, addr)
+                del tags[data_tag]
+                self.completed[(addr, data_tag)] = now
+            if len(given_up) > 0:
+                with self.data_lock:
+                    self.data_store.dropped += len(given_up)
+
+    def _handle_nack(self, addr, data_tag, payload):
+        '''Send the packets a receiver asked for again, if they are still buffered'''
+        with self.conn_lock:
+            packets = self.retransmit.get((addr, data_tag))
+        if packets is None:
+            logger.debug('NACK from %s for tag %s which is not buffered', addr, data_tag)
+            return
+        resend = [packets[seq] for seq in parse_nack(payload) if seq < len(packets)]
+        self._send_packets(resend, addr)
+
+    def _evict_partial(self, addr):
+        '''Throw away partly received messages from ``addr`` whose iteration has left the data
+        store window. They are counted as dropped.'''
+        with self.data_lock:
+            stale = [tag for tag in self.tmp_data[addr] if self.data_store.is_stale(addr, tag)]
+            self.data_store.dropped += len(stale)
+        for tag in stale:
+            del self.tmp_data[addr][tag]
+
+
+def open_shm(name, create=False, size=0):
+    '''Create or attach a ``SharedMemory`` segment which the resource tracker leaves alone where
+    Python allows it, see ``ShmRing``'''
+    if SHM_TRACK:
+        return shared_memory.SharedMemory(name, create=create, size=size, track=False)
+    return shared_memory.SharedMemory(name, create=create, size=size)
+
+
+class ShmRing(object):
+    '''Single producer, single consumer ring buffer of tagged messages in a
+    ``multiprocessing.shared_memory`` segment.
+
+    The segment starts with the producer's write position (8 bytes) and, on its own cache line,
+    the consumer's read position. Both only grow, so ``head - tail`` is the number of bytes in
+    use. Each message is a 4 byte length, the 4 byte tag and the data, padded to 8 bytes. A
+    message which does not fit before the end of the buffer is preceded by a ``PAD`` length
+    and written at the start instead.
+
+    Both sides hold an ``flock`` on a lock file next to the named pipes while they touch the
+    cursors and the message. Weakly ordered CPUs such as the ARM cores of a Raspberry Pi may
+    otherwise make the new ``head`` visible before the message it covers. Taking and releasing
+    the lock are system calls, which order all memory accesses around them on every
+    architecture.
+
+    The producer creates the segment, replacing one left over from an earlier run, and only
+    then tells the consumer about it. The consumer never creates it, so the two sides cannot
+    race to create it with different sizes. The producer also owns the name and is the only
+    side which unlinks it. Before Python 3.13 the resource tracker of a consumer's process
+    still unlinks the segment when that process exits.
+
+    Args:
+        name (str): Name of the shared memory segment
+        size (int): Size of the segment
+        create (bool): Whether this is the producer's end, which creates the segment
+    Raises:
+        FileNotFoundError: if the consumer's end is opened before the producer created it
+        ValueError: if an existing segment is smaller than ``size``
+    '''
+    CURSORS = 128  # Bytes before the data, holding head at 0 and tail at 64
+    PAD = 0xFFFFFFFF
+
+    def __init__(self, name, size=SHM_RING_SIZE, create=True):
+        if create:
+            try:
+                self.shm = open_shm(name, create=True, size=size)
+            except FileExistsError:
+                stale = open_shm(name)
+                stale.close()
+                stale.unlink()
+                self.shm = open_shm(name, create=True, size=size)
+        else:
+            self.shm = open_shm(name)
+            if self.shm.size < size:
+                self.shm.close()
+                raise ValueError('Segment {} has {} bytes, expected {}'.format(
+                    name, self.shm.size, size))
+        self.name = name
+        self.owner = create
+        self.buf = self.shm.buf
+        self.capacity = (size - self.CURSORS) // 8 * 8
+        self.lock_path = os.path.join(tempfile.gettempdir(), '{}.lock'.format(name))
+        self.lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+
+    def _locked(self, func, *args):
+        fcntl.flock(self.lock_fd, fcntl.LOCK_EX)
+        try:
+            return func(*args)
+        finally:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+
+    def _cursor(self, offset):
+        return struct.unpack_from('Q', self.buf, offset)[0]
+
+    def write(self, tag, data):
+        '''Copy a message into the ring
+
+        Args:
+            tag (bytes): 4 byte tag
+            data (bytes): The message
+
+        Returns:
+            bool: ``False`` if the ring does not have room for the message right now
+        '''
+        size = memoryview(data).nbytes
+        frame = (8 + size + 7) // 8 * 8
+        if frame > self.capacity:
+            raise ValueError('Message of {} bytes does not fit in a {} byte ring'.format(
+                size, self.capacity))
+        return self._locked(self._write, tag, data, size, frame)
+
+    def _write(self, tag, data, size, frame):
+        head, tail = self._cursor(0), self._cursor(64)
+        pos = head % self.capacity
+        tail_room = self.capacity - pos
+        wrap = frame > tail_room
+        if (tail_room if wrap else 0) + frame > self.capacity - (head - tail):
+            return False
+        if wrap:
+            struct.pack_into('I', self.buf, self.CURSORS + pos, self.PAD)
+            head += tail_room
+            pos = 0
+        start = self.CURSORS + pos
+        struct.pack_into('I4s', self.buf, start, size, tag)
+        self.buf[start + 8:start + 8 + size] = data
+        struct.pack_into('Q', self.buf, 0, head + frame)
+        return True
+
+    def read(self):
+        '''Copy the oldest message out of the ring
+
+        Returns:
+            tuple: ``(tag, data)`` as bytes, or ``None`` if the ring is empty
+        '''
+        return self._locked(self._read)
+
+    def _read(self):
+        head, tail = self._cursor(0), self._cursor(64)
+        if tail == head:
+            return None
+        pos = tail % self.capacity
+        start = self.CURSORS + pos
+        size = struct.unpack_from('I', self.buf, start)[0]
+        if size == self.PAD:
+            tail += self.capacity - pos
+            start = self.CURSORS
+            size = struct.unpack_from('I', self.buf, start)[0]
+        tag = bytes(self.buf[start + 4:start + 8])
+        data = bytes(self.buf[start + 8:start + 8 + size])
+        struct.pack_into('Q', self.buf, 64, tail + (8 + size + 7) // 8 * 8)
+        return tag, data
+
+    def close(self):
+        '''Unmap the segment. The producer's end also removes its name.'''
+        self.buf = None
+        self.shm.close()
+        os.close(self.lock_fd)
+        if self.owner:
+            try:
+                os.unlink(self.lock_path)
+            except FileNotFoundError:
+                pass
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class ShmCommunicator(BaseCommunicator):
+    '''Communicator for nodes on the same host which exchanges messages through shared memory.
+
+    Every directed edge gets a ``ShmRing``, so sending is one copy into shared memory and
+    receiving one copy out of it, with no sockets involved. After writing to a ring the sender
+    writes its address and a newline to the receiver's named pipe (in the temp directory),
+    which wakes up the receiver's listener thread to drain the rings of the senders it was
+    told about. The wakeup also carries a token which is new for every ring the sender
+    creates, so a receiver reopens the ring of a sender which restarted.
+
+    ``get``, ``wait_any`` and ``wait_all`` first drain the rings in the calling thread, so data
+    which is already in shared memory is returned without waiting for the listener thread.
+    Receive callbacks can therefore run on the calling thread as well.
+
+    Nodes are told apart by ``addr``, which can be any name without newlines, and
+    communicators with different ``port`` values never see each other's messages. A sender
+    waits for the receiver to listen (and for room in a full ring) for up to ``timeout``
+    seconds, the same as ``TCPCommunicator`` waits to connect.
+
+    Args:
+        port (int): Separates independent groups of nodes on the host
+        addr (str): This node's address, the one its neighbors send to
+        window (int): Number of iterations of data to keep per sender, see ``DataStore``
+        ring_size (int): Bytes of shared memory per edge, which bounds the message size
+        timeout (float): Seconds a send waits for the receiver
+    '''
+
+    def __init__(self, port, addr, window=None, ring_size=SHM_RING_SIZE, timeout=15):
+        super().__init__(port, window)
+        if '\n' in addr:
+            raise ValueError('addr may not contain a newline')
+        self.addr = addr
+        self.ring_size = ring_size
+        self.timeout = timeout
+        self.inbound = {}
+        self.outbound = {}
+        # Tokens of the rings from each sender and of the rings to each receiver
+        self.in_tokens = {}
+        self.out_tokens = {}
+        self.pipes = {}
+        self.send_locks = {}
+        self.fifo_fd = None
+        self.fifo_keep = None
+        # Only one thread at a time may read the rings
+        self.drain_lock = threading.Lock()
+
+    def _name(self, src, dst):
+        '''Name of the shared memory segment of the edge from ``src`` to ``dst``'''
+        return 'adac_{}_{}_{}'.format(self.port, re.sub(r'[^\w.-]', '_', src),
+                                      re.sub(r'[^\w.-]', '_', dst))
+
+    def _fifo(self, addr):
+        '''Path of the named pipe which wakes up node ``addr``'''
+        return os.path.join(tempfile.gettempdir(), '{}.fifo'.format(self._name(addr, 'notify')))
+
+    def listen(self):
+        '''Create this node's named pipe and start the thread which receives messages'''
+        if self.is_listening is True:
+            raise RuntimeError('Cannot listen. Already listening.')
+        path = self._fifo(self.addr)
+        try:
+            os.unlink(path)  # Left over from a node which did not close
+        except FileNotFoundError:
+            pass
+        os.mkfifo(path, 0o600)
+        self.fifo_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        # Keep a writer open so the pipe never reads as closed between senders
+        self.fifo_keep = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        self.is_listening = True
+        self.listen_thread = threading.Thread(target=self._run_listen)
+        self.listen_thread.start()
+
+    def _run_listen(self):
+        '''Sleep on the named pipe and drain the rings of every sender which writes to it'''
+        selector = selectors.DefaultSelector()
+        selector.register(self.fifo_fd, selectors.EVENT_READ)
+        pending = b''
+        while self.is_listening:
+            selector.select()
+            try:
+                while True:
+                    chunk = os.read(self.fifo_fd, 4096)
+                    if not chunk:
+                        break
+                    pending += chunk
+            except BlockingIOError:
+                pass
+            *lines, pending = pending.split(b'\n')
+            try:
+                with self.drain_lock:
+                    for line in dict.fromkeys(lines):
+                        if line:
+                            self._open_inbound(*line.decode('utf-8').rsplit(' ', 1))
+                    self._drain_all()
+            except Exception as err:  # pylint: disable=broad-except
+                # Never let one bad wakeup or ring take down the listener
+                logger.exception('Error receiving from shared memory: %s', err)
+        selector.close()
+        logger.debug('Listening thread exiting')
+
+    def _open_inbound(self, src, token):
+        '''Open the ring from ``src`` unless it is open already. A new token means that the
+        sender created a new ring, and what is left in the old one is drained first. Needs
+        ``self.drain_lock``.'''
+        if self.in_tokens.get(src) == token and src in self.inbound:
+            return
+        old = self.inbound.pop(src, None)
+        if old is not None:
+            logger.info('%s created a new ring, reopening it', src)
+            self._drain(src, old)
+            old.close()
+        try:
+            self.inbound[src] = ShmRing(self._name(src, self.addr), self.ring_size, create=False)
+        except (OSError, ValueError) as err:
+            logger.warning('Could not open the ring from %s: %s', src, err)
+            return
+        self.in_tokens[src] = token
+
+    def _drain(self, src, ring):
+        '''Move every message in the ring from ``src`` into the data store. Needs
+        ``self.drain_lock``.'''
+        while True:
+            msg = ring.read()
+            if msg is None:
+                return
+            tg_int = int.from_bytes(msg[0], byteorder='little')
+            if self._store(src, tg_int, msg[1]) and self.recv_callback is not None:
+                try:
+                    self.recv_callback(src, tg_int, msg[1])
+                except Exception as err:  # pylint: disable=broad-except
+                    logger.exception('Receive callback failed on a message from %s: %s',
+                                     src, err)
+
+    def _drain_all(self):
+        '''Move every message in the inbound rings into the data store. Needs
+        ``self.drain_lock``.'''
+        for src, ring in list(self.inbound.items()):
+            try:
+                self._drain(src, ring)
+            except (struct.error, ValueError) as err:
+                # Reopened when the sender wakes this node up again
+                logger.warning('Bad frame in the ring from %s, closing it: %s', src, err)
+                del self.inbound[src]
+                ring.close()
+
+    def _poll(self):
+        '''Drain the rings in the calling thread unless the listener is already at it'''
+        if self.drain_lock.acquire(blocking=False):
+            try:
+                self._drain_all()
+            finally:
+                self.drain_lock.release()
+
+    def get(self, ip_addr, tag, timeout=0):
+        self._poll()
+        return super().get(ip_addr, tag, timeout)
+
+    def wait_any(self, addrs, tag, timeout=0):
+        self._poll()
+        return super().wait_any(addrs, tag, timeout)
+
+    def wait_all(self, addrs, tag, timeout=0):
+        self._poll()
+        return super().wait_all(addrs, tag, timeout)
+
+    def send(self, addr, data, tag):
+        '''Copy a message into the ring of the edge to ``addr`` and wake ``addr`` up.
+
+        Args:
+            addr (str): The receiving node
+            data (bytes): The message
+            tag (bytes): An identifier for the message
+
+        Returns:
+            bool: ``False`` if ``addr`` did not listen or did not make room in time, or if the
+             message is larger than the ring
+        '''
+        tag = check_tag(tag)
+        with self.conn_lock:
+            lock = self.send_locks.setdefault(addr, threading.Lock())
+        with lock:
+            deadline = time.monotonic() + self.timeout
+            fd = self._pipe(addr, deadline)
+            if fd is None:
+                logger.warning('%s is not listening', addr)
+                return False
+            ring = self.outbound.get(addr)
+            if ring is None:
+                ring = ShmRing(self._name(self.addr, addr), self.ring_size)
+                self.outbound[addr] = ring
+                self.out_tokens[addr] = os.urandom(8).hex()
+            while True:
+                try:
+                    if ring.write(tag, data):
+                        break
+                except ValueError as err:
+                    logger.error('Cannot send to %s: %s', addr, err)
+                    return False
+                if time.monotonic() > deadline:
+                    logger.warning('Ring to %s stayed full', addr)
+                    return False
+                time.sleep(0.0005)
+            try:
+                os.write(fd, '{} {}\n'.format(self.addr, self.out_tokens[addr]).encode('utf-8'))
+            except BlockingIOError:
+                pass  # The receiver has wakeups queued and drains every known ring
+            except OSError as err:
+                logger.warning('Could not notify %s: %s', addr, err)
+                os.close(self.pipes.pop(addr))
+                return False
+        return True
+
+    def _pipe(self, addr, deadline):
+        '''Open the named pipe of ``addr``, waiting until the deadline for it to listen'''
+        fd = self.pipes.get(addr)
+        while fd is None:
+            try:
+                fd = os.open(self._fifo(addr), os.O_WRONLY | os.O_NONBLOCK)
+                self.pipes[addr] = fd
+            except OSError as err:
+                # ENOENT: no pipe yet, ENXIO: nobody is reading it
+                if err.errno not in (errno.ENOENT, errno.ENXIO) or time.monotonic() > deadline:
+                    return None
+                time.sleep(0.01)
+        return fd
+
+    def close(self):
+        '''Stop listening and release the pipes and shared memory'''
+        logger.debug('Close requested on communicator %s', self)
+        self.stop_heartbeat()
+        if self.listen_thread is not None:
+            self.is_listening = False
+            try:
+                os.write(self.fifo_keep, b'\n')
+            except OSError:
+                pass
+            self.listen_thread.join()
+            self.listen_thread = None
+        for fd in (self.fifo_fd, self.fifo_keep):
+            if fd is not None:
+                os.close(fd)
+        if self.fifo_fd is not None:
+            try:
+                os.unlink(self._fifo(self.addr))
+            except FileNotFoundError:
+                pass
+        self.fifo_fd = None
+        self.fifo_keep = None
+        for fd in self.pipes.values():
+            os.close(fd)
+        self.pipes = {}
+        # Only the outbound rings are unlinked, their receivers merely unmap theirs
+        for ring in list(self.inbound.values()) + list(self.outbound.values()):
+            ring.close()
+        self.inbound = {}
+        self.outbound = {}
+        self.in_tokens = {}
+        self.out_tokens = {}
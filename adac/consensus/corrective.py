@@ -0,0 +1,205 @@
+'''Corrective Consensus[1] and Accelerated Corrective Consensus[2].
+
+Plain averaging (``adac.consensus.iterative``) only keeps the network average when every
+message arrives. Here each node also keeps, per neighbor, the total amount ``phi_ij`` it has
+moved towards that neighbor. Without losses ``phi_ij = -phi_ji``. Every ``period`` rounds the
+nodes exchange these totals and undo half of every mismatch, which puts back whatever mass lost
+messages took away.
+
+The accelerated version replaces the update with the second order iteration
+``x(t+1) = beta W x(t) + (1 - beta) x(t-1)``, split over the edges so that the same
+bookkeeping still applies. With ``beta = 1`` it is the original corrective algorithm, and with a
+well chosen ``beta`` (see ``weights.optimal_beta``) it needs far fewer rounds.
+
+- [1] <http://vision.jhu.edu/assets/consensus-cdc10.pdf>
+- [2] <http://www.vision.jhu.edu/assets/ChenACC11.pdf>
+'''
+import logging
+import numpy as np
+import adac.nettools as nettools
+from adac.communicator import SendError
+from adac.consensus import iterative
+from adac.data_collector.util_logger import psLogger
+
+plogger = psLogger('.'.join([__name__, 'psutil']))
+logger = logging.getLogger(__name__)
+
+
+def run(orig_data, tc, tag_id, neighbors, communicator, codec=nettools.CODEC, beta=1.0,
+        period=10):
+    '''Run (accelerated) corrective consensus v.s. a list of nodes in order to converge upon the
+    network average.
+
+    Unlike ``iterative.run`` a neighbor whose data does not arrive in time is skipped for that
+    round instead of ending the run. The correction rounds make up for it. A neighbor which the
+    communicator fails to send to (a ``SendError``) is skipped for the rest of the run.
+
+    Args:
+            orig_data (matrix): The data which we want to find a consensus with (numpy matrix)
+            tc (int): Number of consensus iterations, not counting correction rounds
+            tag_id (num): A numbered id for this consensus run. Used when sending tag info
+            neighbors (dict): Maps each neighbor to its weight
+            communicator (Communicator): The communicator object to send and receive messages
+            codec (obj): Encodes the data for the wire, see ``nettools.ArrayCodec``
+            beta (float): Acceleration parameter. ``1`` is plain Corrective Consensus. Every
+                         node must use the same value.
+            period (int): Number of iterations between correction rounds
+
+    Returns:
+            matrix: A numpy matrix with the agreed-upon consensus values.
+    '''
+    if period < 1:
+        raise ValueError('period must be at least 1')
+    logger.debug("tc: {}, tag_id: {}, beta: {}, period: {}".format(tc, tag_id, beta, period))
+    state = CorrectiveState(orig_data, neighbors, beta)
+    gone = set()
+    plogger.log_cpu_time("0")
+    plogger.log_mem("0")
+    plogger.log_network("0")
+
+    for i in range(tc):
+        plogger.log_cpu_time('{}'.format(i+1))
+        plogger.log_mem('{}'.format(i+1))
+        plogger.log_network('{}'.format(i+1))
+        logger.info('%s | Data: %s', i+1, state.x)
+
+        tag = iterative.build_tag(tag_id, i)
+        transmit(nettools.matrix_to_bytes(state.x, codec), tag,
+                 [j for j in state.neighbors if j not in gone], communicator, gone)
+        live = [j for j in state.neighbors if j not in gone]
+        data = iterative.gather(tag, live, communicator)
+        for j in state.neighbors:
+            if data.get(j) is None:
+                if j not in gone:
+                    logger.warning('Iteration {}: no data from {}'.format(i, j))
+                state.drop(j)
+            else:
+                state.load(j, nettools.matrix_from_bytes(data[j], codec))
+        state.step()
+
+        if (i + 1) % period == 0:
+            correct(state, tag_id, i, communicator, codec, gone)
+
+    return state.x
+
+
+def correct(state, tag_id, num, communicator, codec=nettools.CODEC, gone=None):
+    '''Run a correction round. Each node sends ``phi_ij`` to neighbor ``j`` and both sides
+    remove half of ``phi_ij + phi_ji`` from their value.
+
+    A neighbor whose totals do not arrive is left alone, the next correction round picks up
+    the mismatch again.
+
+    Args:
+            state (CorrectiveState): The node's state
+            tag_id (int): The id of the consensus run
+            num (int): The iteration after which the correction happens
+            communicator (Communicator): The object used in sending and receiving data
+            codec (obj): Encodes the data for the wire
+            gone (set): Neighbors which are skipped. Those the communicator fails to send to
+                         are added.
+    '''
+    if gone is None:
+        gone = set()
+    tag = iterative.build_tag(tag_id, num, control=True)
+    for j in state.neighbors:
+        if j not in gone:
+            phi = nettools.matrix_to_bytes(state.phi[state.index[j]], codec)
+            transmit(phi, tag, [j], communicator, gone)
+    live = [j for j in state.neighbors if j not in gone]
+    data = iterative.gather(tag, live, communicator)
+    for j in live:
+        if data[j] is None:
+            logger.warning('Correction {}: no data from {}'.format(num, j))
+        else:
+            state.correct(j, nettools.matrix_from_bytes(data[j], codec))
+    state.reset()
+
+
+def transmit(data, tag, neighbors, communicator, gone):
+    '''``iterative.transmit`` which adds the neighbors it fails to send to to ``gone``'''
+    try:
+        iterative.transmit(data, tag, neighbors, communicator)
+    except SendError as err:
+        for j in err.failed:
+            logger.warning('Sending to neighbor {} failed, skipping it from now on'.format(j))
+            gone.add(j)
+
+
+class CorrectiveState(object):
+    '''Per-edge bookkeeping for (accelerated) corrective consensus.
+
+    Each round the node moves ``e_ij = beta w_ij (x_j - x_i) + (beta - 1) e_ij`` towards
+    neighbor ``j`` and adds it to ``phi_ij``, so ``x_i = x_i(0) + sum_j phi_ij`` at all times.
+    Summing the first term over the edges gives ``beta (W x - x)_i`` and the second one the
+    previous step times ``beta - 1``, which is the accelerated iteration.
+
+    Args:
+            orig_data (matrix): The node's starting value. It is copied, never modified.
+            neighbors (dict): Maps each neighbor to its weight
+            beta (float): Acceleration parameter
+    '''
+
+    def __init__(self, orig_data, neighbors, beta=1.0):
+        orig_data = np.asarray(orig_data)
+        dtype = np.result_type(orig_data.dtype, np.float64)
+        self.neighbors = list(neighbors)
+        self.index = {n: k for k, n in enumerate(self.neighbors)}
+        self.beta = beta
+        self.x = np.array(orig_data, dtype=dtype, order='C')
+        shape = (len(self.neighbors),) + self.x.shape
+        bcast = (len(self.neighbors),) + (1,) * self.x.ndim
+        self.weights = np.array([neighbors[n] for n in self.neighbors],
+                                dtype=dtype).reshape(bcast)
+        self.scale = self.weights * beta
+        self.received = np.zeros(bcast, dtype=bool)
+        self.stack = np.zeros(shape, dtype=dtype)
+        self.edge = np.zeros(shape, dtype=dtype)
+        self.phi = np.zeros(shape, dtype=dtype)
+        self.total = np.zeros_like(self.x)
+
+    def load(self, neighbor, data):
+        '''Copy a neighbor's value into its slot of the stacked receive buffer'''
+        k = self.index[neighbor]
+        np.copyto(self.stack[k], data)
+        self.received[k] = True
+
+    def drop(self, neighbor):
+        '''Mark a neighbor's value for this round as lost'''
+        self.received[self.index[neighbor]] = False
+
+    def step(self):
+        '''Apply one round of updates from the loaded neighbor values in place.
+
+        Returns:
+                matrix: ``self.x``
+        '''
+        if len(self.neighbors) == 0:
+            return self.x
+        # e = beta w (x_j - x) + (beta - 1) e, with lost edges keeping only the momentum
+        self.edge *= self.beta - 1
+        np.subtract(self.stack, self.x, out=self.stack)
+        self.stack *= self.scale
+        np.add(self.edge, self.stack, out=self.edge, where=self.received)
+        self.phi += self.edge
+        np.sum(self.edge, axis=0, out=self.total)
+        self.x += self.total
+        self.received[:] = False
+        return self.x
+
+    def correct(self, neighbor, phi_ji):
+        '''Remove half the mismatch between what this node and ``neighbor`` moved over their
+        edge.
+
+        Args:
+                neighbor: The neighbor
+                phi_ji (matrix): The neighbor's total for the edge
+        '''
+        phi = self.phi[self.index[neighbor]]
+        half = (phi + phi_ji) / 2
+        phi -= half
+        self.x -= half
+
+    def reset(self):
+        '''Restart the momentum after a correction round'''
+        self.edge[:] = 0
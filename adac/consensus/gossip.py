@@ -0,0 +1,292 @@
+'''Asynchronous randomized gossip with push-sum[1].
+
+There are no rounds. Every node wakes up on its own Poisson clock, keeps part of its mass and
+pushes the rest to one random neighbor (or, in broadcast mode, splits it between all of them).
+Each node holds a sum ``s`` and a weight ``w``, starting at ``x(0)`` and ``1``, and its estimate
+is ``s / w``. Pushes move mass around without creating or destroying it, so ``sum s / sum w``
+stays the network average and every estimate converges to it, no matter how fast each node
+ticks. A slow node just pushes less often, nobody waits on it.
+
+Messages carry the running totals ``sigma_ij`` of everything node ``i`` ever pushed to ``j``
+instead of the increments, and the receiver adds the difference to the last totals it saw[2].
+A lost message is then made up by the next one, so this also works over a lossy
+``UDPCommunicator``. A newer message overwriting an older one in the data store is fine too.
+Only the last message to each neighbor has nothing coming after it, so a node which is done
+repeats its final totals until they are acknowledged.
+
+- [1] Kempe, Dobra, Gehrke. Gossip-Based Computation of Aggregate Information. FOCS 2003.
+- [2] Hadjicostis, Vaidya, Dominguez-Garcia. Robust Distributed Average Consensus via
+  Exchange of Running Sums. IEEE TAC 2016.
+'''
+import logging
+import struct
+import threading
+import time
+import numpy as np
+import adac.nettools as nettools
+from adac.consensus import iterative
+from adac.data_collector.util_logger import psLogger
+
+plogger = psLogger('.'.join([__name__, 'psutil']))
+logger = logging.getLogger(__name__)
+HEADER = struct.Struct('!I?d')  # Sequence number, final flag, running total of the weight
+ACK = struct.Struct('!I')  # Sequence number of the acknowledged final totals
+SEQ_MOD = 2**32
+
+
+def run(orig_data, tc, tag_id, neighbors, communicator, codec=nettools.CODEC, interval=0.05,
+        broadcast=False, linger=1.0, seed=None, timeout=iterative.TIMEOUT):
+    '''Run push-sum gossip v.s. a list of nodes in order to converge upon the network average.
+
+    Messages are taken in by the communicator's receive callback whenever they arrive. Each
+    message to a neighbor is tagged with its own sequence number, so the duplicate filter of a
+    reliable ``UDPCommunicator`` never takes a new push for a repeat of an earlier one.
+
+    After ``tc`` ticks a node stops pushing and flushes: every ``linger`` seconds it sends the
+    neighbors which did not acknowledge them yet its final totals. It leaves once every neighbor
+    acknowledged them and sent its own final totals, so mass whose last message was lost is not
+    stranded. Afterwards it keeps acknowledging repeats until none came for ``linger`` seconds,
+    in case its own acknowledgements were lost.
+
+    Args:
+            orig_data (matrix): The data which we want to find a consensus with (numpy matrix)
+            tc (int): Number of pushes this node makes
+            tag_id (num): A numbered id for this consensus run. Used when sending tag info
+            neighbors (dict): The neighbors of this node. Their weights are not used.
+            communicator (Communicator): The communicator object to send and receive messages
+            codec (obj): Encodes the data for the wire, see ``nettools.ArrayCodec``
+            interval (float): Mean number of seconds between two pushes
+            broadcast (bool): Push to every neighbor at once instead of one random neighbor
+            linger (float): Seconds between repeats of the final totals, and of silence after
+                         which a node which is done leaves
+            seed (int): Seed of the random clock and neighbor choice
+            timeout (float): Seconds after which a node gives up on neighbors which did not
+                         finish the flush
+
+    Returns:
+            matrix: A numpy matrix with this node's estimate of the average.
+    '''
+    logger.debug("tc: {}, tag_id: {}, interval: {}, broadcast: {}".format(
+        tc, tag_id, interval, broadcast))
+    state = GossipState(orig_data, neighbors)
+    rng = np.random.RandomState(seed)
+    # Acknowledgements of final totals go out as control messages
+    push_id = iterative.build_tag(tag_id, 0)[0]
+    ack_id = iterative.build_tag(tag_id, 0, control=True)[0]
+    plogger.log_cpu_time("0")
+    plogger.log_mem("0")
+    plogger.log_network("0")
+    if len(state.neighbors) == 0:
+        return state.estimate()
+
+    ready = threading.Condition()
+    replies = []  # (neighbor, seq) of final totals to acknowledge
+    acked = set()
+
+    def receive(sender, tg_int, data):
+        k = state.index.get(sender)
+        if k is None or tg_int & 0xFF not in (push_id, ack_id):
+            return
+        # Only clears the data store, the data is already here
+        communicator.get(sender, tg_int.to_bytes(4, byteorder='little'))
+        with ready:
+            try:
+                if tg_int & 0xFF == ack_id:
+                    ACK.unpack_from(data)
+                    acked.add(sender)
+                elif absorb(state, sender, data, codec) and state.done[k]:
+                    replies.append((sender, int(state.recv_seq[k])))
+            except (ValueError, struct.error) as err:
+                logger.warning('Ignoring malformed gossip message from %s: %s', sender, err)
+                return
+            ready.notify_all()
+
+    def flushed():
+        return ticks >= tc and len(acked) == len(state.neighbors) and state.done.all()
+
+    def answer():
+        with ready:
+            pending = list(replies)
+            del replies[:]
+        for j, seq in pending:
+            tag = iterative.build_tag(tag_id, seq, control=True)
+            iterative.transmit(ACK.pack(seq), tag, [j], communicator)
+        return len(pending)
+
+    def send(targets, final=False):
+        for j in targets:
+            tag = iterative.build_tag(tag_id, int(state.seq[state.index[j]]))
+            iterative.transmit(pack(state, j, codec, final), tag, [j], communicator)
+
+    ticks = 0
+    previous = communicator.recv_callback
+    communicator.register_recv_callback(receive)
+    try:
+        # Picks up messages which landed before the callback was registered
+        for j in state.neighbors:
+            num = 1
+            while True:
+                tag = iterative.build_tag(tag_id, num)
+                payload = communicator.get(j, tag)
+                if payload is None:
+                    break
+                receive(j, int.from_bytes(tag, byteorder='little'), payload)
+                num += 1
+
+        now = time.monotonic()
+        deadline = now + rng.exponential(interval) if tc > 0 else now
+        give_up = None
+        while True:
+            with ready:
+                ready.wait_for(lambda: len(replies) > 0 or flushed(),
+                               max(0, deadline - time.monotonic()))
+            answer()
+            with ready:
+                if flushed():
+                    break
+            now = time.monotonic()
+            if now < deadline:
+                continue
+            if ticks < tc:
+                ticks += 1
+                plogger.log_cpu_time('{}'.format(ticks))
+                plogger.log_mem('{}'.format(ticks))
+                plogger.log_network('{}'.format(ticks))
+                if broadcast:
+                    targets = state.neighbors
+                else:
+                    targets = [state.neighbors[rng.randint(len(state.neighbors))]]
+                with ready:
+                    state.push(targets)
+                send(targets)
+                deadline = deadline + rng.exponential(interval) if ticks < tc else now
+                continue
+            if give_up is None:
+                give_up = now + timeout
+            elif now >= give_up:
+                logger.warning('Gossip gave up on neighbors which did not finish: %s',
+                               [j for j in state.neighbors if j not in acked or
+                                not state.done[state.index[j]]])
+                break
+            missing = [j for j in state.neighbors if j not in acked]
+            state.skip(missing)
+            send(missing, final=True)
+            deadline = now + linger
+
+        end = time.monotonic() + linger
+        while True:
+            with ready:
+                ready.wait_for(lambda: len(replies) > 0, max(0, end - time.monotonic()))
+            if answer() == 0:
+                break
+            end = time.monotonic() + linger
+    finally:
+        communicator.recv_callback = previous
+    logger.info('Gossip finished after {} pushes, weight {}'.format(tc, state.w))
+    return state.estimate()
+
+
+def pack(state, neighbor, codec=nettools.CODEC, final=False):
+    '''Build the message carrying the running totals of everything pushed to ``neighbor``.
+
+    Args:
+            final (bool): Mark the totals as the last ones this node sends, see ``run``
+
+    Returns:
+            bytes: The message
+    '''
+    k = state.index[neighbor]
+    header = HEADER.pack(state.seq[k], final, state.sent_w[k])
+    return header + nettools.matrix_to_bytes(state.sent_s[k], codec)
+
+
+def absorb(state, neighbor, payload, codec=nettools.CODEC):
+    '''Take in a message made by ``pack``.
+
+    Returns:
+            bool: ``False`` if the message was older than one already taken in
+
+    Raises:
+            ValueError: if the message is malformed
+    '''
+    view = memoryview(payload)
+    if len(view) < HEADER.size:
+        raise ValueError('Message is missing the gossip header')
+    seq, final, total_w = HEADER.unpack_from(view)
+    total_s = nettools.matrix_from_bytes(view[HEADER.size:], codec)
+    return state.absorb(neighbor, seq, total_w, total_s, final)
+
+
+class GossipState(object):
+    '''The push-sum state of a single node.
+
+    Args:
+            orig_data (matrix): The node's starting value. It is copied, never modified.
+            neighbors (iterable): The neighbors of this node
+    '''
+
+    def __init__(self, orig_data, neighbors):
+        orig_data = np.asarray(orig_data)
+        dtype = np.result_type(orig_data.dtype, np.float64)
+        self.neighbors = list(neighbors)
+        self.index = {n: k for k, n in enumerate(self.neighbors)}
+        self.s = np.array(orig_data, dtype=dtype, order='C')
+        self.w = 1.0
+        shape = (len(self.neighbors),) + self.s.shape
+        # Running totals pushed to / last received from each neighbor
+        self.sent_s = np.zeros(shape, dtype=dtype)
+        self.sent_w = np.zeros(len(self.neighbors))
+        self.seq = np.zeros(len(self.neighbors), dtype=np.int64)
+        self.recv_s = np.zeros(shape, dtype=dtype)
+        self.recv_w = np.zeros(len(self.neighbors))
+        self.recv_seq = np.zeros(len(self.neighbors), dtype=np.int64)
+        # Whether each neighbor sent its final totals
+        self.done = np.zeros(len(self.neighbors), dtype=bool)
+
+    def push(self, targets):
+        '''Keep an equal share of the mass and add one share to the totals of each target'''
+        self.s /= len(targets) + 1
+        self.w /= len(targets) + 1
+        for j in targets:
+            k = self.index[j]
+            self.sent_s[k] += self.s
+            self.sent_w[k] += self.w
+            self.seq[k] = (self.seq[k] + 1) % SEQ_MOD
+
+    def skip(self, targets):
+        '''Move on to the next sequence number of each target without pushing anything, so
+        the same totals can be sent again under a new tag'''
+        for j in targets:
+            k = self.index[j]
+            self.seq[k] = (self.seq[k] + 1) % SEQ_MOD
+
+    def absorb(self, neighbor, seq, total_w, total_s, final=False):
+        '''Add what a neighbor pushed since its last message that arrived.
+
+        Messages older than one already taken in are ignored.
+
+        Args:
+                neighbor: The neighbor the message came from
+                seq (int): The message's sequence number
+                total_w (float): The neighbor's running total of the weight pushed here
+                total_s (matrix): The neighbor's running total of the sum pushed here
+                final (bool): Whether the neighbor will not push anything more
+
+        Returns:
+                bool: ``False`` if the message was ignored
+        '''
+        k = self.index[neighbor]
+        if (seq - self.recv_seq[k]) % SEQ_MOD >= SEQ_MOD // 2 or seq == self.recv_seq[k]:
+            return False
+        self.s += total_s
+        self.s -= self.recv_s[k]
+        self.w += total_w - self.recv_w[k]
+        np.copyto(self.recv_s[k], total_s)
+        self.recv_w[k] = total_w
+        self.recv_seq[k] = seq
+        self.done[k] |= final
+        return True
+
+    def estimate(self):
+        '''The node's current estimate of the average, ``s / w``'''
+        return self.s / self.w
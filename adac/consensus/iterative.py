@@ -8,23 +8,36 @@
 
 
 '''
-import math
+import asyncio
 import logging
 import configparser
+import queue
+import struct
+import threading
 import time
-from collections import deque
 import requests
 import adac.nettools as nettools
 import numpy as np
 from numpy import linalg as LA
 import psutil
 from adac.data_collector.util_logger import psLogger
+from adac.communicator import SendError
 from mpi4py import MPI as OMPI
 
 # Consensus Functions
 plogger = psLogger('.'.join([__name__, 'psutil']))
 logger = logging.getLogger(__name__)
 MPI = False
+TIMEOUT = 15  # Seconds to wait on neighbors each iteration
+STATUS = struct.Struct('!BI')  # Convergence header: flags, quiet rounds
+STOP = 0x01
+QUIET_MAX = 2**32 - 1
+WEIGHT = struct.Struct('!d')  # Ratio weight in front of the data, see run_bounded
+DEGREE = struct.Struct('!I')  # Sender's degree in front of the data, see run_resilient
+POLL = 0.1  # Seconds between failure detector checks while waiting on neighbors
+ITER_MOD = 2**24  # Iteration numbers in a tag wrap around here, see build_tag
+RUN_MOD = 128  # Run ids wrap around here, the top bit of their byte is CONTROL
+CONTROL = 0x80  # Set in the run id byte of control messages, see build_tag
 
 def get_weights(neighbors, config="params.conf", MPI_graph_comm=None):
     '''Calculate the Metropolis Hastings weights for the current node and its neighbors.
@@ -60,6 +73,7 @@ def get_weights(neighbors, config="params.conf", MPI_graph_comm=None):
                     weights[neigh] = 0
                     raise RuntimeError("One of the nodes could not be contacted")
             except:
+                logger.warning('Could not get the degree of %s, its weight is 0', neigh)
                 weights[neigh] = 0
         else:
             degs[neigh] = len(MPI_graph_comm.Get_neighbors(neigh))
@@ -68,9 +82,20 @@ def get_weights(neighbors, config="params.conf", MPI_graph_comm=None):
     return weights
 
 
-def run(orig_data, tc, tag_id, neighbors, communicator):
+def run(orig_data, tc, tag_id, neighbors, communicator, codec=nettools.CODEC, eps=None,
+        patience=3, diameter=None):
     '''Run consensus v.s. a list of nodes in order to converge upon the network average.
 
+    With ``eps`` set the run may stop before ``tc`` iterations. Every node tracks how many
+    rounds in a row its local disagreement (the norm of ``sum_j w_j (x_j - x)``) stayed below
+    ``eps`` and piggybacks a small header on its messages (see ``pack_status``) carrying
+    ``quiet = min(own count, 1 + min of the neighbors' quiet values)``. A node ``d`` hops away
+    has then been below ``eps`` for at least ``quiet - d`` rounds, so once ``quiet`` reaches
+    ``patience + diameter`` every node in the network was below ``eps`` during the same
+    ``patience`` consecutive rounds, and the node stops. A stopping node sends one last message with the stop
+    flag set, so its neighbors stop one round later and the decision spreads through the network
+    without anyone waiting on a node that already left.
+
     Args:
             orig_data (matrix): The data which we want to find a consensus with (numpy matrix)
             tc (int): Number of consensus iterations
@@ -78,77 +103,741 @@ def run(orig_data, tc, tag_id, neighbors, communicator):
             neighbors (dict): an object outlining the neighbors of the current node and the weights
                          corresponding to each one.
             communicator (Communicator): The communicator object to send and receive messages.abs
+            codec (obj): Encodes the data for the wire, see ``nettools.ArrayCodec``. Every node
+                         must use the same codec.
+            eps (float): Disagreement tolerance. ``None`` always runs ``tc`` iterations. Every
+                         node must agree on whether this is set.
+            patience (int): Number of consecutive rounds every node must be below ``eps``
+            diameter (int): Upper bound on the diameter of the network graph. Required with
+                         ``eps``.
 
     Returns:
             matrix: A numpy matrix with the agreed-upon consensus values.
 
 
     '''
+    if eps is not None and diameter is None:
+        raise ValueError("diameter is required for early termination")
     plogger.log_cpu_time("0")
     plogger.log_mem("0")
     plogger.log_network("0")
     logger.debug("tc: {}, tag_id: {}, num neighbors: {}, ".format(tc, tag_id, len(neighbors)))
-    old_data = orig_data
-    new_data = orig_data
-
-    neigh_list = list(neighbors.keys())
-    logger.debug("Old data before: {}".format(old_data))
-    logger.debug("new data before: {}".format(new_data))
-    missing_data = {}
-    for n in neigh_list:
-        missing_data[n] = deque()
+    state = ConsensusState(orig_data, neighbors)
+    logger.debug("Data before: %s", state.x)
+    streak = 0  # rounds in a row below eps
+    quiet = QUIET_MAX  # min streak of everything we heard from
+    stopping = False
 
     for i in range(tc):
         plogger.log_cpu_time('{}'.format(i+1))
         plogger.log_mem('{}'.format(i+1))
         plogger.log_network('{}'.format(i+1))
-        logger.info('{} | Data: {}'.format(i+1, new_data))
-        old_data = new_data
+        logger.info('%s | Data: %s', i+1, state.x)
 
         # transfer data
         tag = build_tag(tag_id, i)
-        b_data = nettools.matrix_to_bytes(new_data)
-        transmit(b_data, tag, neighbors, communicator)
-        data = receive(tag, neighbors, communicator)
+        b_data = nettools.matrix_to_bytes(state.x, codec)
+        if eps is not None:
+            b_data = pack_status(stopping, quiet) + b_data
+        try:
+            transmit(b_data, tag, neighbors, communicator)
+        except SendError as err:
+            if not stopping:
+                raise
+            # Neighbors which sent the stop flag themselves may be gone already
+            logger.info('Could not send the stop flag to neighbors which left: %s',
+                        list(err.failed))
+        if stopping:
+            logger.info('Consensus converged after {} iterations'.format(i))
+            break
+        data = gather(tag, neighbors, communicator)
 
         # Consensus
-        tempsum = 0  # used for tracking 'mass' transmitted
+        neigh_quiet = QUIET_MAX
+        for j in neighbors:
+            if data[j] is None:
+                logger.error('Consensus timed out while waiting for missing data')
+                return None
+            payload = data[j]
+            if eps is not None:
+                stop_flag, j_quiet, payload = unpack_status(payload)
+                stopping = stopping or stop_flag
+                neigh_quiet = min(neigh_quiet, j_quiet + 1)
+            state.load(j, nettools.matrix_from_bytes(payload, codec))
+        state.step(track_change=eps is not None)
+
+        if eps is not None:
+            streak = streak + 1 if state.change < eps else 0
+            quiet = min(streak, neigh_quiet)
+            logger.debug('Disagreement {}, quiet rounds {}'.format(state.change, quiet))
+            if quiet >= patience + diameter:
+                stopping = True
+
+    return state.x
+
+
+async def run_async(orig_data, tc, tag_id, neighbors, communicator, codec=nettools.CODEC):
+    '''Coroutine version of ``run`` for an ``AsyncTCPCommunicator``.
+
+    Each round's broadcast runs concurrently with the wait for the neighbors' data, and the
+    event loop stays free for other work while the node waits. Early termination is not
+    supported here.
+
+    Args:
+            orig_data (matrix): The data which we want to find a consensus with (numpy matrix)
+            tc (int): Number of consensus iterations
+            tag_id (num): A numbered id for this consensus run. Used when sending tag info
+            neighbors (dict): Maps each neighbor to its weight
+            communicator (AsyncTCPCommunicator): The communicator to send and receive messages
+            codec (obj): Encodes the data for the wire, see ``nettools.ArrayCodec``
+
+    Returns:
+            matrix: A numpy matrix with the agreed-upon consensus values.
+    '''
+    plogger.log_cpu_time("0")
+    plogger.log_mem("0")
+    plogger.log_network("0")
+    logger.debug("tc: {}, tag_id: {}, num neighbors: {}, ".format(tc, tag_id, len(neighbors)))
+    state = ConsensusState(orig_data, neighbors)
+
+    for i in range(tc):
+        plogger.log_cpu_time('{}'.format(i+1))
+        plogger.log_mem('{}'.format(i+1))
+        plogger.log_network('{}'.format(i+1))
+        logger.info('%s | Data: %s', i+1, state.x)
+
+        tag = build_tag(tag_id, i)
+        sending = asyncio.ensure_future(communicator.broadcast(
+            neighbors, nettools.matrix_to_bytes(state.x, codec), tag))
+        try:
+            data = await communicator.gather_round(neighbors, tag, timeout=TIMEOUT)
+        finally:
+            await sending
+
+        for j in neighbors:
+            if data[j] is None:
+                logger.error('Consensus timed out while waiting for missing data')
+                return None
+            state.load(j, nettools.matrix_from_bytes(data[j], codec))
+        state.step()
+
+    return state.x
+
+
+def run_bounded(orig_data, tc, tag_id, neighbors, communicator, codec=nettools.CODEC,
+                staleness=1):
+    '''Version of ``run`` which keeps going while neighbors are up to ``staleness`` rounds late.
+
+    This is ratio consensus: every round a node keeps ``1 - sum_j w_j`` of its value and sends
+    the share ``w_j`` to each neighbor, and it adds whatever shares arrived since the last
+    round. A value which is late is simply added in the round it shows up, so nothing is lost
+    and the sum over all nodes and all messages on their way stays the same. A weight ``y``,
+    starting at ``1``, goes through the same steps next to the data, and ``x / y`` converges
+    to the average even while values are late. A round only waits on a neighbor whose newest
+    value is more than ``staleness`` rounds old. After the last round the node waits for the
+    rest of its neighbors' values, so no mass is left on the way. ``staleness=0`` gives the
+    same result as ``run``.
+
+    The communicator has to keep more than ``staleness + 1`` iterations of data per neighbor,
+    see ``DataStore``. Early termination and MPI are not supported here.
+
+    Args:
+            orig_data (matrix): The data which we want to find a consensus with (numpy matrix)
+            tc (int): Number of consensus iterations
+            tag_id (num): A numbered id for this consensus run. Used when sending tag info
+            neighbors (dict): Maps each neighbor to its weight. The weights must be symmetric,
+                         like the Metropolis-Hastings weights of ``get_weights``.
+            communicator (Communicator): The communicator object to send and receive messages
+            codec (obj): Encodes the data for the wire, see ``nettools.ArrayCodec``
+            staleness (int): How many rounds old a neighbor's newest value may be
+
+    Returns:
+            matrix: A numpy matrix with the agreed-upon consensus values.
+    '''
+    if staleness < 0:
+        raise ValueError('staleness must not be negative')
+    plogger.log_cpu_time("0")
+    plogger.log_mem("0")
+    plogger.log_network("0")
+    logger.debug("tc: {}, tag_id: {}, num neighbors: {}, staleness: {}".format(
+        tc, tag_id, len(neighbors), staleness))
+    state = ConsensusState(orig_data, neighbors)
+    ratio = [1.0, 0.0]  # The weight y and the part of it which arrived this round
+    newest = {j: -1 for j in neighbors}  # Newest round received from each neighbor
+
+    def catch_up(j, num, need):
+        # Adds the values of j up to round num which arrived, waits while j is behind need
+        while newest[j] < num:
+            wait = TIMEOUT if newest[j] < need else 0
+            payload = communicator.get(j, build_tag(tag_id, newest[j] + 1), timeout=wait)
+            if payload is None:
+                return newest[j] >= need
+            newest[j] += 1
+            view = memoryview(payload)
+            if len(view) < WEIGHT.size:
+                raise ValueError('Message is missing the ratio weight')
+            ratio[1] += neighbors[j] * WEIGHT.unpack_from(view)[0]
+            state.fold(j, nettools.matrix_from_bytes(view[WEIGHT.size:], codec))
+        return True
+
+    for i in range(tc):
+        plogger.log_cpu_time('{}'.format(i+1))
+        plogger.log_mem('{}'.format(i+1))
+        plogger.log_network('{}'.format(i+1))
+        logger.info('%s | Data: %s', i+1, state.x / ratio[0])
+
+        b_data = WEIGHT.pack(ratio[0]) + nettools.matrix_to_bytes(state.x, codec)
+        transmit(b_data, build_tag(tag_id, i), neighbors, communicator)
+        state.reset()
+        ratio[1] = 0.0
         for j in neighbors:
+            if not catch_up(j, i, i - staleness):
+                logger.error('Consensus timed out while waiting for missing data')
+                return None
+        state.apply()
+        ratio[0] = state.self_weight * ratio[0] + ratio[1]
+
+    state.reset()
+    ratio[1] = 0.0
+    for j in neighbors:
+        if not catch_up(j, tc - 1, tc - 1):
+            logger.error('Consensus timed out while waiting for missing data')
+            return None
+    state.x += state.acc
+    ratio[0] += ratio[1]
+    state.x /= ratio[0]
+    return state.x
+
+
+def run_resilient(orig_data, tc, tag_id, neighbors, communicator, codec=nettools.CODEC):
+    '''Version of ``run`` which carries on without neighbors that failed.
+
+    Every message carries the sender's current degree, and each round both ends of an edge
+    compute its Metropolis-Hastings weight ``1 / (max(d_i, d_j) + 1)`` from the degrees in
+    that round's messages. No degree lookups are needed and the weights stay symmetric. A
+    neighbor which the communicator's failure detector suspects (see
+    ``BaseCommunicator.start_heartbeat``), which sent nothing for ``TIMEOUT`` seconds, or
+    which the communicator failed to send to (a ``SendError``), is dropped. From the next round
+    on this node sends to it no more and reports the smaller degree, so the surviving neighbors
+    reweight their edges too. The current round keeps the degree its messages already carry.
+
+    A neighbor which is dropped because its message did not arrive may still have used ours.
+    It is sent a notice with degree 0 in the next round, on which it takes the edge's share
+    back out of its value and drops this node as well, so both ends leave the edge in the same
+    round. The run converges to the average of the values the survivors held when the failures
+    happened, unless the message is lost in the last round. Early termination and MPI are not
+    supported here.
+
+    Args:
+            orig_data (matrix): The data which we want to find a consensus with (numpy matrix)
+            tc (int): Number of consensus iterations
+            tag_id (num): A numbered id for this consensus run. Used when sending tag info
+            neighbors (iterable): The neighbors of this node. Weights given with them are not
+                         used.
+            communicator (Communicator): The communicator object to send and receive messages
+            codec (obj): Encodes the data for the wire, see ``nettools.ArrayCodec``
+
+    Returns:
+            matrix: A numpy matrix with the agreed-upon consensus values.
+    '''
+    plogger.log_cpu_time("0")
+    plogger.log_mem("0")
+    plogger.log_network("0")
+    logger.debug("tc: {}, tag_id: {}, num neighbors: {}, ".format(tc, tag_id, len(neighbors)))
+    alive = list(neighbors)
+    state = ConsensusState(orig_data, {j: 0 for j in alive})
+    prev = np.empty_like(state.x)  # Value before the last step, to take an edge back out
+    lost = []  # Neighbors dropped for a missing message, told so in the next round
+
+    for i in range(tc):
+        plogger.log_cpu_time('{}'.format(i+1))
+        plogger.log_mem('{}'.format(i+1))
+        plogger.log_network('{}'.format(i+1))
+        logger.info('%s | Data: %s', i+1, state.x)
+
+        tag = build_tag(tag_id, i)
+        if len(lost) > 0:
+            try:
+                transmit(DEGREE.pack(0), tag, lost, communicator)
+            except SendError:
+                pass  # Neighbors which cannot be reached did not use our value either
+            lost = []
+        degree = len(alive)
+        try:
+            transmit(DEGREE.pack(degree) + nettools.matrix_to_bytes(state.x, codec), tag, alive,
+                     communicator)
+        except SendError as err:
+            for j in err.failed:
+                logger.warning('Iteration {}: sending to neighbor {} failed, dropping it'.format(
+                    i, j))
+                alive.remove(j)
+        data = collect(tag, alive, communicator)
+        weights = {}
+        undo = None  # Share of the edges to neighbors which dropped this node
+        for j in list(alive):
+            if data[j] is None:
+                logger.warning('Iteration {}: neighbor {} failed, dropping it'.format(i, j))
+                alive.remove(j)
+                lost.append(j)
+                continue
+            view = memoryview(data[j])
+            if len(view) < DEGREE.size:
+                raise ValueError('Message is missing the degree header')
+            d_j = DEGREE.unpack_from(view)[0]
+            if d_j == 0:
+                logger.warning('Iteration {}: neighbor {} dropped this node, taking back the '
+                               'last round of their edge'.format(i, j))
+                k = state.index[j]
+                share = state.weights[k] * (state.stack[k] - prev)
+                undo = share if undo is None else undo + share
+                alive.remove(j)
+                continue
+            weights[j] = 1 / (max(degree, d_j) + 1)
+            state.load(j, nettools.matrix_from_bytes(view[DEGREE.size:], codec))
+        state.reweight(weights)
+        np.copyto(prev, state.x)
+        state.step()
+        if undo is not None:
+            # Only after the step, the neighbors used the value this node sent them
+            state.x -= undo
+
+    return state.x
+
+
+def run_pipelined(orig_data, tc, tag_id, neighbors, communicator, codec=nettools.CODEC):
+    '''Version of ``run`` which overlaps communication with computation.
+
+    A ``Sender`` thread pushes each round's value out while the main loop folds the
+    neighbors' values into the update one at a time, in the order they arrive, instead of
+    waiting for all of them first. As soon as a round's update is done the next round is
+    posted, so a round takes about as long as the slower of the network and the compute
+    rather than both added up. The result is the same as ``run`` up to rounding. Early
+    termination and MPI are not supported here.
+
+    Args:
+            orig_data (matrix): The data which we want to find a consensus with (numpy matrix)
+            tc (int): Number of consensus iterations
+            tag_id (num): A numbered id for this consensus run. Used when sending tag info
+            neighbors (dict): Maps each neighbor to its weight
+            communicator (Communicator): The communicator object to send and receive messages
+            codec (obj): Encodes the data for the wire, see ``nettools.ArrayCodec``
 
-            # Process any data which has arrived
-            if data[j] != None:  # if data was received, then...
-                t = nettools.matrix_from_bytes(data[j])
-                diff = t - old_data
-                logger.debug("diff from neighbor {} is {} ".format(j, diff))
-                tempsum += neighbors[j] * diff  # 'mass' added to itself
-            elif data[j] == None: # add to the missing queue
-                missing_data[j].append(tag)
-                logger.debug('Adding {} to missing packets of neighbor {}'.format(tag, j))
-
-            # Attempt to get any missing data (Basically synchronization)
-            # If I had to guess this is where performance issues stem from
-            start = time.time()
-            while len(missing_data[j]) > 0:
-                if time.time() - start > 15:
+    Returns:
+            matrix: A numpy matrix with the agreed-upon consensus values.
+    '''
+    plogger.log_cpu_time("0")
+    plogger.log_mem("0")
+    plogger.log_network("0")
+    logger.debug("tc: {}, tag_id: {}, num neighbors: {}, ".format(tc, tag_id, len(neighbors)))
+    state = ConsensusState(orig_data, neighbors)
+    sender = Sender(neighbors, communicator)
+    try:
+        for i in range(tc):
+            plogger.log_cpu_time('{}'.format(i+1))
+            plogger.log_mem('{}'.format(i+1))
+            plogger.log_network('{}'.format(i+1))
+            logger.info('%s | Data: %s', i+1, state.x)
+
+            tag = build_tag(tag_id, i)
+            sender.post(nettools.matrix_to_bytes(state.x, codec), tag)
+            state.reset()
+            missing = list(neighbors)
+            while len(missing) > 0:
+                # Every arrival restarts the timeout, like gather
+                j, payload = communicator.wait_any(missing, tag, timeout=TIMEOUT)
+                if j is None:
                     logger.error('Consensus timed out while waiting for missing data')
                     return None
-                tag1 = missing_data[j].popleft()
-                # logger.debug('missing data tag: %s', tag1)
-                d1 = communicator.get(j, tag1)
-                if d1 != None:
-                    logger.debug("Picked up old data on tag {}".format(tag1))
-                    t = nettools.matrix_from_bytes(d1)
-                    diff = t - old_data
-                    logger.debug("diff from neighbor {} is {} ".format(j, diff))
-                    tempsum += neighbors[j] * diff # weight * diff
-                else:
-                    missing_data[j].append(tag1)
+                state.fold(j, nettools.matrix_from_bytes(payload, codec))
+                missing.remove(j)
+            state.apply()
+    finally:
+        sender.close()
+    return state.x
+
+
+class Sender(object):
+    '''Transmits messages from a background thread, in the order they are posted.
+
+    Args:
+            neighbors (iterable): The neighbors every message goes to
+            communicator (Communicator): The object used in sending data
+            depth (int): Messages which may wait to go out before ``post`` blocks
+    '''
+
+    def __init__(self, neighbors, communicator, depth=2):
+        self.neighbors = list(neighbors)
+        self.communicator = communicator
+        self.queue = queue.Queue(depth)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def post(self, data, tag):
+        '''Queue a message for every neighbor.
+
+        Raises:
+                RuntimeError: if an earlier message failed to send
+        '''
+        if self.error is not None:
+            raise RuntimeError('Sending to the neighbors failed') from self.error
+        self.queue.put((data, tag))
+
+    def close(self):
+        '''Wait until every posted message went out and stop the thread'''
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                transmit(item[0], item[1], self.neighbors, self.communicator)
+            except Exception as err:  # pylint: disable=broad-except
+                logger.exception('Failed to send to the neighbors')
+                self.error = err
+
+
+def run_incremental(orig_data, tc, tag_id, neighbors, communicator, codec=nettools.CODEC):
+    '''Version of ``run`` which adds up the neighbors' values as their messages arrive.
+
+    An ``Accumulator`` is registered as the communicator's receive callback for the length of
+    the run. It decodes each neighbor's message on the receiving thread and adds it into the sum
+    of its round right away, so the decode work is spread over the wait and closing a round only
+    takes an add. The communicator's previous callback is put back afterwards. Early
+    termination and MPI are not supported here.
+
+    Args:
+            orig_data (matrix): The data which we want to find a consensus with (numpy matrix)
+            tc (int): Number of consensus iterations
+            tag_id (num): A numbered id for this consensus run. Used when sending tag info
+            neighbors (dict): Maps each neighbor to its weight
+            communicator (Communicator): The communicator object to send and receive messages
+            codec (obj): Encodes the data for the wire, see ``nettools.ArrayCodec``
+
+    Returns:
+            matrix: A numpy matrix with the agreed-upon consensus values.
+    '''
+    plogger.log_cpu_time("0")
+    plogger.log_mem("0")
+    plogger.log_network("0")
+    logger.debug("tc: {}, tag_id: {}, num neighbors: {}, ".format(tc, tag_id, len(neighbors)))
+    acc = Accumulator(orig_data, tag_id, neighbors, codec)
+    previous = communicator.recv_callback
+    communicator.register_recv_callback(acc.receive)
+    try:
+        for i in range(tc):
+            plogger.log_cpu_time('{}'.format(i+1))
+            plogger.log_mem('{}'.format(i+1))
+            plogger.log_network('{}'.format(i+1))
+            logger.info('%s | Data: %s', i+1, acc.x)
+
+            tag = build_tag(tag_id, i)
+            # Picks up messages which landed before the callback was registered
+            acc.drain(communicator, tag)
+            transmit(nettools.matrix_to_bytes(acc.x, codec), tag, neighbors, communicator)
+            if not acc.wait(timeout=TIMEOUT):
+                logger.error('Consensus timed out while waiting for missing data')
+                return None
+            acc.close()
+            # The callback already used them, so this only clears the data store
+            acc.drain(communicator, tag)
+    finally:
+        communicator.recv_callback = previous
+    return acc.x
+
+
+class Accumulator(object):
+    '''Adds up the neighbors' values of a node while their messages arrive.
+
+    ``receive`` is meant to be registered as the communicator's receive callback and may be
+    called from any thread. As in ``ConsensusState`` the update ``x += sum_j w_j (x_j - x)`` is
+    computed as ``x = (1 - sum_j w_j) x + sum_j w_j x_j``. A neighbor may send the next round
+    before this node finished the current one, and this way its value can be added in before the
+    next ``x`` is known. Rounds in flight each get a sum buffer, and the buffers are reused.
+
+    Args:
+            orig_data (matrix): The node's starting value. It is copied, never modified.
+            tag_id (num): The id of the consensus run, see ``build_tag``
+            neighbors (dict): Maps each neighbor to its weight
+            codec (obj): Decodes the messages, see ``nettools.ArrayCodec``
+    '''
 
-            logger.debug("Tempsum iter {} is {}".format(i, tempsum))
+    def __init__(self, orig_data, tag_id, neighbors, codec=nettools.CODEC):
+        self.state = ConsensusState(orig_data, neighbors)
+        self.run = tag_id % RUN_MOD
+        self.codec = codec
+        self.current = 0
+        self.rounds = {}  # iteration -> (sum buffer, neighbors added in)
+        self.spare = []
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+
+    @property
+    def x(self):
+        '''The node's current value'''
+        return self.state.x
+
+    def receive(self, sender, tag, data):
+        '''Add a neighbor's value into the sum of its round.
+
+        Messages from other runs, for closed rounds or more than one round ahead, and repeats
+        are ignored.
+
+        Args:
+                sender: The neighbor the message came from
+                tag (int): The message tag as an integer
+                data (bytes): The encoded value
+        '''
+        k = self.state.index.get(sender)
+        if k is None or tag & 0xFF != self.run:
+            return
+        num = (tag >> 8) % ITER_MOD
+        with self.ready:
+            if (num - self.current) % ITER_MOD > 1:
+                return
+            entry = self.rounds.get(num)
+            if entry is None:
+                buf = self.spare.pop() if len(self.spare) > 0 else np.zeros_like(self.state.x)
+                entry = self.rounds[num] = (buf, set())
+            if sender in entry[1]:
+                return
+            value = nettools.matrix_from_bytes(data, self.codec)
+            np.multiply(value, self.state.weights[k], out=self.state.stack[k])
+            np.add(entry[0], self.state.stack[k], out=entry[0])
+            entry[1].add(sender)
+            self.ready.notify_all()
+
+    def drain(self, communicator, tag):
+        '''Take the messages of a round out of the communicator's data store, adding in the ones
+        ``receive`` has not seen yet'''
+        tg_int = int.from_bytes(tag, byteorder='little')
+        for j in self.state.neighbors:
+            data = communicator.get(j, tag)
+            if data is not None:
+                self.receive(j, tg_int, data)
+
+    def wait(self, timeout=None):
+        '''Block until every neighbor's value of the current round was added in. Every arrival
+        restarts the timeout.
+
+        Returns:
+                bool: ``False`` on timeout
+        '''
+        def count():
+            entry = self.rounds.get(self.current)
+            return 0 if entry is None else len(entry[1])
+
+        with self.ready:
+            while True:
+                have = count()
+                if have == len(self.state.neighbors):
+                    return True
+                if not self.ready.wait_for(lambda: count() > have, timeout):
+                    return False
+
+    def close(self):
+        '''Update ``self.x`` in place with the sum of the current round and move to the next.
+
+        Returns:
+                matrix: ``self.x``
+        '''
+        with self.lock:
+            entry = self.rounds.pop(self.current, None)
+            self.current = (self.current + 1) % ITER_MOD
+        self.state.x *= self.state.self_weight
+        if entry is not None:
+            self.state.x += entry[0]
+            entry[0].fill(0)
+            with self.lock:
+                self.spare.append(entry[0])
+        return self.state.x
+
+
+def pack_status(stop, quiet):
+    '''Build the convergence header which is put in front of the data in tolerance mode.
 
-        new_data = old_data + tempsum
+    Args:
+            stop (bool): Whether the sender is stopping after this message
+            quiet (int): The sender's count of network-wide quiet rounds
+
+    Returns:
+            bytes: The header
+    '''
+    return STATUS.pack(STOP if stop else 0, min(quiet, QUIET_MAX))
+
+
+def unpack_status(data):
+    '''Split a message made with ``pack_status`` into its header and data.
+
+    Returns:
+            tuple: ``(stop, quiet, data)`` where ``data`` is a memoryview of the remaining bytes
+
+    Raises:
+            ValueError: if the message is too short to carry the header
+    '''
+    view = memoryview(data)
+    if len(view) < STATUS.size:
+        raise ValueError('Message is missing the convergence header')
+    flags, quiet = STATUS.unpack_from(view)
+    return (bool(flags & STOP), quiet, view[STATUS.size:])
+
+
+class ConsensusState(object):
+    '''Preallocated buffers for the consensus update of a single node.
+
+    The update ``x += sum_j w_j (x_j - x)`` is rewritten as
+    ``x = (1 - sum_j w_j) x + sum_j w_j x_j`` so that it can be computed as one weighted
+    reduction over a stacked buffer of neighbor values. ``step`` does not allocate, so the memory
+    used by a run stays constant no matter how large the matrices are.
+
+    Args:
+            orig_data (matrix): The node's starting value. It is copied, never modified.
+            neighbors (dict): Maps each neighbor to its weight
+    '''
+
+    def __init__(self, orig_data, neighbors):
+        orig_data = np.asarray(orig_data)
+        dtype = np.result_type(orig_data.dtype, np.float64)
+        self.neighbors = list(neighbors)
+        self.index = {n: k for k, n in enumerate(self.neighbors)}
+        self.weights = np.array([neighbors[n] for n in self.neighbors], dtype=dtype)
+        self.self_weight = 1 - np.sum(self.weights)
+        self.x = np.array(orig_data, dtype=dtype, order='C')
+        self.stack = np.zeros((len(self.neighbors),) + self.x.shape, dtype=dtype)
+        self.acc = np.empty_like(self.x)
+        self.prev = None
+        self.change = None
+
+    def load(self, neighbor, data):
+        '''Copy a neighbor's value into its slot of the stacked receive buffer'''
+        np.copyto(self.stack[self.index[neighbor]], data)
+
+    def reweight(self, weights):
+        '''Replace the neighbor weights, e.g. after a neighbor failed.
+
+        Args:
+                weights (dict): Maps neighbors to their new weight. Neighbors which are left out
+                         get weight 0.
+        '''
+        self.weights.fill(0)
+        for n, w in weights.items():
+            self.weights[self.index[n]] = w
+        self.self_weight = 1 - np.sum(self.weights)
+
+    def reset(self):
+        '''Start a round of ``fold`` calls'''
+        self.acc.fill(0)
+
+    def fold(self, neighbor, data):
+        '''Add a neighbor's weighted value to the update of this round right away, instead of
+        loading it for ``step``'''
+        k = self.index[neighbor]
+        np.multiply(data, self.weights[k], out=self.stack[k])
+        self.acc += self.stack[k]
+
+    def apply(self):
+        '''Finish a round of ``fold`` calls and update ``self.x`` in place.
+
+        Returns:
+                matrix: ``self.x``
+        '''
+        self.x *= self.self_weight
+        self.x += self.acc
+        return self.x
+
+    def step(self, track_change=False):
+        '''Fold the loaded neighbor values into ``self.x`` in place.
+
+        Args:
+                track_change (bool): Also store the norm of the update,
+                         ``||sum_j w_j (x_j - x)||``, in ``self.change``
+
+        Returns:
+                matrix: ``self.x``
+        '''
+        n_neigh = len(self.neighbors)
+        if track_change:
+            if self.prev is None:
+                self.prev = np.empty_like(self.x)
+            np.copyto(self.prev, self.x)
+        if n_neigh > 0:
+            np.dot(self.weights, self.stack.reshape(n_neigh, -1), out=self.acc.reshape(-1))
+        self.x *= self.self_weight
+        if n_neigh > 0:
+            self.x += self.acc
+        if track_change:
+            np.subtract(self.x, self.prev, out=self.prev)
+            self.change = LA.norm(self.prev.reshape(-1))
+        return self.x
+
+
+def gather(tag, neighbors, communicator, timeout=None):
+    '''Wait for one round of data from every neighbor.
+
+    Each missing neighbor gets ``timeout`` seconds, as long as the other neighbors keep
+    arriving.
+
+    Args:
+            tag (bytes): The tag of the round
+            neighbors (iterable): The neighbors to wait on
+            communicator (Communicator): The object used in sending and receiving data
+            timeout (float): Seconds to wait without progress. Defaults to ``TIMEOUT``
+
+    Returns:
+            dict: Maps each neighbor to its data, or ``None`` if it never arrived.
+    '''
+    if timeout is None:
+        timeout = TIMEOUT
+    # Sleeps until every neighbor's data arrived (Basically synchronization)
+    data = receive(tag, neighbors, communicator, timeout=timeout)
+    missing = [j for j in neighbors if data[j] is None]
+    progress = len(missing) < len(data)
+    while len(missing) > 0 and progress:
+        late = receive(tag, missing, communicator, timeout=timeout)
+        data.update(late)
+        progress = any(late[j] is not None for j in missing)
+        missing = [j for j in missing if late[j] is None]
+    return data
+
+
+def collect(tag, neighbors, communicator, timeout=None):
+    '''Wait for one round of data from every neighbor, giving up on failed neighbors.
+
+    Like ``gather``, but a neighbor which the communicator's failure detector suspects is not
+    waited on any longer.
 
-    return new_data
+    Args:
+            tag (bytes): The tag of the round
+            neighbors (iterable): The neighbors to wait on
+            communicator (Communicator): The object used in sending and receiving data
+            timeout (float): Seconds to wait without progress. Defaults to ``TIMEOUT``
+
+    Returns:
+            dict: Maps each neighbor to its data, or ``None`` if it failed or never sent it.
+    '''
+    if timeout is None:
+        timeout = TIMEOUT
+    data = {j: None for j in neighbors}
+    missing = list(neighbors)
+    deadline = time.monotonic() + timeout
+    while len(missing) > 0:
+        wait = min(POLL, deadline - time.monotonic())
+        j, payload = communicator.wait_any(missing, tag, timeout=max(wait, 0))
+        if j is not None:
+            data[j] = payload
+            missing.remove(j)
+            deadline = time.monotonic() + timeout
+            continue
+        if time.monotonic() >= deadline:
+            break
+        for j in communicator.suspects(missing):
+            missing.remove(j)
+    return data
 
 
 def transmit(data, tag, neighbors, communicator):
@@ -169,21 +858,23 @@ def transmit(data, tag, neighbors, communicator):
         for n in neighbors:
             communicator.send(data, n, tag=int.from_bytes(tag, byteorder='little'))
     else:
-        for n in neighbors:
-            logger.debug('Consensus transmitting data to neighbor {} with tag {}'.format(n, tag))
-            communicator.send(n, data, tag)
+        logger.debug('Consensus transmitting data to neighbors %s with tag %s', neighbors, tag)
+        communicator.broadcast(neighbors, data, tag)
 
 
-def receive(tag, neighbors, communicator):
+def receive(tag, neighbors, communicator, timeout=0):
     '''Attempt to retrieve the data from a set of neighbors
 
     Args:
             tag (bytes): a set of bytes identifying the data tag to retrieve
             neighbors (iterable): a list or dictionary of neighbors to retrieve data from
             communicator (Communicator): The communicator object which can access the data.
+            timeout (float): Seconds to wait for data from all neighbors. ``None`` waits
+                         forever. Ignored with MPI, where receives always block.
 
     Returns:
-            dict: A dictionary mapping each neighbor to the data which is sent.
+            dict: A dictionary mapping each neighbor to the data which is sent. Neighbors
+            whose data did not arrive in time map to ``None``.
     '''
     data = {}
     if MPI:
@@ -191,29 +882,29 @@ def receive(tag, neighbors, communicator):
             rectemp = communicator.recv(source=n, tag=int.from_bytes(tag, byteorder="little"))
             data[n] = rectemp
     else:
-        for n in neighbors:
-            tmp = communicator.get(n, tag)
-            data[n] = tmp
+        data = communicator.wait_all(neighbors, tag, timeout=timeout)
 
     return data
 
 
-def build_tag(tag_id, num):
+def build_tag(tag_id, num, control=False):
     '''Creates a tag from tag_id and the iteration number
 
+    The first byte holds the run id modulo ``RUN_MOD``. Its top bit is reserved for the
+    ``CONTROL`` flag, which sets the messages an algorithm exchanges besides its regular rounds
+    (such as correction rounds) apart from those of every run id. The iteration numbers of
+    control messages wrap around one earlier, so no tag is ever ``HEARTBEAT_TAG``.
+
     Args:
         tag_id (int): identifier for consensus run
         num (int): The iteration number
+        control (bool): Whether this is the tag of a control message
 
     Returns:
         bytes: A unique tag in bytes.
     '''
-    tag = (tag_id % 256).to_bytes(1, byteorder='little')
-    if num > 0:
-        bts = math.log(num, 2)  # number of bits required
-        bts = math.ceil(bts / 8)  # number of bytes required
+    if control:
+        run, num = tag_id % RUN_MOD | CONTROL, num % (ITER_MOD - 1)
     else:
-        bts = 3
-    bts = max(3, bts)  # Should always give us at least 3 bytes to work with.
-    tag += num.to_bytes(bts, byteorder='little')[0:3]
-    return tag
+        run, num = tag_id % RUN_MOD, num % ITER_MOD
+    return run.to_bytes(1, byteorder='little') + num.to_bytes(3, byteorder='little')
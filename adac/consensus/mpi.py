@@ -0,0 +1,102 @@
+'''Distributed average consensus over MPI.
+
+The iterative module sends with mpi4py's lowercase ``send``/``recv``, which pickle every message
+and block on one neighbor at a time. Here every neighbor gets a persistent send and receive
+request, created once on a distributed graph communicator and started together each round.
+The requests point straight at the NumPy buffers of ``iterative.ConsensusState``, so the data is
+never serialized or copied and all transfers of a round overlap.
+'''
+import logging
+from mpi4py import MPI
+from adac.consensus import iterative
+from adac.data_collector.util_logger import psLogger
+
+plogger = psLogger('.'.join([__name__, 'psutil']))
+logger = logging.getLogger(__name__)
+TAG = 0xAD
+
+
+def neighbor_comm(comm, neighbors):
+    '''Create a distributed graph communicator in which this rank is linked to ``neighbors``.
+
+    Ranks are not reordered, so they are the same as in ``comm``.
+
+    Args:
+            comm (Intracomm): The communicator holding every node, i.e. ``MPI.COMM_WORLD``
+            neighbors (iterable): The ranks of the neighbors
+
+    Returns:
+            Distgraphcomm: The new communicator
+    '''
+    ranks = list(neighbors)
+    return comm.Create_dist_graph_adjacent(ranks, ranks, reorder=False)
+
+
+class MPIConsensus(object):
+    '''Persistent MPI requests for the consensus rounds of a single node.
+
+    Every node in the graph must create its ``MPIConsensus`` at the same time since creating the
+    graph communicator is collective over ``comm``. The data must have the same shape on every
+    node.
+
+    Args:
+            orig_data (matrix): The node's starting value. It is copied, never modified.
+            neighbors (dict): Maps each neighbor's rank to its weight
+            comm (Intracomm): The communicator holding every node
+            tag (int): MPI tag of the consensus messages
+    '''
+
+    def __init__(self, orig_data, neighbors, comm, tag=TAG):
+        self.state = iterative.ConsensusState(orig_data, neighbors)
+        self.comm = neighbor_comm(comm, self.state.neighbors)
+        self.requests = []
+        for k, n in enumerate(self.state.neighbors):
+            self.requests.append(self.comm.Send_init(self.state.x, dest=n, tag=tag))
+            self.requests.append(self.comm.Recv_init(self.state.stack[k], source=n, tag=tag))
+
+    def step(self):
+        '''Exchange values with every neighbor and apply the consensus update.
+
+        Returns:
+                matrix: The node's new value
+        '''
+        if len(self.requests) > 0:
+            MPI.Prequest.Startall(self.requests)
+            MPI.Request.Waitall(self.requests)
+        return self.state.step()
+
+    def close(self):
+        '''Free the requests and the graph communicator'''
+        for req in self.requests:
+            req.Free()
+        self.requests = []
+        self.comm.Free()
+
+
+def run(orig_data, tc, neighbors, comm):
+    '''Run consensus v.s. the neighboring ranks in order to converge upon the network average.
+
+    Args:
+            orig_data (matrix): The data which we want to find a consensus with (numpy matrix)
+            tc (int): Number of consensus iterations
+            neighbors (dict): Maps each neighbor's rank to its weight
+            comm (Intracomm): The communicator holding every node, i.e. ``MPI.COMM_WORLD``
+
+    Returns:
+            matrix: A numpy matrix with the agreed-upon consensus values.
+    '''
+    logger.debug("tc: {}, num neighbors: {}".format(tc, len(neighbors)))
+    engine = MPIConsensus(orig_data, neighbors, comm)
+    plogger.log_cpu_time("0")
+    plogger.log_mem("0")
+    plogger.log_network("0")
+    try:
+        for i in range(tc):
+            plogger.log_cpu_time('{}'.format(i+1))
+            plogger.log_mem('{}'.format(i+1))
+            plogger.log_network('{}'.format(i+1))
+            logger.info('%s | Data: %s', i+1, engine.state.x)
+            engine.step()
+    finally:
+        engine.close()
+    return engine.state.x
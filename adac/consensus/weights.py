@@ -0,0 +1,176 @@
+'''Helpers for building consensus weight matrices from a network graph and for picking the
+acceleration parameter of Accelerated Corrective Consensus.
+
+These work on the whole graph, so they are meant for nodes which know the network layout from
+their config file and for offline experiments.
+'''
+import json
+import math
+import numpy as np
+from numpy import linalg as LA
+
+
+def parse_edges(text):
+    '''Parse an adjacency matrix as it appears in the ``[graph] edges`` option of a config file.
+
+    Both JSON (``[[1, 1], [1, 1]]``) and whitespace separated rows (``[[1 1] [1 1]]``) are
+    accepted.
+
+    Args:
+            text (str): The matrix
+
+    Returns:
+            list: The adjacency matrix as a list of lists of ints
+    '''
+    try:
+        return json.loads(text)
+    except ValueError:
+        rows = text.replace('[', ' ').replace(',', ' ').split(']')
+        return [[int(v) for v in row.split()] for row in rows if row.strip()]
+
+
+def metropolis_matrix(edges):
+    '''Build the Metropolis-Hastings weight matrix of a graph.
+
+    ``W[i][j] = 1 / (max(d_i, d_j) + 1)`` for every edge and the diagonal holds the leftover
+    weight so that every row sums to one. These are the weights ``iterative.get_weights`` gives
+    each node.
+
+    Args:
+            edges (list): Square adjacency matrix. The diagonal is ignored and links are
+                         treated as undirected.
+
+    Returns:
+            ndarray: The symmetric, doubly stochastic weight matrix
+    '''
+    adj = _adjacency(edges)
+    deg = adj.sum(axis=1)
+    weights = np.where(adj, 1 / (np.maximum.outer(deg, deg) + 1), 0)
+    np.fill_diagonal(weights, 1 - weights.sum(axis=1))
+    return weights
+
+
+def second_eigenvalue(weights):
+    '''Second largest eigenvalue modulus of a symmetric weight matrix, which sets the rate at
+    which consensus converges.
+
+    Args:
+            weights (ndarray): A symmetric weight matrix
+
+    Returns:
+            float: The second largest eigenvalue modulus
+    '''
+    eig = np.sort(np.abs(LA.eigvalsh(weights)))
+    if len(eig) < 2:
+        return 0.0
+    return float(eig[-2])
+
+
+def optimal_beta(weights):
+    '''Acceleration parameter for ``x(t+1) = beta W x(t) + (1 - beta) x(t-1)``.
+
+    Uses ``beta = 2 / (1 + sqrt(1 - lambda_2^2))`` from [2] in ``adac.consensus.corrective``.
+
+    Args:
+            weights (ndarray): A symmetric weight matrix
+
+    Returns:
+            float: beta, between 1 and 2
+    '''
+    lam = second_eigenvalue(weights)
+    return 2 / (1 + math.sqrt(max(0.0, 1 - lam ** 2)))
+
+
+def fastest_mixing_matrix(edges, iterations=500, step=0.3):
+    '''Search for edge weights which make consensus converge faster than Metropolis-Hastings.
+
+    Minimizes ``max(lambda_2(W), -lambda_n(W))`` over the symmetric matrices
+    ``W = I - sum_l w_l (e_i - e_j)(e_i - e_j)^T`` which respect the graph, have non-negative
+    entries and rows summing to one, with the projected subgradient method of Boyd, Diaconis
+    and Xiao (Fastest Mixing Markov Chain on a Graph). The search starts from the Metropolis
+    weights and returns the best matrix it saw, so it is never worse than them.
+
+    The method is deterministic, so every node which reads the same graph computes the same
+    matrix and the weights agree across the network.
+
+    Args:
+            edges (list): Square adjacency matrix. The diagonal is ignored and links are
+                         treated as undirected.
+            iterations (int): Number of subgradient steps
+            step (float): Initial step length. Step ``k`` is ``step / sqrt(k)``.
+
+    Returns:
+            ndarray: The symmetric, doubly stochastic weight matrix
+    '''
+    weights = metropolis_matrix(edges)
+    n = len(weights)
+    rows, cols = np.nonzero(np.triu(_adjacency(edges), 1))
+    if len(rows) == 0:
+        return weights
+    w = weights[rows, cols].copy()
+    best, best_lam = weights, second_eigenvalue(weights)
+
+    for k in range(1, iterations + 1):
+        # Subgradient of the active extreme eigenvalue w.r.t. each edge weight
+        eig, vec = LA.eigh(weights)
+        if eig[-2] >= -eig[0]:
+            u = vec[:, -2]
+            grad = -(u[rows] - u[cols]) ** 2
+        else:
+            u = vec[:, 0]
+            grad = (u[rows] - u[cols]) ** 2
+        norm = LA.norm(grad)
+        if norm == 0:
+            break
+        w -= step / math.sqrt(k) * grad / norm
+        w = _project(w, rows, cols, n)
+
+        weights = np.zeros((n, n))
+        weights[rows, cols] = w
+        weights[cols, rows] = w
+        np.fill_diagonal(weights, 1 - weights.sum(axis=1))
+        lam = second_eigenvalue(weights)
+        if lam < best_lam:
+            best, best_lam = weights, lam
+    return best
+
+
+def _adjacency(edges):
+    '''Symmetric boolean adjacency matrix without self loops'''
+    adj = np.array(edges, dtype=bool)
+    if adj.ndim != 2 or adj.shape[0] != adj.shape[1]:
+        raise ValueError('The adjacency matrix must be square')
+    adj = adj | adj.T
+    np.fill_diagonal(adj, False)
+    return adj
+
+
+def _project(w, rows, cols, n, sweeps=20):
+    '''Push edge weights back onto ``w >= 0`` with every node's total at most one'''
+    w = np.maximum(w, 0)
+    for _ in range(sweeps):
+        total = np.bincount(rows, w, n) + np.bincount(cols, w, n)
+        over = np.maximum(total - 1, 0)
+        if not over.any():
+            break
+        deg = np.bincount(rows, w > 0, n) + np.bincount(cols, w > 0, n)
+        share = over / np.maximum(deg, 1)
+        w = np.maximum(w - np.maximum(share[rows], share[cols]), 0)
+    # Scale down whatever the sweeps did not fix
+    total = np.bincount(rows, w, n) + np.bincount(cols, w, n)
+    scale = 1 / np.maximum(total, 1)
+    return w * np.minimum(scale[rows], scale[cols])
+
+
+def node_weights(weights, index, neighbors):
+    '''Pick out the weights one node uses from a weight matrix.
+
+    Args:
+            weights (ndarray): The network's weight matrix
+            index (int): The node's row in the matrix
+            neighbors (dict): Maps each neighbor to its row in the matrix
+
+    Returns:
+            dict: Maps each neighbor to its weight, the same format as ``iterative.get_weights``
+    '''
+    return {n: float(weights[index][j]) for n, j in neighbors.items()}
@@ -13,15 +13,21 @@ class psLogger(object):
 
     def log_cpu_time(self, *args):
         '''Log process CPU time'''
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
         self.log(psutil.cpu_times(), *args)
         self.log(self.proc.cpu_times(), *args)
 
     def log_mem(self, *args):
         '''Log memory statistics for current process'''
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
         self.log(self.proc.memory_full_info(), *args)
 
     def log_network(self, *args):
         '''Log network activity'''
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
         self.log(psutil.net_io_counters(), *args)
 
     def log(self, info_str, *args):
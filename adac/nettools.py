@@ -5,6 +5,7 @@ import fcntl
 import logging
 import netifaces
 import platform
+import numpy as np
 logger = logging.getLogger(__name__)
 
 def get_ip_address(ifname):
@@ -36,40 +37,126 @@ def get_ip_address(ifname):
     return ip
 
 
-def matrix_to_bytes(data):
-    '''Convert a numpy matrix to an array of bytes to transfer
-     over the network*
+class ArrayCodec(object):
+    '''Encodes numpy arrays as a small header followed by the raw array buffer.
+
+    The header is laid out as follows (shape entries are little-endian unsigned 64 bit ints)
+
+    +-----------------+-------------+-----------+-------------------+--------------+------------+
+    | Magic (2 bytes) | Version (1) | ndim (1)  | dtype length (1)  | dtype (n)    | shape (8n) |
+    +-----------------+-------------+-----------+-------------------+--------------+------------+
+    |                        Array data (C-contiguous, ``prod(shape) * itemsize`` bytes)       |
+    +------------------------------------------------------------------------------------------+
+
+    The dtype is stored as its numpy type string (i.e. ``'<f8'``) which carries the byte order.
+    Only plain numeric dtypes are accepted so decoding can never execute code, unlike unpickling.
+    Decoding wraps the received memory with ``np.frombuffer`` and does not copy it.
+    '''
+    MAGIC = b'AC'
+    VERSION = 1
+    MAX_DIMS = 32
+    KINDS = 'biufc'
+
+    def encode(self, data):
+        '''Convert an array into bytes
+
+        Args:
+                data (array_like): The array to encode. Converted with ``np.asarray``
+
+        Returns:
+                bytes: The header followed by the array data
+        '''
+        arr = np.asarray(data)
+        if not arr.flags.c_contiguous:
+            arr = np.ascontiguousarray(arr)
+        if arr.dtype.kind not in self.KINDS or arr.ndim > self.MAX_DIMS:
+            raise TypeError('Cannot encode an array of dtype {} with {} dimensions'.format(
+                arr.dtype, arr.ndim))
+        dtype = arr.dtype.str.encode('ascii')
+        header = self.MAGIC + struct.pack('<BBB', self.VERSION, arr.ndim, len(dtype)) + dtype
+        header += struct.pack('<{}Q'.format(arr.ndim), *arr.shape)
+        return b''.join([header, memoryview(arr.reshape(-1)).cast('B')])
+
+    def decode(self, data):
+        '''Convert bytes created by ``encode`` back into an array without copying the data.
+
+        Args:
+                data (bytes): Any bytes-like object holding an encoded array
+
+        Returns:
+                numpy.ndarray: An array backed by ``data``. Read-only if ``data`` is.
+
+        Raises:
+                ValueError: if the header is malformed or does not match the data length
+        '''
+        view = memoryview(data).cast('B')
+        if len(view) < 5 or view[:2] != self.MAGIC:
+            raise ValueError('Not an encoded array')
+        version, ndim, dt_len = struct.unpack_from('<BBB', view, 2)
+        if version != self.VERSION:
+            raise ValueError('Unsupported array encoding version {}'.format(version))
+        if ndim > self.MAX_DIMS:
+            raise ValueError('Too many dimensions: {}'.format(ndim))
+        offset = 5 + dt_len + 8 * ndim
+        if len(view) < offset:
+            raise ValueError('Truncated array header')
+        try:
+            dtype = np.dtype(bytes(view[5:5 + dt_len]).decode('ascii'))
+        except (TypeError, ValueError, UnicodeDecodeError) as err:
+            raise ValueError('Bad dtype in array header: {}'.format(err))
+        if dtype.kind not in self.KINDS:
+            raise ValueError('Refusing to decode dtype {}'.format(dtype))
+        shape = struct.unpack_from('<{}Q'.format(ndim), view, 5 + dt_len)
+        count = 1
+        for dim in shape:
+            count *= dim
+        if count * dtype.itemsize != len(view) - offset:
+            raise ValueError('Array data is {} bytes, header expects {}'.format(
+                len(view) - offset, count * dtype.itemsize))
+        return np.frombuffer(view, dtype=dtype, count=count, offset=offset).reshape(shape)
+
+
+class PickleCodec(object):
+    '''The original pickle based encoding.
+
+    Unpickling data which came over the network can execute arbitrary code, so this should only
+    be used to talk to nodes running older versions on a trusted network.
+    '''
+
+    def encode(self, data):
+        return pickle.dumps(data)
 
-    *This is just a simple implementation. In production one should probably not use the pickle
-    library. One reason against using pickle is that the process of unpickling data after it
-    has been sent over the network can be maliciously modified to execute arbitrary code which
-    inherntly presents a serious security hazard. Anyone using this code in a security-concious
-    environment should replace the matrix_*_bytes pair of methods with a more suitable
-    implementation.
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+CODEC = ArrayCodec()
+
+
+def matrix_to_bytes(data, codec=CODEC):
+    '''Convert a numpy matrix to an array of bytes to transfer
+     over the network
 
     Args:
             data (obj): Data to convert to bytes
+            codec (obj): Object with ``encode``/``decode`` methods. Defaults to ``ArrayCodec``
 
     Returns:
             bytes: The data in a byte representation
     '''
-    pick = pickle.dumps(data)
-    return pick
+    return codec.encode(data)
 
 
-def matrix_from_bytes(data):
+def matrix_from_bytes(data, codec=CODEC):
     '''Convert a byte array back into a numpy matrix.
 
-    Please refer to the * note under ``nettools.matrix_to_bytes``
-    about the security hazard that the pickling implementation
-    leaves open.
-
     Args:
             data (bytes): An array of bytes to convert to a numpy
              matrix
+            codec (obj): Object with ``encode``/``decode`` methods. Defaults to ``ArrayCodec``
 
     Returns:
             obj: An numpy matrix which was originally represented as bytes.
 
     '''
-    return pickle.loads(data)
+    return codec.decode(data)
@@ -1,6 +1,7 @@
 
 '''Run with flask as an HTTP server to communicate starting points of CloudK-SVD and Consensus
 '''
+import asyncio
 import json
 import logging
 import os
@@ -12,8 +13,13 @@ from multiprocessing import Process, Value
 from urllib.parse import urlparse
 import numpy as np
 import adac.consensus.iterative as consensus
+import adac.consensus.corrective as corrective
+import adac.consensus.gossip as gossip
+import adac.consensus.mpi as mpi_consensus
+import adac.consensus.weights as cweights
 import adac.nettools as nettools
-from adac.communicator import TCPCommunicator
+from adac.communicator import (SHM_RING_SIZE, AsyncTCPCommunicator, BaseCommunicator,
+                               ShmCommunicator, TCPCommunicator, UDPCommunicator)
 import requests
 from flask import Flask, request
 from mpi4py import MPI as OMPI
@@ -55,22 +61,15 @@ def data_loader(filename):
 
     return data
 
-def get_neighbors():
-    '''Gets IP addresses of neigbors for given node
+def get_ip(con):
+    '''Gets the IP address of this node on the interface from the config file
 
     Args:
-            N/A
+            con (ConfigParser): The loaded config file
 
     Returns:
-            (iterable): list of IP addresses of neighbors. None if no neighbors were found. Check
-            logs for additional information if you keep getting "None".
+            str: The IP address
     '''
-
-    global CONF_FILE
-    con = ConfigParser()
-    con.read(CONF_FILE)
-    v = json.loads(con['graph']['nodes'])
-    e = json.loads(con['graph']['edges'])
     ip = None 
     try:
         ip = nettools.get_ip_address(con['network']['iface'])
@@ -83,11 +82,77 @@ def get_neighbors():
         raise OSError('Could not retrieve our IP address. Make sure your connection is "wlan0" or "wifi0"')
 
     logger.debug('IP of wlan0/wifi0 is %s', ip)
+    return ip
+
+def get_node_id(con):
+    '''Gets the name of this node in the ``[graph] nodes`` list of the config file
+
+    This is ``[network] id`` when it is set and the node's IP address otherwise. Nodes which
+    share a host, such as the nodes of a shared memory run, need their own ``id``.
+
+    Args:
+            con (ConfigParser): The loaded config file
+
+    Returns:
+            str: The name of this node
+    '''
+    node_id = con['network'].get('id')
+    if node_id:
+        return node_id
+    return get_ip(con)
+
+def get_variant(con, mpi=False):
+    '''Gets the variant of iterative consensus which the ``[consensus]`` section asks for
+
+    ``pipelined``, ``incremental``, ``resilient`` and ``staleness`` each pick a variant of
+    their own. None of them supports early termination or MPI.
+
+    Args:
+            con (ConfigParser): The loaded config file
+            mpi (bool): Whether the nodes run over MPI
+
+    Returns:
+            str: ``pipelined``, ``incremental``, ``resilient`` or ``staleness``, ``None`` for plain
+             iterative consensus
+
+    Raises:
+            ValueError: if more than one variant is set, or one is set with epsilon or MPI
+    '''
+    section = con['consensus']
+    chosen = [name for name in ('pipelined', 'incremental', 'resilient')
+              if section.getboolean(name, fallback=False)]
+    if section.getint('staleness', fallback=0) > 0:
+        chosen.append('staleness')
+    if len(chosen) > 1:
+        raise ValueError('Only one of {} can be set'.format(', '.join(chosen)))
+    if len(chosen) == 0:
+        return None
+    if section.get('epsilon', fallback=None) is not None or mpi:
+        raise ValueError('{} does not support epsilon or MPI'.format(chosen[0]))
+    return chosen[0]
+
+def get_neighbors():
+    '''Gets IP addresses of neigbors for given node
+
+    Args:
+            N/A
+
+    Returns:
+            (iterable): list of IP addresses of neighbors. None if no neighbors were found. Check
+            logs for additional information if you keep getting "None".
+    '''
+
+    global CONF_FILE
+    con = ConfigParser()
+    con.read(CONF_FILE)
+    v = json.loads(con['graph']['nodes'])
+    e = json.loads(con['graph']['edges'])
+    ip = get_node_id(con)
 
     try:
         i = v.index(ip)
     except ValueError as err:
-        logger.warning('IP %s was not found in neighbor list', ip)
+        logger.warning('Node %s was not found in neighbor list', ip)
         return None
     n = []
     for x in range(len(v)):
@@ -95,6 +160,95 @@ def get_neighbors():
             n.append(v[x])
 
     return n
+def get_diameter():
+    '''Gets the diameter of the graph in the config file, i.e. the largest number of hops between
+    any two nodes.
+
+    Args:
+            N/A
+
+    Returns:
+            int: The diameter. If the graph is disconnected, the number of nodes.
+    '''
+    global CONF_FILE
+    con = ConfigParser()
+    con.read(CONF_FILE)
+    e = json.loads(con['graph']['edges'])
+    diameter = 0
+    for start in range(len(e)):
+        dist = {start: 0}
+        frontier = [start]
+        while len(frontier) > 0:
+            nxt = []
+            for i in frontier:
+                for j in range(len(e)):
+                    if e[i][j] == 1 and j not in dist:
+                        dist[j] = dist[i] + 1
+                        nxt.append(j)
+            frontier = nxt
+        if len(dist) < len(e):
+            return len(e)
+        diameter = max(diameter, max(dist.values()))
+    return diameter
+
+def get_weight_matrix(method='metropolis'):
+    '''Computes the consensus weight matrix of the whole graph in the config file.
+
+    Args:
+            method (str): ``'metropolis'`` for Metropolis-Hastings weights or ``'fastest'`` for
+                         the optimized weights of ``weights.fastest_mixing_matrix``
+
+    Returns:
+            ndarray: The weight matrix, rows and columns ordered like ``[graph] nodes``
+    '''
+    global CONF_FILE
+    con = ConfigParser()
+    con.read(CONF_FILE)
+    e = cweights.parse_edges(con['graph']['edges'])
+    if method == 'metropolis':
+        return cweights.metropolis_matrix(e)
+    elif method == 'fastest':
+        return cweights.fastest_mixing_matrix(e)
+    raise ValueError('Unknown weight method {}'.format(method))
+
+def get_config_weights(neighs, method, rank=None):
+    '''Computes the weights of this node from the graph in the config file, without asking the
+    neighbors for their degree.
+
+    Args:
+            neighs (iterable): IP addresses of the neighbors, or their ranks with MPI
+            method (str): See ``get_weight_matrix``
+            rank (int): Our MPI rank. ``None`` looks up our IP address in ``[graph] nodes``.
+
+    Returns:
+            dict: a dictionary mapping neighbors to their weights
+    '''
+    if neighs is None:
+        return {}
+    global CONF_FILE
+    con = ConfigParser()
+    con.read(CONF_FILE)
+    if rank is None:
+        v = json.loads(con['graph']['nodes'])
+        index = v.index(get_node_id(con))
+        rows = {n: v.index(n) for n in neighs}
+    else:
+        index = rank
+        rows = {n: n for n in neighs}
+    return cweights.node_weights(get_weight_matrix(method), index, rows)
+
+def get_beta(method='metropolis'):
+    '''Gets the acceleration parameter for Accelerated Corrective Consensus from the graph in
+    the config file.
+
+    Args:
+            method (str): The weights the nodes use, see ``get_weight_matrix``
+
+    Returns:
+            float: The optimal beta for those weights
+    '''
+    return cweights.optimal_beta(get_weight_matrix(method))
+
 def get_indexAndEdges():
     '''Gets index and edge lists to be passed into OMPI.COMM_WORLD.Create_graph
 
@@ -188,6 +342,58 @@ def post_message(msg):
     except:
         logger.warn("Could not post message to {}".format(url))
 
+def notify_neighbor(node, port, tc, consensus_id):
+    '''Ask a neighbor to start running the same consensus job.
+
+    Args:
+        node (str): IP address of the neighbor
+        port (str): Port of the neighbor's node runner
+        tc (int): Number of consensus iterations
+        consensus_id (str): The id of the consensus job
+    '''
+    req_url = 'http://{}:{}/start/consensus?tc={}&id={}'.format(node, port, tc, consensus_id)
+    logger.info('Kickoff URL for node {} is {}'.format(node, req_url))
+    try:
+        requests.get(req_url, timeout=5)
+        logger.debug('Made kickoff request')
+    except BaseException as err:
+        message = "Error requesting {}: {}".format(req_url, err)
+        post_message(message)
+        logger.warning(message)
+
+async def consensus_async(data, tc, weights, port, node_port, consensus_id, window=None):
+    '''Run the neighbor kickoff requests and consensus together on one event loop.
+
+    The kickoff requests run in the loop's default executor while the communicator is already
+    listening, so neighbors which start early can connect right away.
+
+    Args:
+        data (matrix): This node's data
+        tc (int): Number of consensus iterations
+        weights (dict): Maps each neighbor to its weight
+        port (int): The consensus port
+        node_port (str): Port of the neighbors' node runners
+        consensus_id (str): The id of the consensus job
+        window (int): Iterations of data the communicator keeps per neighbor
+
+    Returns:
+        matrix: The consensus result, ``None`` if consensus did not finish
+    '''
+    loop = asyncio.get_running_loop()
+    c = AsyncTCPCommunicator(port, window=window)
+    await c.listen()
+    logger.debug('Now listening on new TCP port %s', port)
+    try:
+        kicks = [loop.run_in_executor(None, notify_neighbor, node, node_port, tc, consensus_id)
+                 for node in weights]
+        result = await consensus.run_async(data, tc, 1, weights, c)
+        await asyncio.gather(*kicks)
+        logger.info('Dropped messages: %s, late messages: %s', c.data_store.dropped,
+                    c.data_store.late)
+        return result
+    finally:
+        await c.close()
+
 def kickoff(task, tc, consensus_id):
     '''The worker method for running distributed consensus.
 
@@ -203,6 +409,7 @@ def kickoff(task, tc, consensus_id):
     c = None
     neighs = None
     graph_comm = None
+    rank = None
     finished_consensus = False
     try:
         config = ConfigParser()
@@ -210,24 +417,30 @@ def kickoff(task, tc, consensus_id):
         config.read(CONF_FILE)
         ####### Notify Other Nodes to Start #######
         port = config['node_runner']['port']
+        node_port = port
         post_url = config['collector']['url']
+        algorithm = config['consensus'].get('algorithm', fallback='iterative')
+        eps = config['consensus'].getfloat('epsilon', fallback=None)
+        multicast = config['consensus'].get('multicast', fallback=None)
+        transport = config['consensus'].get('communicator', fallback='tcp')
+        variant = get_variant(config, MPI) if algorithm == 'iterative' else None
+        # The asyncio path runs plain iterative consensus over TCP only
+        wants_async = config['consensus'].getboolean('async', fallback=False)
+        use_async = (wants_async and not MPI and algorithm == 'iterative' and eps is None
+                     and variant is None and multicast is None and transport == 'tcp')
+        if wants_async and not use_async:
+            logger.warning('async only runs plain iterative consensus over TCP without MPI, '
+                           'multicast or epsilon. Running it with threads instead.')
+        window = config['consensus'].getint('window', fallback=None)
         logger.debug('Attempting to tell all other nodes in my vicinity to start')
         neighs = get_neighbors()
         logger.info("Myneighs: {}".format(neighs))
         if neighs is None:
             logger.warning("No neighbors found - consensus finished")
-        else:
+        elif not use_async:
+            # With asyncio the requests go out from the event loop, see consensus_async
             for node in neighs:
-                req_url = 'http://{}:{}/start/consensus?tc={}&id={}'.format(node,
-                                                                            port, tc, consensus_id)
-                logger.info('Kickoff URL for node {} is {}'.format(node, req_url))
-                try:
-                    requests.get(req_url, timeout=5)
-                    logger.debug('Made kickoff request')
-                except BaseException as err:
-                    message = "Error requesting {}: {}".format(req_url, err)
-                    post_message(message)
-                    logger.warning(message)
+                notify_neighbor(node, port, tc, consensus_id)
 
         if MPI:
             c = OMPI.COMM_WORLD
@@ -239,10 +452,25 @@ def kickoff(task, tc, consensus_id):
             rank = c.Get_rank()
             neighs = graph.Get_neighbors(rank)
             #populate neighs with ranks of neghbor nodes using Graphcomm.get_neighbors()
-        else:
+        elif multicast is not None:
+            port = config['consensus']['port']
+            # Every round goes out once to the run's group, lost packets are NACKed
+            c = UDPCommunicator(int(port), window=window, reliable=True, multicast=multicast)
+            c.join(1)
+            c.filter_sources(neighs or [])
+            c.listen()
+            logger.debug('Now listening on UDP port %s for multicast group %s', port, multicast)
+        elif transport == 'shm':
+            port = config['consensus']['port']
+            ring_size = config['consensus'].getint('shm_ring_size', fallback=SHM_RING_SIZE)
+            c = ShmCommunicator(int(port), get_node_id(config), window=window,
+                                ring_size=ring_size)
+            c.listen()
+            logger.debug('Now listening on shared memory as %s', c.addr)
+        elif not use_async:
             port = config['consensus']['port']
             logger.debug('Communicating on port {}'.format(port))
-            c = TCPCommunicator(int(port))
+            c = TCPCommunicator(int(port), window=window)
             c.listen()
             logger.debug('Now listening on new TCP port %s', port)
             #for neighbor in neighs:
@@ -257,14 +485,59 @@ def kickoff(task, tc, consensus_id):
         # Pick a tag ID (doesn't matter) --> 1
         # communicator already created
         logger.debug('My neighbors {}'.format(neighs))
-        weights = consensus.get_weights(neighs, MPI_graph_comm=graph_comm)
+        method = config['consensus'].get('weights', fallback='http')
+        if method == 'http':
+            weights = consensus.get_weights(neighs, MPI_graph_comm=graph_comm)
+        else:
+            weights = get_config_weights(neighs, method, rank=rank)
         logger.debug('Neighbor weights {}'.format(weights))
         data = data_loader(config['data']['file'])
         logger.debug('Loaded data')
         try:
             #set MPI to true or false
             consensus.MPI = MPI
-            consensus_data = consensus.run(data, tc, 1, weights, c)
+            if use_async:
+                consensus_data = asyncio.run(consensus_async(
+                    data, tc, weights, int(config['consensus']['port']), node_port,
+                    consensus_id, window))
+            elif algorithm == 'iterative':
+                patience = config['consensus'].getint('patience', fallback=3)
+                diameter = get_diameter() if eps is not None else None
+                if MPI and eps is None:
+                    consensus_data = mpi_consensus.run(data, tc, weights, c)
+                elif variant == 'pipelined':
+                    consensus_data = consensus.run_pipelined(data, tc, 1, weights, c)
+                elif variant == 'incremental':
+                    consensus_data = consensus.run_incremental(data, tc, 1, weights, c)
+                elif variant == 'resilient':
+                    c.start_heartbeat(
+                        weights, config['consensus'].getfloat('heartbeat', fallback=1.0),
+                        config['consensus'].getfloat('phi', fallback=8.0),
+                        config['consensus'].getfloat('failure_timeout', fallback=None))
+                    consensus_data = consensus.run_resilient(data, tc, 1, weights, c)
+                elif variant == 'staleness':
+                    staleness = config['consensus'].getint('staleness')
+                    consensus_data = consensus.run_bounded(data, tc, 1, weights, c,
+                                                           staleness=staleness)
+                else:
+                    consensus_data = consensus.run(data, tc, 1, weights, c, eps=eps,
+                                                   patience=patience, diameter=diameter)
+            elif algorithm in ('corrective', 'accelerated'):
+                beta = 1.0
+                if algorithm == 'accelerated':
+                    beta = config['consensus'].getfloat('beta', fallback=None)
+                    if beta is None:
+                        beta = get_beta('fastest' if method == 'fastest' else 'metropolis')
+                period = config['consensus'].getint('correction_period', fallback=10)
+                consensus_data = corrective.run(data, tc, 1, weights, c, beta=beta,
+                                                period=period)
+            elif algorithm == 'gossip':
+                interval = config['consensus'].getfloat('gossip_interval', fallback=0.05)
+                fanout = config['consensus'].getboolean('gossip_broadcast', fallback=False)
+                consensus_data = gossip.run(data, tc, 1, weights, c, interval=interval,
+                                            broadcast=fanout)
+            else:
+                raise ValueError('Unknown consensus algorithm {}'.format(algorithm))
             logger.info("~~~~~~~~~~~~~~ CONSENSUS DATA ~~~~~~~~~~~~~~~~")
             logger.info('{}'.format(consensus_data))
             logger.info("~~~~~~~~~~~~~~ CONSENSUS DATA ~~~~~~~~~~~~~~~~")
@@ -290,7 +563,9 @@ def kickoff(task, tc, consensus_id):
         msg = 'Consensus exception {}'.format(repr(traceback.format_tb(exc_traceback)))
         logger.error(msg)
         #post_message(msg)
-    if isinstance(c, TCPCommunicator):
+    if isinstance(c, BaseCommunicator):
+        logger.info('Dropped messages: %s, late messages: %s', c.data_store.dropped,
+                    c.data_store.late)
         c.close()
 
     try:
@@ -0,0 +1,535 @@
+'''Simulate iterative consensus on large generated networks inside one process.
+
+Every simulated node has a ``LoopbackCommunicator`` and does what a real node does in
+``iterative.run``: it encodes its value, ``transmit``s it to its neighbors, ``receive``s their
+values and folds them in with a ``ConsensusState``. The nodes take turns in lock step, first
+every node sends and then every node receives and updates, so a run needs no threads and always
+gives the same result.
+
+Large networks can be split over a pool of processes. Each process simulates a contiguous range
+of nodes, and the messages which cross ranges are exchanged in one batch per pair of processes
+each round.
+
+``simulate_matrix`` is the fast path for picking ``tc`` and the weights. Every round of
+iterative consensus is ``x(t+1) = W x(t)``, so it builds the network's weight matrix ``W`` as a
+sparse ``CSRMatrix`` and multiplies all nodes at once. It also estimates the second largest
+eigenvalue modulus of ``W``, which bounds how many rounds any starting value needs.
+
+    python3 -m adac.simulator --graph random --nodes 10000 --degree 6 --rounds 50 --processes 4
+    python3 -m adac.simulator --graph random --nodes 100000 --degree 6 --rounds 200 --matrix
+'''
+import argparse
+import bisect
+import itertools
+import logging
+import math
+import multiprocessing
+import random
+import time
+from configparser import ConfigParser
+import numpy as np
+import adac.nettools as nettools
+from adac.communicator import LoopbackCommunicator
+from adac.consensus import iterative
+from adac.consensus import weights as cweights
+
+logger = logging.getLogger(__name__)
+TAG_ID = 1
+GRAPHS = ('ring', 'torus', 'random')
+
+
+def generate_graph(kind, num, degree=4, seed=0):
+    '''Generate an undirected, connected network topology.
+
+    - ``ring``: every node is linked to the ``degree / 2`` nearest nodes on each side
+    - ``torus``: a two dimensional grid which wraps around, as square as ``num`` allows
+    - ``random``: a ring plus random links until the average degree is about ``degree``
+
+    Args:
+        kind (str): One of ``GRAPHS``
+        num (int): Number of nodes
+        degree (int): Target degree for ``ring`` and ``random``
+        seed (int): Seed of the random links
+
+    Returns:
+        list: ``neighbors[i]`` is the set of neighbors of node ``i``
+    '''
+    if num < 2:
+        raise ValueError('A network needs at least 2 nodes')
+    neighbors = [set() for _ in range(num)]
+
+    def link(i, j):
+        if i != j:
+            neighbors[i].add(j)
+            neighbors[j].add(i)
+
+    if kind in ('ring', 'random'):
+        reach = max(1, degree // 2) if kind == 'ring' else 1
+        for i in range(num):
+            for k in range(1, reach + 1):
+                link(i, (i + k) % num)
+        if kind == 'random':
+            rng = random.Random(seed)
+            for _ in range(num * max(0, degree - 2) // 2):
+                link(rng.randrange(num), rng.randrange(num))
+    elif kind == 'torus':
+        rows = max(r for r in range(1, int(num ** 0.5) + 1) if num % r == 0)
+        cols = num // rows
+        for i in range(num):
+            row, col = divmod(i, cols)
+            link(i, row * cols + (col + 1) % cols)
+            link(i, (row + 1) % rows * cols + col)
+    else:
+        raise ValueError('Unknown graph {}, use one of {}'.format(kind, GRAPHS))
+    return neighbors
+
+
+def load_graph(config):
+    '''Read the network from the ``[graph]`` section of a config file.
+
+    Returns:
+        list: ``neighbors[i]`` is the set of neighbors of node ``i``
+    '''
+    con = ConfigParser()
+    con.read(config)
+    adj = np.array(cweights.parse_edges(con['graph']['edges']), dtype=bool)
+    adj = adj | adj.T
+    np.fill_diagonal(adj, False)
+    return [set(np.flatnonzero(row).tolist()) for row in adj]
+
+
+def metropolis_weights(neighbors):
+    '''The weights ``iterative.get_weights`` gives every node.
+
+    Returns:
+        list: ``weights[i]`` maps each neighbor of node ``i`` to its weight
+    '''
+    deg = [len(n) for n in neighbors]
+    return [{j: 1 / (max(deg[i], deg[j]) + 1) for j in sorted(neigh)}
+            for i, neigh in enumerate(neighbors)]
+
+
+def simulate(neighbors, values, tc, weights=None, processes=1, codec=nettools.CODEC):
+    '''Run ``tc`` rounds of iterative consensus on every node of a network.
+
+    Args:
+        neighbors (list): ``neighbors[i]`` is the set of neighbors of node ``i``
+        values (ndarray): The starting values, ``values[i]`` belongs to node ``i``
+        tc (int): Number of consensus iterations
+        weights (list): ``weights[i]`` maps each neighbor of node ``i`` to its weight.
+         Defaults to ``metropolis_weights(neighbors)``.
+        processes (int): Number of processes to split the nodes over
+        codec (obj): Encodes the data for the wire, see ``nettools.ArrayCodec``
+
+    Returns:
+        dict: ``x``, the final values in node order, ``disagreement``, the largest distance
+        of any node to the average before every round and after the last one, and
+        ``round_time``, the seconds every round took (in the slowest process).
+    '''
+    if weights is None:
+        weights = metropolis_weights(neighbors)
+    values = np.asarray(values, dtype=np.float64)
+    average = values.mean(axis=0)
+    num = len(neighbors)
+    processes = max(1, min(processes, num))
+    bounds = [num * k // processes for k in range(processes + 1)]
+    if processes == 1:
+        results = [_run_shard(0, bounds, neighbors, weights, values, tc, average, codec)]
+    else:
+        results = _run_pool(bounds, neighbors, weights, values, tc, average, codec)
+    return {
+        'x': np.concatenate([r[0] for r in results]),
+        'disagreement': np.max([r[1] for r in results], axis=0).tolist(),
+        'round_time': np.max([r[2] for r in results], axis=0).tolist(),
+    }
+
+
+class CSRMatrix(object):
+    '''A square sparse matrix in compressed sparse row form.
+
+    Row ``i`` holds the values ``data[indptr[i]:indptr[i + 1]]`` in the columns
+    ``indices[indptr[i]:indptr[i + 1]]``.
+
+    Args:
+        indptr (ndarray): Start of every row in ``indices`` and ``data``, plus the end
+        indices (ndarray): Column of every stored value
+        data (ndarray): The stored values
+    '''
+
+    def __init__(self, indptr, indices, data):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.data = np.asarray(data, dtype=np.float64)
+        self.shape = (len(self.indptr) - 1, len(self.indptr) - 1)
+        self._filled = np.diff(self.indptr) > 0
+
+    def dot(self, x):
+        '''Multiply with a vector, or with every column of a matrix.
+
+        Args:
+            x (ndarray): ``shape[0]`` rows
+
+        Returns:
+            ndarray: The product, the same shape as ``x``
+        '''
+        x = np.asarray(x, dtype=np.float64)
+        prod = self.data.reshape((-1,) + (1,) * (x.ndim - 1)) * x[self.indices]
+        out = np.zeros_like(x)
+        if len(prod) > 0:
+            out[self._filled] = np.add.reduceat(prod, self.indptr[:-1][self._filled], axis=0)
+        return out
+
+    def toarray(self):
+        '''The matrix as a dense ndarray'''
+        out = np.zeros(self.shape)
+        rows = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        out[rows, self.indices] = self.data
+        return out
+
+
+def weight_matrix(neighbors, weights=None):
+    '''Build the network's weight matrix ``W``, in which one consensus round is ``W x``.
+
+    Args:
+        neighbors (list): ``neighbors[i]`` is the set of neighbors of node ``i``
+        weights (list): ``weights[i]`` maps each neighbor of node ``i`` to its weight.
+         Defaults to ``metropolis_weights(neighbors)``.
+
+    Returns:
+        CSRMatrix: ``W``, with every node's own weight on the diagonal
+    '''
+    num = len(neighbors)
+    deg = np.array([len(n) for n in neighbors], dtype=np.int64)
+    rows = np.repeat(np.arange(num), deg)
+    cols = np.fromiter(itertools.chain.from_iterable(sorted(n) for n in neighbors),
+                       dtype=np.int64, count=int(deg.sum()))
+    if weights is None:
+        vals = 1 / (np.maximum(deg[rows], deg[cols]) + 1)
+    else:
+        vals = np.fromiter((weights[i][j] for i, j in zip(rows.tolist(), cols.tolist())),
+                           dtype=np.float64, count=len(rows))
+    diag = 1 - np.bincount(rows, vals, num)
+    rows = np.concatenate([rows, np.arange(num)])
+    cols = np.concatenate([cols, np.arange(num)])
+    vals = np.concatenate([vals, diag])
+    order = np.lexsort((cols, rows))
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(rows, minlength=num))])
+    return CSRMatrix(indptr, cols[order], vals[order])
+
+
+def second_eigenvalue(matrix, iterations=500, tol=1e-9, seed=0, residual=False):
+    '''Estimate the second largest eigenvalue modulus of a symmetric, doubly stochastic matrix.
+
+    The all ones vector is the eigenvector of eigenvalue one, so it is projected out and the
+    largest modulus left is the one sought. Plain power iteration needs thousands of steps on
+    large graphs, so this runs the Lanczos recurrence, which refines the same power sequence,
+    and reads the extreme eigenvalues off its small tridiagonal matrix. This is the sparse
+    counterpart of ``weights.second_eigenvalue``.
+
+    Args:
+        matrix (CSRMatrix): The weight matrix
+        iterations (int): Most multiplications to spend
+        tol (float): Stop once the estimate changes less than this
+        seed (int): Seed of the starting vector
+        residual (bool): Also return the residual norm of the estimate. ``W`` has an
+         eigenvalue within that distance of the estimate, so adding it gives a safer upper
+         bound.
+
+    Returns:
+        float: The estimate. It never exceeds the true value. With ``residual`` a tuple
+        ``(estimate, residual)``.
+    '''
+    num = matrix.shape[0]
+    if num < 2:
+        return (0.0, 0.0) if residual else 0.0
+
+    def ritz_max():
+        return ritz()[0]
+
+    def ritz():
+        # The largest Ritz value and beta_k times the last entry of its eigenvector
+        off = betas[:len(alphas) - 1]
+        tri = np.diag(alphas) + np.diag(off, 1) + np.diag(off, -1)
+        vals, vecs = np.linalg.eigh(tri)
+        top = int(np.argmax(np.abs(vals)))
+        return float(abs(vals[top])), abs(beta * float(vecs[-1, top]))
+
+    vec = np.random.RandomState(seed).randn(num)
+    vec -= vec.mean()
+    vec /= np.linalg.norm(vec)
+    prev = np.zeros(num)
+    alphas, betas = [], []
+    beta = 0.0
+    lam = 0.0
+    for k in range(min(iterations, num - 1)):
+        nxt = matrix.dot(vec)
+        nxt -= nxt.mean()
+        alpha = float(vec @ nxt)
+        nxt -= alpha * vec + beta * prev
+        alphas.append(alpha)
+        beta = float(np.linalg.norm(nxt))
+        if beta < tol:  # The vectors span an invariant subspace, so the estimate is exact
+            break
+        betas.append(beta)
+        prev, vec = vec, nxt / beta
+        if k % 10 == 9:
+            last, lam = lam, ritz_max()
+            if abs(lam - last) < tol:
+                break
+    else:
+        if iterations < num - 1:
+            logger.warning('Eigenvalue estimate did not settle after %s steps, %s may be low',
+                           iterations, ritz_max())
+    lam, res = ritz()
+    if residual:
+        return min(lam, 1.0), res
+    return min(lam, 1.0)
+
+
+def predict_iterations(values, lam, eps):
+    '''Rounds after which every node is within ``eps`` of the average.
+
+    ``||x(t) - avg|| <= lam^t ||x(0) - avg||`` for every column of the data, and no entry is
+    further from the average than the norm of its column. The result is only an upper bound
+    if ``lam`` is at least the true eigenvalue modulus. The Lanczos estimate of
+    ``second_eigenvalue`` can be low, which is why ``simulate_matrix`` adds its residual.
+
+    Args:
+        values (ndarray): The starting values
+        lam (float): Second largest eigenvalue modulus of the weight matrix, or an upper bound
+         on it
+        eps (float): Target distance to the average
+
+    Returns:
+        int: The number of rounds, or ``None`` if consensus never gets there
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    dev = values - values.mean(axis=0)
+    start = float(np.max(np.linalg.norm(dev.reshape(len(dev), -1), axis=0)))
+    if start < eps:
+        return 0
+    if lam >= 1:
+        return None
+    if lam <= 0:
+        return 1
+    return max(0, math.ceil(math.log(eps / start) / math.log(lam)))
+
+
+def simulate_matrix(neighbors, values, tc, weights=None, eps=None):
+    '''Compute ``tc`` rounds of iterative consensus as ``W^tc x``.
+
+    Gives the same values as ``simulate`` up to rounding, at a fraction of the cost.
+
+    Args:
+        neighbors (list): ``neighbors[i]`` is the set of neighbors of node ``i``
+        values (ndarray): The starting values, ``values[i]`` belongs to node ``i``
+        tc (int): Number of consensus iterations
+        weights (list): ``weights[i]`` maps each neighbor of node ``i`` to its weight.
+         Defaults to ``metropolis_weights(neighbors)``.
+        eps (float): Target distance to the average for ``predicted``
+
+    Returns:
+        dict: ``x`` and ``disagreement`` like ``simulate``, ``lambda``, the second largest
+        eigenvalue modulus of ``W``, ``spectral_gap``, ``1 - lambda``, and with ``eps``,
+        ``predicted``, see ``predict_iterations``. ``predicted`` uses ``lambda`` plus its
+        Lanczos residual, so it errs towards too many rounds.
+    '''
+    matrix = weight_matrix(neighbors, weights)
+    x = np.array(values, dtype=np.float64)
+    average = x.mean(axis=0)
+    disagreement = [float(np.max(np.abs(x - average)))]
+    for _ in range(tc):
+        x = matrix.dot(x)
+        disagreement.append(float(np.max(np.abs(x - average))))
+    lam, residual = second_eigenvalue(matrix, residual=True)
+    res = {'x': x, 'disagreement': disagreement, 'lambda': lam, 'spectral_gap': 1 - lam}
+    if eps is not None:
+        res['predicted'] = predict_iterations(values, min(lam + residual, 1.0), eps)
+    return res
+
+
+class _Remote(object):
+    '''Stands in for a node simulated by another process and collects the messages sent
+    to it'''
+
+    def __init__(self, addr, shard, outboxes):
+        self.addr = addr
+        self.shard = shard
+        self.outboxes = outboxes
+
+    def deliver(self, src, tg_int, data):
+        self.outboxes[self.shard].append((src, self.addr, tg_int, data))
+
+
+def _run_shard(shard, bounds, neighbors, weights, values, tc, average, codec, queues=None):
+    '''Simulate the nodes ``bounds[shard]`` to ``bounds[shard + 1] - 1``.
+
+    With ``queues`` the other shards run in other processes, and ``queues[k]`` carries the
+    messages for shard ``k``.
+
+    Returns:
+        tuple: the final values, the disagreement and the round times of this shard
+    '''
+    nodes = range(bounds[shard], bounds[shard + 1])
+    network = {}
+    comms = []
+    states = []
+    for i in nodes:
+        comm = LoopbackCommunicator(i, network, window=2)
+        comm.listen()
+        comms.append(comm)
+        states.append(iterative.ConsensusState(values[i], weights[i]))
+    outboxes = {}
+    if queues is not None:
+        outboxes = {k: [] for k in range(len(queues)) if k != shard}
+        for i in nodes:
+            for j in neighbors[i]:
+                if j not in network:
+                    owner = bisect.bisect_right(bounds, j) - 1
+                    network[j] = _Remote(j, owner, outboxes)
+    early = {}
+
+    def spread():
+        return max(float(np.max(np.abs(s.x - average))) for s in states)
+
+    disagreement = []
+    round_time = []
+    for rnd in range(tc):
+        disagreement.append(spread())
+        start = time.perf_counter()
+        tag = iterative.build_tag(TAG_ID, rnd)
+        for comm, state in zip(comms, states):
+            iterative.transmit(nettools.matrix_to_bytes(state.x, codec), tag,
+                               weights[comm.addr], comm)
+        if queues is not None:
+            _exchange(shard, rnd, queues, outboxes, early, network)
+        for comm, state in zip(comms, states):
+            data = iterative.receive(tag, weights[comm.addr], comm)
+            for j, payload in data.items():
+                if payload is None:
+                    raise RuntimeError('Node {} got no data from {}'.format(comm.addr, j))
+                state.load(j, nettools.matrix_from_bytes(payload, codec))
+            state.step()
+        round_time.append(time.perf_counter() - start)
+    disagreement.append(spread())
+    return np.array([s.x for s in states]), disagreement, round_time
+
+
+def _exchange(shard, rnd, queues, outboxes, early, network):
+    '''Send this round's messages to the other shards and deliver theirs'''
+    for k in list(outboxes):
+        queues[k].put((rnd, outboxes[k]))
+        outboxes[k] = []
+    batches = early.pop(rnd, [])
+    while len(batches) < len(outboxes):
+        batch_rnd, batch = queues[shard].get()
+        if batch_rnd == rnd:
+            batches.append(batch)
+        else:  # A faster shard is already a round ahead
+            early.setdefault(batch_rnd, []).append(batch)
+    for batch in batches:
+        for src, dst, tg_int, data in batch:
+            network[dst].deliver(src, tg_int, data)
+
+
+def _shard_main(shard, bounds, neighbors, weights, values, tc, average, codec, queues, results):
+    try:
+        results.put((shard, _run_shard(shard, bounds, neighbors, weights, values, tc, average,
+                                       codec, queues)))
+    except BaseException as err:  # pylint: disable=broad-except
+        results.put((shard, err))
+
+
+def _run_pool(bounds, neighbors, weights, values, tc, average, codec):
+    '''Run every shard in its own process'''
+    methods = multiprocessing.get_all_start_methods()
+    # Forked workers share the graph with the parent instead of unpickling it
+    ctx = multiprocessing.get_context('fork' if 'fork' in methods else None)
+    shards = len(bounds) - 1
+    queues = [ctx.Queue() for _ in range(shards)]
+    results = ctx.Queue()
+    procs = [ctx.Process(target=_shard_main, args=(k, bounds, neighbors, weights, values, tc,
+                                                   average, codec, queues, results))
+             for k in range(shards)]
+    for proc in procs:
+        proc.start()
+    out = [None] * shards
+    try:
+        for _ in range(shards):
+            shard, res = results.get()
+            if isinstance(res, BaseException):
+                raise res
+            out[shard] = res
+    finally:
+        for proc in procs:
+            if out[procs.index(proc)] is None:
+                proc.terminate()
+            proc.join()
+    return out
+
+
+def rounds_to_eps(disagreement, eps):
+    '''First round after which every node was within ``eps`` of the average, or ``None``'''
+    for rnd, dis in enumerate(disagreement):
+        if dis < eps:
+            return rnd
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--graph', default='random',
+                        help='one of {} or a config file with a [graph] section'.format(GRAPHS))
+    parser.add_argument('--nodes', type=int, default=1000)
+    parser.add_argument('--degree', type=int, default=4)
+    parser.add_argument('--rounds', type=int, default=50, help='iterations per run')
+    parser.add_argument('--size', type=int, default=1, help='length of the data vectors')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--eps', type=float, default=1e-3, help='target distance to average')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--matrix', action='store_true',
+                        help='multiply by the weight matrix instead of passing messages')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    if args.graph in GRAPHS:
+        neighbors = generate_graph(args.graph, args.nodes, args.degree, args.seed)
+    else:
+        neighbors = load_graph(args.graph)
+    rng = np.random.RandomState(args.seed)
+    values = rng.rand(len(neighbors), args.size) * 100
+    start = time.perf_counter()
+    if args.matrix:
+        res = simulate_matrix(neighbors, values, args.rounds, eps=args.eps)
+    else:
+        res = simulate(neighbors, values, args.rounds, processes=args.processes)
+    total = time.perf_counter() - start
+
+    edges = sum(len(n) for n in neighbors) // 2
+    if args.matrix:
+        print('nodes {} edges {} lambda {:.6f} spectral gap {:.6g}'.format(
+            len(neighbors), edges, res['lambda'], res['spectral_gap']))
+        print('{:>6} {:>14}'.format('round', 'disagreement'))
+        step = max(1, args.rounds // 10)
+        for rnd in range(0, args.rounds + 1, step):
+            print('{:>6} {:>14.6g}'.format(rnd, res['disagreement'][rnd]))
+        reached = rounds_to_eps(res['disagreement'], args.eps)
+        print('rounds to eps: {} predicted at most: {}'.format(
+            '-' if reached is None else reached,
+            '-' if res['predicted'] is None else res['predicted']))
+        print('total {:.2f} s'.format(total))
+        return
+    print('nodes {} edges {} processes {}'.format(len(neighbors), edges, args.processes))
+    print('{:>6} {:>14} {:>10}'.format('round', 'disagreement', 'seconds'))
+    step = max(1, args.rounds // 10)
+    for rnd in range(0, args.rounds, step):
+        print('{:>6} {:>14.6g} {:>10.4f}'.format(rnd, res['disagreement'][rnd],
+                                                 res['round_time'][rnd]))
+    print('{:>6} {:>14.6g}'.format(args.rounds, res['disagreement'][-1]))
+    reached = rounds_to_eps(res['disagreement'], args.eps)
+    print('rounds to eps: {}'.format('-' if reached is None else reached))
+    print('mean round {:.4f} s, total {:.2f} s'.format(np.mean(res['round_time']), total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#! /usr/bin/env python3
+'''Compare plain, corrective and accelerated corrective consensus on the graphs of the config
+files.
+
+Every node runs in its own thread and talks through an in-memory communicator, so the numbers
+measure the algorithms and not the network. For each run the table shows the number of rounds
+and the wall-clock time until every node is within ``eps`` of the true average, and the total
+time of the run.
+
+    python3 benchmark.py params.conf params2.conf --rounds 200 --eps 1e-6 --loss 0.01
+'''
+import argparse
+import logging
+import random
+import threading
+import time
+from configparser import ConfigParser
+import numpy as np
+import adac.nettools as nettools
+from adac.communicator import LoopbackCommunicator, check_tag
+from adac.consensus import corrective, iterative, weights
+
+TAG_ID = 1
+
+
+class TraceCommunicator(LoopbackCommunicator):
+    '''Loses messages with probability ``loss`` and records every value this node
+    transmits'''
+
+    def __init__(self, addr, network, loss=0.0, seed=0):
+        super().__init__(addr, network)
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.trace = []
+        self.listen()
+
+    def broadcast(self, addrs, data, tag):
+        tag = check_tag(tag)
+        if tag[0] == TAG_ID:
+            num = int.from_bytes(tag[1:], byteorder='little')
+            self.trace.append((num, time.perf_counter(), nettools.matrix_from_bytes(data)))
+        super().broadcast(addrs, data, tag)
+
+    def send(self, addr, data, tag):
+        if self.random.random() < self.loss:
+            return True
+        return super().send(addr, data, tag)
+
+
+def load_graph(config):
+    '''Read the adjacency matrix from a config file'''
+    con = ConfigParser()
+    con.read(config)
+    return weights.parse_edges(con['graph']['edges'])
+
+
+def simulate(w_mat, values, target, loss, seed):
+    '''Run ``target`` on every node. Returns the results, the communicators and the start and
+    end times'''
+    network = {}
+    num = len(w_mat)
+    comms = [TraceCommunicator(i, network, loss, seed + i) for i in range(num)]
+    results = [None] * num
+
+    def node(i):
+        neigh = {j: w_mat[i][j] for j in range(num) if j != i and w_mat[i][j] > 0}
+        results[i] = target(values[i], neigh, comms[i])
+
+    thds = [threading.Thread(target=node, args=(i,)) for i in range(num)]
+    start = time.perf_counter()
+    for thd in thds:
+        thd.start()
+    for thd in thds:
+        thd.join()
+    return results, comms, start, time.perf_counter()
+
+
+def rounds_to_eps(comms, average, eps, start):
+    '''Find the first round in which every node was within ``eps`` of the average.
+
+    Returns:
+            tuple: the round and the seconds it took to get there, or ``(None, None)``
+    '''
+    traces = [dict((num, (stamp, x)) for num, stamp, x in c.trace) for c in comms]
+    rounds = set.intersection(*(set(t.keys()) for t in traces))
+    for num in sorted(rounds):
+        if all(np.max(np.abs(t[num][1] - average)) < eps for t in traces):
+            return num, max(t[num][0] for t in traces) - start
+    return None, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('configs', nargs='*', default=['params.conf', 'params2.conf'])
+    parser.add_argument('--rounds', type=int, default=200, help='iterations per run')
+    parser.add_argument('--eps', type=float, default=1e-6, help='target distance to average')
+    parser.add_argument('--size', type=int, default=1000, help='length of the data vectors')
+    parser.add_argument('--period', type=int, default=10, help='rounds between corrections')
+    parser.add_argument('--loss', type=float, default=0.0, help='message loss probability')
+    parser.add_argument('--timeout', type=float, default=0.05,
+                        help='seconds to wait on a neighbor when --loss is set')
+    parser.add_argument('--weights', choices=['metropolis', 'fastest'], default='metropolis',
+                        help='weight matrix the nodes use')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    if args.loss > 0:
+        iterative.TIMEOUT = args.timeout
+
+    print('{:<14} {:<12} {:>8} {:>10} {:>10} {:>10}'.format(
+        'config', 'algorithm', 'beta', 'rounds', 'to eps s', 'total s'))
+    for config in args.configs:
+        edges = load_graph(config)
+        if args.weights == 'fastest':
+            w_mat = weights.fastest_mixing_matrix(edges)
+        else:
+            w_mat = weights.metropolis_matrix(edges)
+        beta = weights.optimal_beta(w_mat)
+        rng = np.random.RandomState(args.seed)
+        values = [rng.rand(args.size) * 100 for _ in edges]
+        average = np.mean(values, axis=0)
+        runs = [
+            ('iterative', 1.0, lambda x, n, c: iterative.run(x, args.rounds, TAG_ID, n, c)),
+            ('corrective', 1.0, lambda x, n, c: corrective.run(
+                x, args.rounds, TAG_ID, n, c, period=args.period)),
+            ('accelerated', beta, lambda x, n, c: corrective.run(
+                x, args.rounds, TAG_ID, n, c, beta=beta, period=args.period)),
+        ]
+        for name, b, target in runs:
+            results, comms, start, end = simulate(w_mat, values, target, args.loss, args.seed)
+            if any(r is None for r in results):
+                print('{:<14} {:<12} {:>8.4f} {:>10}'.format(config, name, b, 'failed'))
+                continue
+            num, secs = rounds_to_eps(comms, average, args.eps, start)
+            print('{:<14} {:<12} {:>8.4f} {:>10} {:>10} {:>10.3f}'.format(
+                config, name, b, '-' if num is None else num,
+                '-' if secs is None else '{:.3f}'.format(secs), end - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import random
 import struct
@@ -9,11 +10,30 @@ import struct
 from unittest.mock import MagicMock, patch
 
 from adac import communicator as comm
-from adac.communicator import TCPCommunicator
+from adac.communicator import LoopbackCommunicator, ShmCommunicator, ShmRing, TCPCommunicator
 from adac.communicator import UDPCommunicator as Communicator
 # from communicator import Communicator
 
 
+def recv_into(chunks):
+    '''Build a fake ``socket.recv_into`` which copies the next chunk into the given buffer.
+    ``chunks`` is either a list of bytes objects or a function of the requested size.'''
+    pending = list(chunks) if isinstance(chunks, list) else None
+
+    def _recv_into(buf, nbytes=0):
+        nbytes = nbytes or len(buf)
+        if pending is None:
+            chunk = chunks(nbytes)[:nbytes]
+        else:
+            chunk = pending[0][:nbytes]
+            pending[0] = pending[0][nbytes:]
+            if len(pending[0]) == 0:
+                pending.pop(0)
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+    return _recv_into
+
+
 class TestCommModuleMethods(unittest.TestCase):
 
     def test_get_mtu(self):
@@ -101,14 +121,13 @@ class TestCommunicator(unittest.TestCase):
         r = bytes() # total data bytes
         t = bytes()
         for packet in packs:
-            r += packet[8:]
+            r += packet[comm.HEADER_SIZE:]
             t += packet
 
         self.assertEqual(len(d), len(r))
-        self.assertEqual(len(d), len(t) - 8*len(packs))
+        self.assertEqual(len(d), len(t) - comm.HEADER_SIZE*len(packs))
         for i in range(len(packs)):
-            seq = struct.unpack('H', packs[i][2:4])[0]
-            t = struct.unpack('H', packs[i][0:2])[0]
+            seq, t = comm.parse_meta_packet(packs[i])[0:2]
             self.assertEqual(seq, i)
             self.assertEqual(t, len(packs) - 1)
         comm1.close()
@@ -118,12 +137,13 @@ class TestCommunicator(unittest.TestCase):
         d = []
         for i in range(122): # Exactly 500 bytes
             d.append(i)
-        d = str(d).encode('utf-8')
+        d = str(d).encode('utf-8')[:comm.get_mtu() - 68 - comm.HEADER_SIZE]
         d = comm1.create_packets(d, '1111'.encode('utf-8'))
         self.assertEqual(len(d), 1, 'Should have only created a single packet')
-        self.assertEqual('1111'.encode('utf-8'), d[0][4:8])
-        self.assertEqual(0, struct.unpack('H', d[0][0:2])[0])
-        self.assertEqual(0, struct.unpack('H', d[0][2:4])[0])
+        seq, total, tag, flags, group = comm.parse_meta_packet(d[0])
+        self.assertEqual(int.from_bytes('1111'.encode('utf-8'), byteorder='little'), tag)
+        self.assertEqual(0, total)
+        self.assertEqual(0, seq)
         comm1.close()
 
     def test_close_ops(self):
@@ -186,29 +206,60 @@ class TestCommunicator(unittest.TestCase):
         self.assertEqual(l, r, 'Reassembled bytes should be the same.')
         comm1.close()
 
-    @patch('socket.socket.recvfrom')
-    def test_mock_listen(self, mock1):
+    def test_mock_listen(self):
         l = str(list(range(20))).encode('utf-8')
-        d = struct.pack('H', 0)
-        d += d
-        d += 'test'.encode('utf-8')
+        d = bytes(comm.build_meta_packet(0, 0, 'test'.encode('utf-8')))
         d += l
-        mock1.return_value = (d, ('127.0.0.1', 9071))
         comm1 = Communicator(9071)
         comm1.listen()
         self.assertNotEqual(comm1.listen_thread, None)
         self.assertEqual(comm1.is_listening, True)
-        comm1.receive = MagicMock()
+        received = []
+        comm1.receive = MagicMock(side_effect=lambda data, addr: received.append((bytes(data), addr)))
+        time.sleep(0.1)  # The listener thread binds the socket
         comm1.send('127.0.0.1', l, 'test'.encode('utf-8'))
 
         # Give some time for the other thread to run before checking conditions
         ctr = 0
-        while mock1.called != True and comm1.receive.called != True and ctr < 20:
+        while comm1.receive.called != True and ctr < 20:
             time.sleep(0.1)
+            ctr += 1
 
-        mock1.assert_called_with(1024)
         comm1.close()
-        comm1.receive.assert_called_with(d, '127.0.0.1')
+        self.assertEqual(received, [(d, '127.0.0.1')])
+        self.assertEqual(comm1.listen_thread, None)
+
+    def test_listen_idle(self):
+        '''The listener sleeps in select instead of polling the socket'''
+        comm1 = Communicator(9071)
+        with patch('socket.socket.recvfrom_into', side_effect=BlockingIOError) as mock1:
+            comm1.listen()
+            time.sleep(0.2)
+            self.assertEqual(mock1.call_count, 0)
+            comm1.close()
+        self.assertEqual(comm1.listen_thread, None)
+
+    def test_callback_error(self):
+        '''An exception while handling one datagram does not stop the listener'''
+        comm1 = Communicator(9072)
+        self.addCleanup(comm1.close)
+
+        def bad_callback(addr, tag, data):
+            if bytes(data) == b'bad':
+                raise ValueError('bad data')
+        comm1.register_recv_callback(bad_callback)
+        comm1.listen()
+        time.sleep(0.1)
+        comm1.send('127.0.0.1', b'bad', b'bad1')
+        self.assertEqual(comm1.get('127.0.0.1', b'bad1', timeout=5), b'bad')
+        with patch.object(comm1, '_handle_nack', side_effect=RuntimeError('broken')):
+            pkt = comm.build_meta_packet(0, 1, b'nack', comm.FLAG_NACK) + b'\x00'
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as _sock:
+                _sock.sendto(pkt, ('127.0.0.1', 9072))
+            time.sleep(0.1)
+        comm1.send('127.0.0.1', b'good', b'good')
+        self.assertEqual(comm1.get('127.0.0.1', b'good', timeout=5), b'good')
+        self.assertTrue(comm1.listen_thread.is_alive())
 
     def test_same_tag_send(self):
 
@@ -237,6 +288,16 @@ class TestCommunicator(unittest.TestCase):
         self.assertNotEqual(s2, s, "Should not be able to retrieve the same data again")
         comm1.close()
 
+    @patch('socket.socket.sendto', return_value=5)
+    def test_udp_broadcast(self, mock1):
+        comm1 = Communicator(10001)
+        l = str(list(range(1000))).encode('utf-8')
+        mtu = min(comm1.path_mtu('10.0.0.1'), comm1.path_mtu('10.0.0.2'))
+        n_packets = len(comm1.create_packets(l, 'big_'.encode('utf-8'), mtu))
+        self.assertEqual(comm1.broadcast(['10.0.0.1', '10.0.0.2'], l, 'big_'.encode('utf-8')), True)
+        self.assertEqual(mock1.call_count, 2 * n_packets)
+        comm1.close()
+
     def test_register_callback(self):
         def cbk(a, b, c):
             return "callback"
@@ -252,7 +313,240 @@ class TestCommunicator(unittest.TestCase):
         # Should raise error on bad function signature
         with self.assertRaises(ValueError):
             comm1.register_recv_callback(bck)
+        # Bound methods should not count self
+        class Holder(object):
+            def cbk(self, a, b, c):
+                return "callback"
+        comm1.register_recv_callback(Holder().cbk)
+
+        comm1.close()
+
+    def test_blocking_get(self):
+        '''get() with a timeout should sleep until receive() stores the data'''
+        comm1 = Communicator(9071)
+        msg = 'blocking'.encode('utf-8')
+        pkts = comm1.create_packets(msg, 'blck'.encode('utf-8'))
+        timer = threading.Timer(0.1, lambda: [comm1.receive(p, 'local') for p in pkts])
+        timer.start()
+        self.assertEqual(comm1.get('local', 'blck'.encode('utf-8'), timeout=5), msg)
+        self.assertEqual(comm1.get('local', 'blck'.encode('utf-8'), timeout=0.05), None)
+        timer.join()
+        comm1.close()
+
+    def test_wait_any_all(self):
+        comm1 = Communicator(9071)
+        tag = 'wait'.encode('utf-8')
+        for pkt in comm1.create_packets(b'two', tag):
+            comm1.receive(pkt, 'local2')
+        self.assertEqual(comm1.wait_any(['local1', 'local2'], tag, timeout=1), ('local2', b'two'))
+        self.assertEqual(comm1.wait_any(['local1', 'local2'], tag, timeout=0.05), (None, None))
+        for pkt in comm1.create_packets(b'zero', tag):
+            comm1.receive(pkt, 0)
+        self.assertEqual(comm1.wait_any(['local1', 0], tag, timeout=0), (0, b'zero'))
+
+        for pkt in comm1.create_packets(b'one', tag):
+            comm1.receive(pkt, 'local1')
+        data = comm1.wait_all(['local1', 'local2'], tag, timeout=0.05)
+        self.assertEqual(data, {'local1': b'one', 'local2': None})
 
+        timer = threading.Timer(0.1, lambda: [comm1.receive(p, addr)
+                                              for addr in ['local1', 'local2']
+                                              for p in comm1.create_packets(b'x', tag)])
+        timer.start()
+        data = comm1.wait_all(['local1', 'local2'], tag, timeout=5)
+        self.assertEqual(data, {'local1': b'x', 'local2': b'x'})
+        timer.join()
+        comm1.close()
+
+    def test_data_store(self):
+        store = comm.DataStore()
+        store.put('a', 1, b'x')
+        self.assertEqual(store.take('a', 1), b'x')
+        self.assertEqual(store.take('a', 1), None)
+        self.assertEqual(len(store), 0)
+        self.assertEqual(store.entries, {}, 'Taken entries should be deleted')
+
+    def test_data_store_window(self):
+        tag = lambda run, num: run + (num << 8)
+        store = comm.DataStore(window=4)
+        for num in range(10):
+            self.assertTrue(store.put('a', tag(1, num), num))
+        self.assertEqual(len(store), 4)
+        self.assertEqual(store.dropped, 6)
+        self.assertEqual(store.peek('a', tag(1, 5)), None)
+        self.assertEqual(store.take('a', tag(1, 6)), 6)
+
+        self.assertFalse(store.put('a', tag(1, 2), 2), 'Too old for the window')
+        self.assertEqual(store.late, 1)
+        self.assertTrue(store.is_stale('a', tag(1, 5)))
+        self.assertFalse(store.is_stale('a', tag(1, 6)))
+        self.assertTrue(store.put('a', tag(2, 0), 'other run'))
+        self.assertTrue(store.put('b', tag(1, 0), 'other sender'))
+        self.assertEqual(store.take('a', tag(2, 0)), 'other run')
+
+        # Iterations wrap around at 2**24 like build_tag
+        store.put('c', tag(1, 2**24 - 1), 'last')
+        store.put('c', tag(1, 0), 'first')
+        self.assertEqual(store.take('c', tag(1, 2**24 - 1)), 'last')
+        with self.assertRaises(ValueError):
+            comm.DataStore(window=0)
+
+    def test_udp_window(self):
+        '''Partial messages are evicted once their iteration leaves the window'''
+        comm1 = Communicator(9071, window=2)
+        tag = lambda num: (1 + (num << 8)).to_bytes(4, byteorder='little')
+        pkts = comm1.create_packets(b'x' * 2000, tag(0))
+        comm1.receive(pkts[0], 'local')
+        self.assertEqual(len(comm1.tmp_data['local']), 1)
+        for num in range(1, 4):
+            for pkt in comm1.create_packets(b'y', tag(num)):
+                comm1.receive(pkt, 'local')
+        self.assertEqual(len(comm1.tmp_data['local']), 0)
+        self.assertEqual(comm1.data_store.dropped, 2)
+        comm1.receive(pkts[1], 'local')
+        self.assertEqual(comm1.data_store.late, 1)
+        self.assertEqual(comm1.get('local', tag(3)), b'y')
+        comm1.close()
+
+    def test_nack_packet(self):
+        tag = 'nack'.encode('utf-8')
+        pkt = comm.build_nack([3, 4, 9, 40], tag)
+        self.assertEqual(comm.parse_meta_packet(pkt)[3], comm.FLAG_NACK)
+        self.assertEqual(comm.parse_meta_packet(pkt)[2], int.from_bytes(tag, byteorder='little'))
+        self.assertEqual(comm.parse_nack(pkt[comm.HEADER_SIZE:]), [3, 4, 9, 40])
+
+    def test_udp_nack(self):
+        '''A receiver asks for a lost packet and the sender sends it again'''
+        sender = Communicator(9071, reliable=True)
+        receiver = Communicator(9072, reliable=True)
+        tag = 'rlbl'.encode('utf-8')
+        msg = bytes(range(256)) * 20
+        sent = []
+        with patch('socket.socket.sendto', side_effect=lambda p, a: sent.append(p) or len(p)):
+            sender.send('10.0.0.2', msg, tag)
+            pkts = list(sent)
+            self.assertGreater(len(pkts), 2)
+            for pkt in pkts[:1] + pkts[2:]:
+                receiver.receive(pkt, '10.0.0.1')
+            self.assertEqual(receiver.get('10.0.0.1', tag), None)
+
+            sent.clear()
+            receiver._check_missing(now=time.monotonic() + 1)
+            self.assertEqual(len(sent), 1)
+            nack = sent.pop()
+            receiver._check_missing(now=time.monotonic() + 1)
+            self.assertEqual(len(sent), 0, 'Should wait nack_delay before asking again')
+
+            sender.receive(nack, '10.0.0.2')
+            self.assertEqual(sent, [pkts[1]])
+            receiver.receive(sent[0], '10.0.0.1')
+            self.assertEqual(receiver.get('10.0.0.1', tag), msg)
+
+            # Late duplicates of the completed message are ignored
+            receiver.receive(pkts[0], '10.0.0.1')
+            self.assertEqual(receiver.tmp_data['10.0.0.1'], {})
+
+            # A message which never completes is given up on after max_nacks
+            tag = 'lost'.encode('utf-8')
+            sent.clear()
+            sender.send('10.0.0.2', msg, tag)
+            receiver.receive(sent[0], '10.0.0.1')
+            sent.clear()
+            later = time.monotonic() + 1
+            for _ in range(receiver.max_nacks + 1):
+                later += 1
+                receiver._check_missing(now=later)
+            self.assertEqual(len(sent), receiver.max_nacks)
+            self.assertEqual(receiver.tmp_data['10.0.0.1'], {}, 'Dead message should be freed')
+            self.assertEqual(receiver.data_store.dropped, 1)
+        sender.close()
+        receiver.close()
+
+    def test_fec(self):
+        '''One lost packet per group is rebuilt from the parity packet'''
+        comm1 = Communicator(9071, fec=4)
+        tag = 'fec_'.encode('utf-8')
+        msg = bytes(random.getrandbits(8) for _ in range(3000))
+        pkts = comm1.create_packets(msg, tag)
+        parity = [p for p in pkts if comm.parse_meta_packet(p)[3] & comm.FLAG_PARITY]
+        self.assertEqual(len(parity), 2, '7 data packets make 2 groups')
+
+        # Lose the first packet of the first group and the short last packet
+        for pkt in pkts[1:-2] + pkts[-1:]:
+            comm1.receive(pkt, 'local')
+        self.assertEqual(comm1.get('local', tag), msg)
+        self.assertEqual(comm1.recovered, 2)
+
+        # Two losses in one group cannot be rebuilt
+        tag = 'fec2'.encode('utf-8')
+        pkts = comm1.create_packets(msg, tag)
+        for pkt in pkts[2:]:
+            comm1.receive(pkt, 'local')
+        self.assertEqual(comm1.get('local', tag), None)
+        with self.assertRaises(ValueError):
+            Communicator(9071, fec=256)
+        comm1.close()
+
+    def test_multicast_broadcast(self):
+        '''A broadcast goes out once to the run's group'''
+        self.assertEqual(comm.multicast_group('239.255.77.0', 1), '239.255.77.1')
+        self.assertEqual(comm.multicast_group('239.255.77.255', 1), '239.255.78.0')
+        comm1 = Communicator(9071, multicast='239.255.77.0')
+        comm1.mtus['239.255.77.1'] = 576
+        addrs = ['10.0.0.{}'.format(i) for i in range(2, 7)]
+        msg = bytes(2000)
+        tag = b'\x01\x00\x00\x00'
+        n_packets = len(comm1.create_packets(msg, tag))
+        with patch('socket.socket.sendto', return_value=5) as mock1:
+            self.assertTrue(comm1.broadcast(addrs, msg, tag))
+            self.assertEqual(mock1.call_count, n_packets)
+            self.assertEqual({c[0][1] for c in mock1.call_args_list}, {('239.255.77.1', 9071)})
+            comm1.broadcast(addrs[:1], msg, tag)
+            self.assertEqual(mock1.call_args[0][1], ('10.0.0.2', 9071), 'Single address is unicast')
+        with self.assertRaises(RuntimeError):
+            Communicator(9071).join(1)
+        comm1.close()
+
+    def test_multicast_loopback(self):
+        comm1 = Communicator(9073, multicast='239.255.77.0')
+        comm1.join(1)
+        comm1.listen()
+        time.sleep(0.1)
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.connect(('239.255.77.1', 9073))
+        local = probe.getsockname()[0]
+        probe.close()
+
+        tag = b'\x01\x00\x00\x00'
+        comm1.filter_sources(['10.0.0.2'])
+        comm1.broadcast(['10.0.0.2', '10.0.0.3'], b'filtered', tag)
+        self.assertEqual(comm1.get(local, tag, timeout=0.2), None)
+        comm1.filter_sources([local])
+        comm1.broadcast(['10.0.0.2', '10.0.0.3'], b'multicast', tag)
+        self.assertEqual(comm1.get(local, tag, timeout=2), b'multicast')
+        comm1.close()
+
+    def test_path_mtu(self):
+        comm1 = Communicator(9071, max_mtu=1500)
+        self.assertEqual(comm1.path_mtu('127.0.0.1'), 1500, 'Loopback is capped at max_mtu')
+        self.assertEqual(comm1.path_mtu('no.such.host.invalid'), comm.get_mtu())
+        comm1.mtus['10.0.0.1'] = 1500
+        self.assertEqual(comm1.path_mtu('10.0.0.1'), 1500)
+
+        msg = bytes(5000)
+        small = comm1.create_packets(msg, 'mtu_'.encode('utf-8'))
+        large = comm1.create_packets(msg, 'mtu_'.encode('utf-8'), 1500)
+        self.assertEqual(len(small), 11)
+        self.assertEqual(len(large), 4)
+        self.assertTrue(all(len(p) <= 1500 - 68 for p in large))
+        for pkt in large:
+            comm1.receive(pkt, 'local')
+        self.assertEqual(comm1.get('local', 'mtu_'.encode('utf-8')), msg)
+
+        # Probes are dropped
+        comm1.receive(comm.build_meta_packet(0, 0, 'prb_'.encode('utf-8'), comm.FLAG_PROBE),
+                      'local')
+        self.assertEqual(comm1.tmp_data['local'], {})
         comm1.close()
 
 class TCPCommTest(unittest.TestCase):
@@ -277,21 +571,25 @@ class TCPCommTest(unittest.TestCase):
         self.assertNotEqual(comm1.is_listening, True)
         self.assertEqual(comm1.listen_thread, None)
 
-    @patch('socket.socket.accept', return_value=(MagicMock(), ('127.0.0.1', 1234)))
-    @patch('adac.communicator.TCPCommunicator._run_connect', return_value=-1)
-    def test_run_tcp(self, mock_conn, mock_sock):
-        '''Make sure that we create all of our threads'''
+    def test_run_tcp(self):
+        '''Make sure the reactor accepts connections and reads framed messages'''
+        n_threads = threading.active_count()
         comm1 = TCPCommunicator(8998)
         comm1.listen()
-        # comm1.is_listening = True
-        # thd = threading.Thread(target=comm1.__run_tcp__,
-        #                        args=(comm1.listen_sock, '0.0.0.0', comm1.listen_port))
-        # thd.start()
-        time.sleep(0.1)
-        comm1.is_listening = False
-        self.assertTrue(mock_sock.called)
-        self.assertTrue(mock_conn.called)
-        self.assertTrue(isinstance(comm1.connections['127.0.0.1'], MagicMock))
+        comm2 = TCPCommunicator(8998)
+        data = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'.encode('utf-8')
+        comm2.send('127.0.0.1', data, 'tcp1'.encode('utf-8'))
+        comm2.send('127.0.0.1', data * 1000, 'tcp2'.encode('utf-8'))
+        ctr = 0
+        while comm1.get('127.0.0.1', 'tcp2'.encode('utf-8')) is None and ctr < 20:
+            time.sleep(0.1)
+            ctr += 1
+        self.assertLess(ctr, 20, 'Large message should have been received')
+        self.assertEqual(comm1.get('127.0.0.1', 'tcp1'.encode('utf-8')), data)
+        self.assertTrue(isinstance(comm1.connections['127.0.0.1'], socket.socket))
+        self.assertEqual(threading.active_count(), n_threads + 1,
+                         'Only the reactor thread should be added')
+        comm2.close()
         comm1.close()
 
     # @patch('socket.socket.recv',
@@ -311,6 +609,96 @@ class TCPCommTest(unittest.TestCase):
     #     self.assertTrue('127.0.0.1' not in comm1.connections)
     #     comm1.close()
 
+    def test_listen_bind_error(self):
+        '''A failed bind should be raised from listen() and leave the object reusable'''
+        comm1 = TCPCommunicator(8996)
+        self.addCleanup(comm1.close)
+        comm1.listen()
+        comm2 = TCPCommunicator(8996)
+        self.addCleanup(comm2.close)
+        with patch('socket.socket.bind', side_effect=OSError('Address already in use')):
+            with self.assertRaises(OSError):
+                comm2.listen()
+        self.assertEqual(comm2.listen_thread, None)
+        self.assertEqual(comm2.is_listening, False)
+
+    def test_callback_error(self):
+        '''An exception in the recv callback only drops the connection, not the reactor'''
+        comm1 = TCPCommunicator(8998)
+        self.addCleanup(comm1.close)
+        comm1.listen()
+
+        def bad_callback(addr, tag, data):
+            if bytes(data) == b'bad':
+                raise ValueError('bad data')
+        comm1.recv_callback = bad_callback
+        comm2 = TCPCommunicator(8998)
+        self.addCleanup(comm2.close)
+        comm2.send('127.0.0.1', b'bad', 'bad1'.encode('utf-8'))
+        ctr = 0
+        while comm1.get('127.0.0.1', 'bad1'.encode('utf-8')) is None and ctr < 50:
+            time.sleep(0.1)
+            ctr += 1
+        ctr = 0
+        while '127.0.0.1' in comm1.connections and ctr < 50:
+            time.sleep(0.1)
+            ctr += 1
+        self.assertNotIn('127.0.0.1', comm1.connections, 'Bad connection should be dropped')
+        comm3 = TCPCommunicator(8998)
+        self.addCleanup(comm3.close)
+        comm3.send('127.0.0.1', b'good', 'good'.encode('utf-8'))
+        self.assertEqual(comm1.get('127.0.0.1', 'good'.encode('utf-8'), timeout=5), b'good')
+        self.assertTrue(comm1.listen_thread.is_alive())
+
+    def test_broadcast(self):
+        '''Broadcast should frame the message once and send it to every address'''
+        comm1 = TCPCommunicator(8998)
+        self.addCleanup(comm1.close)
+        data = bytes(range(256)) * 4096
+        tag = 'bcst'.encode('utf-8')
+        with patch('adac.communicator.TCPCommunicator._attempt_send_data') as mock_send:
+            comm1.broadcast(['10.0.0.1', '10.0.0.2', '10.0.0.3'], data, tag)
+        self.assertEqual(mock_send.call_count, 3)
+        addrs = sorted(c[0][0] for c in mock_send.call_args_list)
+        self.assertEqual(addrs, ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+        msgs = [c[0][1] for c in mock_send.call_args_list]
+        for msg in msgs:
+            self.assertIs(msg, msgs[0])
+        self.assertEqual(msgs[0][0], comm.frame_header(data, tag))
+        self.assertIs(msgs[0][1], data)
+        with self.assertRaises(TypeError):
+            comm1.broadcast(['10.0.0.1'], 'str', tag)
+        with patch('adac.communicator.TCPCommunicator._attempt_send_data') as mock_send:
+            comm1.broadcast([], data, tag)
+        self.assertEqual(mock_send.call_count, 0, 'No neighbors means nothing to send')
+
+    def test_broadcast_loopback(self):
+        '''A broadcast over a real connection is received intact'''
+        comm1 = TCPCommunicator(8998)
+        self.addCleanup(comm1.close)
+        comm1.listen()
+        comm2 = TCPCommunicator(8998)
+        self.addCleanup(comm2.close)
+        data = bytes(range(256)) * 4096
+        tag = 'bcst'.encode('utf-8')
+        comm2.broadcast(['127.0.0.1'], data, tag)
+        self.assertEqual(comm1.get('127.0.0.1', tag, timeout=5), data)
+
+    @patch('adac.communicator.TCPCommunicator.connect', side_effect=ConnectionError('refused'))
+    def test_broadcast_fail(self, mock_conn):
+        comm1 = TCPCommunicator(8997)
+        self.addCleanup(comm1.close)
+        with self.assertRaises(RuntimeError) as ctx:
+            comm1.broadcast(['127.0.0.1', '127.0.0.2'], b'data', 'fail'.encode('utf-8'))
+        self.assertEqual(sorted(ctx.exception.failed), ['127.0.0.1', '127.0.0.2'])
+        with self.assertRaises(comm.SendError) as ctx:
+            comm1.broadcast(['127.0.0.1'], b'data', 'fail'.encode('utf-8'))
+        self.assertEqual(list(ctx.exception.failed), ['127.0.0.1'])
+
+    def test_frame_header(self):
+        hdr = comm.frame_header(b'hello', 'tag1'.encode('utf-8'))
+        self.assertEqual(hdr, struct.pack('!I', 9) + b'tag1')
+
     def test_recv_get_tcp(self):
         '''Ensure we can put a packet into the data store'''
         comm1 = TCPCommunicator(8998)
@@ -324,7 +712,7 @@ class TCPCommTest(unittest.TestCase):
     def test_recv_n_bytes(self):
         '''Make sure that the function to receive at most "n" bytes works correctly
         Used for message delimiting'''
-        with patch('socket.socket.recv', side_effect=[b'1', b'2', b'3', b'4']):
+        with patch('socket.socket.recv_into', side_effect=recv_into([b'1', b'2', b'3', b'4'])):
             _sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             msg = comm.recv_n_bytes(_sock, 4)
             self.assertEqual(msg, b'1234')
@@ -335,8 +723,8 @@ class TCPCommTest(unittest.TestCase):
                 return b'tcp_sock'[:n]
             else:
                 return b'tcp_sock'
-        
-        with patch('socket.socket.recv', side_effect=recv):
+
+        with patch('socket.socket.recv_into', side_effect=recv_into(recv)):
             _sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             msg = comm.recv_n_bytes(_sock, 5)
             self.assertEqual(msg, b'tcp_s')
@@ -349,14 +737,336 @@ class TCPCommTest(unittest.TestCase):
                 _sock.close()
             _sock.close()
 
-        with patch('socket.socket.recv', return_value=struct.pack('!I', 512)):
+        with patch('socket.socket.recv_into', side_effect=recv_into(lambda n: struct.pack('!I', 512))):
             _sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             msg = comm.recv_n_bytes(_sock, 4)
             self.assertEqual(struct.unpack('!I', msg)[0], 512)
             _sock.close()
 
-        with patch('socket.socket.recv', side_effect=[b'\x00', b'\x00', b'\x02', b'\x00']):
+        with patch('socket.socket.recv_into',
+                   side_effect=recv_into([b'\x00', b'\x00', b'\x02', b'\x00'])):
             _sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             msg = comm.recv_n_bytes(_sock, 4)
             self.assertEqual(struct.unpack('!I', msg)[0], 512)
             _sock.close()
+
+        with patch('socket.socket.recv_into', side_effect=recv_into([b''])):
+            _sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.assertEqual(comm.recv_n_bytes(_sock, 4), None)
+            _sock.close()
+
+    def test_frame_reader_oversize(self):
+        '''A header claiming a huge frame must be rejected before allocating'''
+        _sock = MagicMock()
+        _sock.recv_into.side_effect = recv_into([struct.pack('!I', comm.MAX_FRAME_SIZE + 1)])
+        reader = comm.FrameReader('127.0.0.1')
+        with self.assertRaises(ValueError):
+            reader.read(_sock)
+        self.assertEqual(reader.buffer, None)
+        with self.assertRaises(ValueError):
+            comm.recv_n_bytes(_sock, comm.MAX_FRAME_SIZE + 1)
+
+    def test_frame_reader(self):
+        '''The frame reader should reassemble messages split across many reads'''
+        payload = 'tag1'.encode('utf-8') + bytes(range(256)) * 100
+        stream = struct.pack('!I', len(payload)) + payload + struct.pack('!I', 0)
+        chunks = [stream[i:i + 1000] for i in range(0, len(stream), 1000)]
+        _sock = MagicMock()
+        _sock.recv_into.side_effect = recv_into(chunks + [b''])
+        reader = comm.FrameReader('127.0.0.1')
+        msgs = []
+        with self.assertRaises(EOFError):
+            while True:
+                msg = reader.read(_sock)
+                if msg is not None:
+                    msgs.append(msg)
+        self.assertEqual(len(msgs), 2)
+        self.assertTrue(isinstance(msgs[0], memoryview))
+        self.assertEqual(msgs[0], payload)
+        self.assertEqual(len(msgs[1]), 0)
+
+
+class AsyncTCPCommTest(unittest.TestCase):
+
+    def test_loopback(self):
+        '''Messages sent to ourselves arrive through the listening socket'''
+        async def main():
+            comm1 = comm.AsyncTCPCommunicator(9012)
+            await comm1.listen()
+            try:
+                await comm1.send('127.0.0.1', b'hello', b'tag1')
+                data = await comm1.get('127.0.0.1', b'tag1', timeout=5)
+                self.assertEqual(bytes(data), b'hello')
+                self.assertEqual(await comm1.get('127.0.0.1', b'tag1'), None)
+
+                await comm1.broadcast(['127.0.0.1'], b'round', b'tag2')
+                data = await comm1.gather_round(['127.0.0.1', '10.255.0.1'], b'tag2',
+                                                timeout=0.2)
+                self.assertEqual(bytes(data['127.0.0.1']), b'round')
+                self.assertEqual(data['10.255.0.1'], None)
+                with self.assertRaises(TypeError):
+                    await comm1.send('127.0.0.1', 'str', b'tag1')
+            finally:
+                await comm1.close()
+            self.assertEqual(len(comm1.readers), 0)
+        asyncio.run(main())
+
+    def test_from_threaded(self):
+        '''A TCPCommunicator can send to an AsyncTCPCommunicator'''
+        async def main():
+            comm1 = comm.AsyncTCPCommunicator(9013)
+            await comm1.listen()
+            comm2 = TCPCommunicator(9013)
+            try:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, comm2.send, '127.0.0.1', b'x' * 100000,
+                                           b'tag1')
+                data = await comm1.get('127.0.0.1', b'tag1', timeout=5)
+                self.assertEqual(bytes(data), b'x' * 100000)
+            finally:
+                comm2.close()
+                await comm1.close()
+        asyncio.run(main())
+
+    def test_read_frames(self):
+        '''Frames go through a FrameReader, heartbeats and oversized frames are not stored'''
+        async def main():
+            comm1 = comm.AsyncTCPCommunicator(9015)
+            await comm1.listen()
+            with self.assertRaises(ValueError):
+                comm1.register_recv_callback(lambda sender, tag: None)
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', 9015)
+                hb = comm.frame_header(b'\x00', comm.HEARTBEAT_TAG) + b'\x00'
+                writer.write(hb + comm.frame_header(b'data', b'tag1') + b'data')
+                data = await comm1.get('127.0.0.1', b'tag1', timeout=5)
+                self.assertEqual(bytes(data), b'data')
+                self.assertEqual(len(comm1.data_store.entries), 0)
+                writer.write(struct.pack('!I', comm.MAX_FRAME_SIZE + 1))
+                self.assertEqual(await reader.read(), b'', 'The connection is dropped')
+                writer.close()
+            finally:
+                await comm1.close()
+        asyncio.run(main())
+
+    def test_send_fail(self):
+        async def main():
+            comm1 = comm.AsyncTCPCommunicator(9014)
+            with self.assertRaises(RuntimeError):
+                await comm1.send('127.0.0.1', b'data', b'tag1', timeout=0.2)
+            with self.assertRaises(comm.SendError) as ctx:
+                await comm1.broadcast(['127.0.0.1'], b'data', b'tag1', timeout=0.2)
+            self.assertEqual(list(ctx.exception.failed), ['127.0.0.1'])
+            await comm1.close()
+        asyncio.run(main())
+
+
+class LoopbackCommTest(unittest.TestCase):
+
+    def test_send_get(self):
+        network = {}
+        comm1 = LoopbackCommunicator('a', network)
+        comm2 = LoopbackCommunicator('b', network)
+        comm1.listen()
+        self.assertFalse(comm1.send('b', b'x', b'tag1'), 'b is not listening')
+        comm2.listen()
+        comm1.broadcast(['b'], b'hello', b'tag1')
+        self.assertEqual(comm2.get('a', b'tag1'), b'hello')
+        comm2.close()
+        self.assertEqual(list(network), ['a'])
+
+
+    def test_heartbeat(self):
+        network = {}
+        comm1 = LoopbackCommunicator('a', network)
+        comm2 = LoopbackCommunicator('b', network)
+        comm1.listen()
+        comm2.listen()
+        self.addCleanup(comm1.close)
+        self.addCleanup(comm2.close)
+        comm1.start_heartbeat(['b'], interval=0.01, threshold=3)
+        comm2.start_heartbeat(['a'], interval=0.01, threshold=3)
+        time.sleep(0.1)
+        self.assertEqual(comm1.suspects(['b']), [])
+        self.assertEqual(len(comm1.data_store), 0, 'Heartbeats should not be stored')
+        comm2.close()
+        time.sleep(0.2)
+        self.assertEqual(comm1.suspects(['b']), ['b'])
+
+    def test_heartbeat_stuck(self):
+        '''A send stuck on a dead peer does not hold up the heartbeats to the others'''
+        network = {}
+        comm1 = LoopbackCommunicator('a', network)
+        comm2 = LoopbackCommunicator('b', network)
+        comm1.listen()
+        comm2.listen()
+        self.addCleanup(comm1.close)
+        self.addCleanup(comm2.close)
+        unblock = threading.Event()
+        self.addCleanup(unblock.set)
+        send = comm1.send
+        stuck = []
+
+        def slow_send(addr, data, tag):
+            if addr == 'dead':
+                stuck.append(addr)
+                unblock.wait()
+                raise RuntimeError('Unable to send data to dead')
+            send(addr, data, tag)
+
+        comm1.send = slow_send
+        comm2.start_heartbeat(['a'], interval=0.01, threshold=3)
+        comm1.start_heartbeat(['dead', 'b'], interval=0.01, threshold=3)
+        time.sleep(0.2)
+        self.assertEqual(comm2.suspects(['a']), [])
+        self.assertEqual(comm1.suspects(['dead', 'b']), ['dead'])
+        self.assertEqual(stuck, ['dead'], 'Only one heartbeat at a time may be in flight')
+        unblock.set()
+        time.sleep(0.2)
+        self.assertLessEqual(len(stuck), 3, 'Suspected peers are only probed now and then')
+
+    def test_heartbeat_connect(self):
+        '''A connection opened by a heartbeat keeps the send timeout for later messages'''
+        comm1 = TCPCommunicator(8994)
+        self.addCleanup(comm1.close)
+        comm1.listen()
+        comm2 = TCPCommunicator(8994, timeout=15)
+        self.addCleanup(comm2.close)
+        comm2._send_heartbeat('127.0.0.1', 0.05)
+        self.assertEqual(comm2.connections['127.0.0.1'].gettimeout(), 15)
+
+    @patch('adac.communicator.TCPCommunicator._attempt_send_data')
+    def test_heartbeat_tcp(self, mock_send):
+        '''TCP heartbeats give up connecting after one interval'''
+        comm1 = TCPCommunicator(8995)
+        self.addCleanup(comm1.close)
+        comm1.start_heartbeat(['127.0.0.2'], interval=0.05)
+        time.sleep(0.02)
+        comm1.stop_heartbeat()
+        self.assertEqual(mock_send.call_args[0][0], '127.0.0.2')
+        self.assertEqual(mock_send.call_args[1]['timeout'], 0.05)
+
+
+class FailureDetectorTest(unittest.TestCase):
+
+    def test_phi(self):
+        det = comm.FailureDetector(interval=1.0, threshold=3)
+        det.watch(['a', 'b'], now=0)
+        for t in range(1, 11):
+            det.heard('a', now=t)
+        self.assertEqual(det.phi('c', now=100), 0, 'Unwatched peers are never suspected')
+        self.assertAlmostEqual(det.phi('a', now=12), 2 * 0.4342944819)
+        self.assertEqual(det.suspects(['a', 'b'], now=12), ['b'])
+        self.assertEqual(det.suspects(['a', 'b'], now=20), ['a', 'b'])
+
+    def test_first_message(self):
+        '''The wait for the first message is not a gap between messages'''
+        det = comm.FailureDetector(interval=1.0, threshold=3)
+        det.watch(['a'], now=0)
+        det.heard('a', now=0.001)
+        det.heard('a', now=1.001)
+        self.assertEqual(det.suspects(['a'], now=2.001), [])
+        self.assertAlmostEqual(det.phi('a', now=2.001), 0.4342944819)
+
+    def test_timeout(self):
+        det = comm.FailureDetector(timeout=5)
+        det.watch(['a'], now=0)
+        det.heard('b', now=3)
+        self.assertEqual(det.suspects(['a', 'b'], now=4.9), [])
+        self.assertEqual(det.suspects(['a', 'b'], now=8), ['a', 'b'])
+
+
+class ShmCommTest(unittest.TestCase):
+
+    def test_ring(self):
+        ring = ShmRing('adac_test_ring', 4096)
+        self.addCleanup(ring.close)
+        self.assertEqual(ring.read(), None)
+        msg = bytes(range(256)) * 5  # 1280 bytes, three fit in the ring
+        for _ in range(3):
+            self.assertTrue(ring.write(b'tag1', msg))
+        self.assertFalse(ring.write(b'tag1', msg), 'The ring should be full')
+        for _ in range(3):
+            self.assertEqual(ring.read(), (b'tag1', msg))
+        self.assertEqual(ring.read(), None)
+
+        # Messages which do not fit before the end wrap around to the start
+        for i in range(20):
+            self.assertTrue(ring.write(b'tag1', msg))
+            self.assertTrue(ring.write(b'tag2', msg[:i]))
+            self.assertEqual(ring.read(), (b'tag1', msg))
+            self.assertEqual(ring.read(), (b'tag2', msg[:i]))
+        with self.assertRaises(ValueError):
+            ring.write(b'tag1', bytes(5000))
+
+    def test_ring_open(self):
+        '''Only the producer creates the segment, the consumer checks its size'''
+        with self.assertRaises(FileNotFoundError):
+            ShmRing('adac_test_open', 4096, create=False)
+        # Left behind by a producer which did not close
+        stale = comm.open_shm('adac_test_open', create=True, size=4096)
+        struct.pack_into('Q', stale.buf, 0, 64)
+        stale.close()
+        writer = ShmRing('adac_test_open', 4096)
+        self.addCleanup(writer.close)
+        reader = ShmRing('adac_test_open', 4096, create=False)
+        self.assertEqual(reader.read(), None, 'The stale segment should be replaced')
+        writer.write(b'tag1', b'fresh')
+        self.assertEqual(reader.read(), (b'tag1', b'fresh'))
+        reader.close()
+        reader = ShmRing('adac_test_open', 4096, create=False)
+        reader.close()  # Only the producer removes the name
+        with self.assertRaises(ValueError):
+            ShmRing('adac_test_open', 1 << 20, create=False)
+
+    def test_send_get(self):
+        comm1 = ShmCommunicator(9080, 'node1')
+        comm2 = ShmCommunicator(9080, 'node2', timeout=0.1)
+        self.addCleanup(comm2.close)
+        self.addCleanup(comm1.close)
+        self.assertFalse(comm2.send('node1', b'early', b'tag1'), 'node1 is not listening')
+        comm1.listen()
+        for i in range(10):
+            self.assertTrue(comm2.send('node1', bytes([i]) * 1000, b'tag' + bytes([i])))
+        for i in range(10):
+            self.assertEqual(comm1.get('node2', b'tag' + bytes([i]), timeout=1), bytes([i]) * 1000)
+
+        # Through the listener thread
+        timer = threading.Timer(0.1, comm2.send, ('node1', b'late', b'late'))
+        timer.start()
+        self.assertEqual(comm1.wait_all(['node2'], b'late', timeout=2), {'node2': b'late'})
+        timer.join()
+        self.assertFalse(comm2.send('node1', bytes(comm.SHM_RING_SIZE), b'big1'),
+                         'A message larger than the ring cannot be sent')
+        comm1.close()
+        comm2.close()
+        with self.assertRaises(FileNotFoundError):
+            comm.shared_memory.SharedMemory('adac_9080_node2_node1')
+
+    def test_restart(self):
+        '''A receiver reopens the ring of a sender which restarted, and a raising callback
+        does not stop the listener'''
+        comm1 = ShmCommunicator(9081, 'node1')
+        self.addCleanup(comm1.close)
+        comm1.listen()
+        comm2 = ShmCommunicator(9081, 'node2')
+        self.addCleanup(comm2.close)
+        self.assertTrue(comm2.send('node1', b'first', b'tag1'))
+        self.assertEqual(comm1.wait_all(['node2'], b'tag1', timeout=2), {'node2': b'first'})
+        comm2.close()
+        comm2 = ShmCommunicator(9081, 'node2')
+        self.addCleanup(comm2.close)
+
+        def fail(sender, tag, data):
+            raise RuntimeError('callback failed')
+
+        comm1.register_recv_callback(fail)
+        timer = threading.Timer(0.1, comm2.send, ('node1', b'again', b'tag2'))
+        timer.start()
+        self.assertEqual(comm1.wait_all(['node2'], b'tag2', timeout=2), {'node2': b'again'})
+        timer.join()
+        timer = threading.Timer(0.1, comm2.send, ('node1', b'more', b'tag3'))
+        timer.start()
+        self.assertEqual(comm1.wait_all(['node2'], b'tag3', timeout=2), {'node2': b'more'})
+        timer.join()
+        self.assertTrue(comm1.listen_thread.is_alive())
@@ -1,11 +1,19 @@
 
+import asyncio
 import unittest
 import pickle
+import socket
+import struct
+import threading
+import time
 import numpy as np
 
 import adac.nettools as nettools
 from adac.consensus import iterative as consensus
+from adac.consensus import corrective, gossip, weights
 from adac.communicator import UDPCommunicator as Communicator
+from adac.communicator import BaseCommunicator, TCPCommunicator, check_tag
+from adac.communicator import HEARTBEAT_TAG, frame_header, recv_n_bytes
 from unittest.mock import MagicMock, patch
 
 
@@ -22,12 +30,93 @@ def bad_resp():
     return r
 
 
+class MemoryCommunicator(BaseCommunicator):
+    '''Delivers messages straight into the data store of another in-memory communicator'''
+
+    def __init__(self, addr, network, drop=None):
+        super().__init__(1)
+        self.addr = addr
+        self.network = network
+        self.drop = drop
+        self.sent = 0
+        network[addr] = self
+
+    def send(self, addr, data, tag):
+        self.sent += 1
+        tg_int = int.from_bytes(check_tag(tag), byteorder='little')
+        if self.drop is not None and self.drop(self.addr, addr, tg_int):
+            return
+        other = self.network[addr]
+        if other._store(self.addr, tg_int, data) and other.recv_callback is not None:
+            other.recv_callback(self.addr, tg_int, data)
+
+    def close(self):
+        pass
+
+
+def run_network(edges, values, target, drop=None, **kwargs):
+    '''Run ``target`` for every node of a graph in its own thread.
+    Returns the results and the communicators'''
+    network = {}
+    comms = [MemoryCommunicator(i, network, drop) for i in range(len(edges))]
+    results = [None] * len(edges)
+    degs = [sum(row) - 1 for row in edges]
+
+    def node(i):
+        neigh = {j: 1 / (max(degs[i], degs[j]) + 1)
+                 for j in range(len(edges)) if edges[i][j] == 1 and i != j}
+        results[i] = target(values[i], neigh, comms[i], **kwargs)
+
+    thds = [threading.Thread(target=node, args=(i,)) for i in range(len(edges))]
+    for thd in thds:
+        thd.start()
+    for thd in thds:
+        thd.join()
+    return results, comms
+
+
+class AsyncMemoryCommunicator(object):
+    '''Coroutine counterpart of ``MemoryCommunicator`` for ``run_async``'''
+
+    def __init__(self, addr, network):
+        self.addr = addr
+        self.network = network
+        self.data_store = {}
+        self.data_ready = asyncio.Condition()
+        network[addr] = self
+
+    async def broadcast(self, addrs, data, tag):
+        for addr in addrs:
+            other = self.network[addr]
+            async with other.data_ready:
+                other.data_store[(self.addr, bytes(tag))] = data
+                other.data_ready.notify_all()
+
+    async def gather_round(self, neighbors, tag, timeout=None):
+        keys = [(n, bytes(tag)) for n in neighbors]
+        async with self.data_ready:
+            try:
+                await asyncio.wait_for(self.data_ready.wait_for(
+                    lambda: all(k in self.data_store for k in keys)), timeout)
+            except asyncio.TimeoutError:
+                pass
+            return {k[0]: self.data_store.pop(k, None) for k in keys}
+
+
+def ring(n):
+    return [[1 if (i - j) % n in (0, 1, n - 1) else 0 for j in range(n)] for i in range(n)]
+
+
+def complete(n):
+    return [[1] * n for i in range(n)]
+
+
 class ConsensusTest(unittest.TestCase):
 
     @patch('adac.consensus.iterative.transmit', return_value=MagicMock())
     @patch('adac.consensus.iterative.receive',
-           return_value={'local': pickle.dumps(np.zeros((2, 2))),
-                         'local2': pickle.dumps(np.ones((2, 2)))})
+           return_value={'local': nettools.matrix_to_bytes(np.zeros((2, 2))),
+                         'local2': nettools.matrix_to_bytes(np.ones((2, 2)))})
     def test_consensus_test(self, mock2, mock1):
         arr = np.zeros((2, 2))
         arr[0][0] = 14
@@ -41,6 +130,399 @@ class ConsensusTest(unittest.TestCase):
         comm.close()
 
 
+    def test_consensus_no_neighbors(self):
+        '''A node without neighbors keeps its own value over a real TCP communicator'''
+        comm = TCPCommunicator(12311)
+        self.addCleanup(comm.close)
+        res = consensus.run(np.ones((2, 2)), 3, 12, {}, comm)
+        self.assertTrue(np.array_equal(res, np.ones((2, 2))))
+
+    def test_consensus_timeout(self):
+        '''A neighbor that never sends makes run() give up and return None'''
+        comm = Communicator(12309)
+        comm.broadcast = MagicMock()
+        arr = np.ones((2, 2))
+        with patch('adac.consensus.iterative.TIMEOUT', 0.1):
+            self.assertEqual(consensus.run(arr, 2, 12, {'local': 0.5}, comm), None)
+        comm.close()
+
+    def test_consensus_state(self):
+        '''The fused update should match the original x + sum w (x_j - x) update'''
+        rng = np.random.RandomState(1)
+        x = rng.randint(0, 100, size=(3, 4))
+        x_orig = x.copy()
+        neigh = {'a': 0.25, 'b': 0.2, 'c': 1 / 6}
+        vals = {n: rng.rand(3, 4) for n in neigh}
+        state = consensus.ConsensusState(x, neigh)
+        for n in neigh:
+            state.load(n, vals[n])
+        out = state.step()
+        expected = x + sum(neigh[n] * (vals[n] - x) for n in neigh)
+        self.assertTrue(np.allclose(out, expected))
+        self.assertIs(out, state.x)
+        self.assertTrue(np.array_equal(x, x_orig), 'Original data should not be modified')
+
+        lonely = consensus.ConsensusState(np.ones(3), {})
+        self.assertTrue(np.array_equal(lonely.step(), np.ones(3)))
+
+    def test_early_termination(self):
+        '''A complete graph converges after one round and should stop long before tc'''
+        values = [np.full((2, 2), float(i)) for i in range(6)]
+        run = lambda x, n, c, **kw: consensus.run(x, 50, 1, n, c, **kw)
+        results, comms = run_network(complete(6), values, run, eps=1e-9, patience=2, diameter=1)
+        for res in results:
+            self.assertTrue(np.allclose(res, 2.5))
+        for c in comms:
+            self.assertLess(c.sent, 5 * 10, 'Should have stopped early')
+
+        results, comms = run_network(ring(6), values, run, eps=1e-6, patience=2, diameter=3)
+        for res in results:
+            self.assertTrue(np.allclose(res, 2.5, atol=1e-3))
+        rounds = [c.sent / 2 for c in comms]
+        self.assertEqual(len(set(rounds)), 1, 'All nodes should stop on the same round')
+        self.assertLess(rounds[0], 50)
+        with self.assertRaises(ValueError):
+            consensus.run(values[0], 5, 1, {}, comms[0], eps=1)
+
+    def test_early_termination_gone(self):
+        '''Sending the stop flag to a neighbor which already left does not end in an error'''
+        from adac.communicator import SendError
+        values = [np.full(2, float(i)) for i in range(4)]
+        transmit = consensus.transmit
+
+        def fail_stop(data, tag, neighbors, communicator):
+            transmit(data, tag, neighbors, communicator)
+            if consensus.unpack_status(data)[0]:
+                raise SendError({j: '{}: gone'.format(j) for j in neighbors})
+        run = lambda x, n, c, **kw: consensus.run(x, 50, 1, n, c, **kw)
+        with patch('adac.consensus.iterative.transmit', fail_stop):
+            results, _ = run_network(complete(4), values, run, eps=1e-9, patience=2, diameter=1)
+        for res in results:
+            self.assertTrue(np.allclose(res, 1.5))
+
+    def test_run_async(self):
+        values = [np.full((2, 2), float(i)) for i in range(6)]
+        edges = ring(6)
+
+        async def main():
+            network = {}
+            comms = [AsyncMemoryCommunicator(i, network) for i in range(6)]
+            runs = []
+            for i in range(6):
+                neigh = {j: 1 / 3 for j in range(6) if edges[i][j] == 1 and i != j}
+                runs.append(consensus.run_async(values[i], 60, 1, neigh, comms[i]))
+            return await asyncio.gather(*runs)
+        for res in asyncio.run(main()):
+            self.assertTrue(np.allclose(res, 2.5, atol=1e-6))
+
+        async def silent_neighbor():
+            network = {}
+            comm, _ = AsyncMemoryCommunicator(0, network), AsyncMemoryCommunicator(1, network)
+            with patch('adac.consensus.iterative.TIMEOUT', 0.05):
+                return await consensus.run_async(values[0], 2, 1, {1: 0.5}, comm)
+        self.assertEqual(asyncio.run(silent_neighbor()), None)
+
+    def test_run_pipelined(self):
+        '''Pipelined rounds should give the same result as lock-step rounds'''
+        values = [np.full((2, 2), float(i * i)) for i in range(6)]
+        plain, _ = run_network(ring(6), values,
+                               lambda x, n, c: consensus.run(x, 20, 1, n, c))
+        piped, comms = run_network(ring(6), values,
+                                   lambda x, n, c: consensus.run_pipelined(x, 20, 1, n, c))
+        for res, expected in zip(piped, plain):
+            self.assertTrue(np.allclose(res, expected))
+        self.assertEqual(comms[0].sent, 2 * 20)
+
+        comm = MemoryCommunicator(0, {1: MemoryCommunicator(1, {})})
+        with patch('adac.consensus.iterative.TIMEOUT', 0.05):
+            self.assertEqual(consensus.run_pipelined(values[0], 2, 1, {1: 0.5}, comm), None)
+
+    def test_sender_error(self):
+        comm = MagicMock()
+        comm.broadcast.side_effect = OSError('down')
+        sender = consensus.Sender(['a'], comm)
+        sender.post(b'data', b'tag')
+        sender.close()
+        with self.assertRaises(RuntimeError):
+            sender.post(b'data', b'tag')
+        self.assertEqual(comm.broadcast.call_count, 1)
+
+    def test_run_incremental(self):
+        values = [np.full((2, 2), float(i * i)) for i in range(6)]
+        plain, _ = run_network(ring(6), values,
+                               lambda x, n, c: consensus.run(x, 20, 1, n, c))
+        summed, comms = run_network(ring(6), values,
+                                    lambda x, n, c: consensus.run_incremental(x, 20, 1, n, c))
+        for res, expected in zip(summed, plain):
+            self.assertTrue(np.allclose(res, expected))
+        for c in comms:
+            self.assertIsNone(c.recv_callback, 'The previous callback should be put back')
+            self.assertEqual(len(c.data_store), 0, 'Used messages should not pile up')
+
+    def test_accumulator(self):
+        '''Values for the next round and repeats arriving during a round are handled'''
+        neigh = {'a': 0.25, 'b': 0.5}
+        acc = consensus.Accumulator(np.ones(2), 3, neigh)
+        tag = lambda i: int.from_bytes(consensus.build_tag(3, i), byteorder='little')
+        msg = lambda v: nettools.matrix_to_bytes(np.full(2, v))
+        acc.receive('a', tag(0), msg(3.0))
+        acc.receive('a', tag(0), msg(100.0))
+        acc.receive('a', tag(1), msg(5.0))
+        acc.receive('a', tag(2), msg(100.0))
+        acc.receive('b', tag(0) + 1, msg(100.0))
+        acc.receive('c', tag(0), msg(100.0))
+        self.assertFalse(acc.wait(timeout=0.01))
+        acc.receive('b', tag(0), msg(7.0))
+        self.assertTrue(acc.wait(timeout=0))
+        self.assertTrue(np.allclose(acc.close(), 0.25 + 0.25 * 3 + 0.5 * 7))
+        acc.receive('b', tag(0), msg(100.0))
+        acc.receive('b', tag(1), msg(1.0))
+        self.assertTrue(acc.wait(timeout=0))
+        self.assertTrue(np.allclose(acc.close(), 0.25 * 4.5 + 0.25 * 5 + 0.5))
+
+    def test_run_bounded(self):
+        values = [np.full((2, 2), float(i * i)) for i in range(6)]
+        plain, _ = run_network(ring(6), values,
+                               lambda x, n, c: consensus.run(x, 20, 1, n, c))
+        same, _ = run_network(ring(6), values,
+                              lambda x, n, c: consensus.run_bounded(x, 20, 1, n, c, staleness=0))
+        for res, expected in zip(same, plain):
+            self.assertTrue(np.allclose(res, expected))
+
+        def slow(src, dst, tag):
+            if src == 0:
+                time.sleep(0.005)
+            return False
+        # Late values must not move the average the nodes agree on
+        run = lambda x, n, c: consensus.run_bounded(x, 150, 1, n, c, staleness=3)
+        results, comms = run_network(ring(6), values, run, drop=slow)
+        for res in results:
+            self.assertTrue(np.allclose(res, 55 / 6, atol=1e-4))
+        for c in comms:
+            self.assertEqual(len(c.data_store), 0, 'Every value should have been used')
+        with self.assertRaises(ValueError):
+            consensus.run_bounded(values[0], 1, 1, {}, None, staleness=-1)
+
+    def test_run_resilient(self):
+        '''The survivors of a failed node reweight their edges and still agree'''
+        values = [np.full((2, 2), float(i * i)) for i in range(6)]
+        plain, _ = run_network(ring(6), values,
+                               lambda x, n, c: consensus.run(x, 20, 1, n, c))
+        same, _ = run_network(ring(6), values,
+                              lambda x, n, c: consensus.run_resilient(x, 20, 1, n, c))
+        for res, expected in zip(same, plain):
+            self.assertTrue(np.allclose(res, expected))
+
+        def run(x, n, c):
+            c.start_heartbeat(n, interval=0.01, threshold=4)
+            # Node 3 dies after 5 rounds
+            res = consensus.run_resilient(x, 5 if c.addr == 3 else 150, 1, n, c)
+            c.stop_heartbeat()
+            return res
+        start = time.monotonic()
+        results, _ = run_network(ring(6), values, run)
+        self.assertLess(time.monotonic() - start, consensus.TIMEOUT)
+        survivors = [r for i, r in enumerate(results) if i != 3]
+        # Node 3 takes the value it ended with along, the survivors keep the rest of the mass
+        expected = (sum(values) - results[3]) / len(survivors)
+        for res in survivors:
+            self.assertTrue(np.allclose(res, expected, atol=1e-6))
+
+    def test_run_resilient_lost(self):
+        '''A neighbor which drops an edge after losing a message takes the other end along'''
+        values = [np.full(2, float(i * i)) for i in range(6)]
+        # 0 -> 1 loses its message in iteration 5, 0 still uses the one of 1
+        drop = lambda src, dst, tag: src == 0 and dst == 1 and tag == 1 + 5 * 256
+        collect = consensus.collect
+        # Only 1 gives up quickly, and only on the lost message
+        lost = consensus.build_tag(1, 5)
+        fast = lambda tag, nb, c: collect(tag, nb, c,
+                                          timeout=0.05 if (c.addr, tag) == (1, lost) else 5)
+        with patch('adac.consensus.iterative.collect', fast):
+            results, _ = run_network(ring(6), values,
+                                     lambda x, n, c: consensus.run_resilient(x, 150, 1, n, c),
+                                     drop=drop)
+        for res in results:
+            self.assertTrue(np.allclose(res, np.mean(values, axis=0), atol=1e-6))
+
+    def test_run_resilient_tcp(self):
+        '''A TCP neighbor which goes away is dropped once sending to it fails'''
+        node = TCPCommunicator(12313, timeout=0.2)
+        self.addCleanup(node.close)
+        node.listen()
+        tc = 20
+        value = nettools.matrix_to_bytes(np.full(2, 5.0))
+        degrees = []
+
+        def read_frame(conn):
+            size = struct.unpack('!I', recv_n_bytes(conn, 4))[0]
+            msg = recv_n_bytes(conn, size)
+            return msg[:4], msg[4:]
+
+        def reply(conn, tag):
+            data = consensus.DEGREE.pack(1) + value
+            conn.sendall(frame_header(data, tag) + data)
+
+        # Stays for the whole run, connects from 127.0.0.2 so the node reuses its connection
+        stays = socket.create_connection(('127.0.0.1', 12313), source_address=('127.0.0.2', 0))
+        self.addCleanup(stays.close)
+        # Takes part in two rounds and goes away, listening where the node connects to
+        leaves = socket.socket(socket.AF_INET6)
+        self.addCleanup(leaves.close)
+        leaves.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        leaves.bind(('::1', 12313))
+        leaves.listen(1)
+        while '127.0.0.2' not in node.connections:
+            time.sleep(0.01)
+
+        def stay():
+            for _ in range(tc):
+                tag, data = read_frame(stays)
+                degrees.append(consensus.DEGREE.unpack_from(data)[0])
+                reply(stays, tag)
+
+        def leave():
+            conn, _ = leaves.accept()
+            for _ in range(2):
+                reply(conn, read_frame(conn)[0])
+            conn.close()
+            leaves.close()
+
+        thds = [threading.Thread(target=stay), threading.Thread(target=leave)]
+        for thd in thds:
+            thd.start()
+        with patch('adac.consensus.iterative.TIMEOUT', 1):
+            res = consensus.run_resilient(np.zeros(2), tc, 1, ['127.0.0.2', '::1'], node)
+        for thd in thds:
+            thd.join()
+        self.assertEqual(degrees, [2] * 3 + [1] * (tc - 3))
+        self.assertTrue(np.allclose(res, 5, atol=1e-4))
+
+    def test_status(self):
+        msg = consensus.pack_status(True, 2**40) + b'data'
+        stop, quiet, data = consensus.unpack_status(msg)
+        self.assertTrue(stop)
+        self.assertEqual(quiet, consensus.QUIET_MAX)
+        self.assertEqual(bytes(data), b'data')
+        with self.assertRaises(ValueError):
+            consensus.unpack_status(b'ab')
+
+    def test_corrective(self):
+        '''Lost messages move the average unless the correction rounds put the mass back'''
+        values = [np.full((2, 2), float(i * i)) for i in range(5)]
+        avg = np.mean([v[0][0] for v in values])
+        # 0 -> 1 loses its messages in iterations 2 and 5
+        drop = lambda src, dst, tag: src == 0 and dst == 1 and tag in (1 + 2 * 256, 1 + 5 * 256)
+        with patch('adac.consensus.iterative.TIMEOUT', 0.05):
+            run = lambda x, n, c: corrective.run(x, 40, 1, n, c, period=10)
+            results, _ = run_network(ring(5), values, run, drop=drop)
+            for res in results:
+                self.assertTrue(np.allclose(res, avg, atol=1e-2))
+            run = lambda x, n, c: corrective.run(x, 40, 1, n, c, period=100)
+            results, _ = run_network(ring(5), values, run, drop=drop)
+            self.assertFalse(np.isclose(np.mean([r[0][0] for r in results]), avg))
+
+    def test_corrective_send_error(self):
+        '''A neighbor which cannot be sent to is skipped from then on instead of ending the run'''
+        from adac.communicator import SendError
+        comm = MagicMock()
+
+        def broadcast(neighbors, data, tag):
+            if 'b' in neighbors:
+                raise SendError({'b': 'b: refused'})
+        comm.broadcast.side_effect = broadcast
+        comm.wait_all.side_effect = lambda neighbors, tag, timeout: {
+            j: nettools.matrix_to_bytes(np.full(2, 3.0)) for j in neighbors}
+        res = corrective.run(np.full(2, 1.0), 4, 1, {'a': 0.25, 'b': 0.25}, comm, period=2)
+        self.assertEqual(res.shape, (2,))
+        sent = [call[0][0] for call in comm.broadcast.call_args_list]
+        self.assertEqual(sent.count(['a', 'b']), 1)
+        self.assertNotIn(['b'], sent, 'No corrections go to the failed neighbor')
+
+    def test_accelerated(self):
+        values = [np.full(3, float(i * i)) for i in range(7)]
+        beta = weights.optimal_beta(weights.metropolis_matrix(ring(7)))
+        plain, _ = run_network(ring(7), values,
+                               lambda x, n, c: corrective.run(x, 30, 1, n, c))
+        fast, comms = run_network(ring(7), values,
+                                  lambda x, n, c: corrective.run(x, 30, 1, n, c, beta=beta))
+        err = lambda res: max(np.max(np.abs(r - 13)) for r in res)
+        self.assertLess(err(fast), err(plain) / 100)
+        self.assertEqual(comms[0].sent, 2 * 33, '30 rounds and 3 correction rounds')
+
+    def test_gossip(self):
+        values = [np.full((2, 2), float(i * i)) for i in range(6)]
+        for broadcast in (False, True):
+            run = lambda x, n, c: gossip.run(x, 150, 1, n, c, interval=0.002,
+                                             broadcast=broadcast, linger=0.2, seed=c.addr)
+            results, _ = run_network(ring(6), values, run)
+            for res in results:
+                self.assertTrue(np.allclose(res, 55 / 6, atol=1e-2))
+
+    def test_gossip_flush(self):
+        '''The last pushes and acknowledgements are lost, the flush still delivers the mass'''
+        lost = set()
+        lock = threading.Lock()
+
+        def drop(src, dst, tg_int):
+            # The first push and the first acknowledgement of every node
+            with lock:
+                if (src, tg_int & 0xFF) in lost:
+                    return False
+                lost.add((src, tg_int & 0xFF))
+                return True
+
+        states = []
+
+        class State(gossip.GossipState):
+            def __init__(self, *args):
+                super().__init__(*args)
+                states.append(self)
+
+        run = lambda x, n, c: gossip.run(x, 1, 1, n, c, interval=0.002, linger=0.05)
+        with patch.object(gossip, 'GossipState', State):
+            results, _ = run_network(complete(2), [np.full(2, 1.0), np.full(2, 5.0)], run, drop)
+        ack = 1 | consensus.CONTROL
+        self.assertEqual(lost, {(0, 1), (1, 1), (0, ack), (1, ack)})
+        self.assertAlmostEqual(sum(state.w for state in states), 2, msg='Mass was stranded')
+        self.assertTrue(np.allclose(sum(state.s for state in states), 6))
+        for state, res in zip(sorted(states, key=lambda st: st.neighbors), results[::-1]):
+            self.assertTrue(np.allclose(state.estimate(), res))
+
+    def test_gossip_state(self):
+        '''Running totals make up for lost and reordered messages'''
+        nodes = [gossip.GossipState(np.full(2, float(v)), [1 - i]) for i, v in enumerate([1, 5])]
+        msgs = []
+        for _ in range(3):
+            nodes[0].push([1])
+            msgs.append(gossip.pack(nodes[0], 1))
+        gossip.absorb(nodes[1], 0, msgs[0])
+        gossip.absorb(nodes[1], 0, msgs[2])
+        self.assertFalse(gossip.absorb(nodes[1], 0, msgs[1]), 'Late message should be ignored')
+        total = sum(n.s for n in nodes) / sum(n.w for n in nodes)
+        self.assertTrue(np.allclose(total, 3))
+        self.assertAlmostEqual(nodes[0].w + nodes[1].w, 2)
+        with self.assertRaises(ValueError):
+            gossip.absorb(nodes[1], 0, b'ab')
+
+    def test_metropolis_matrix(self):
+        w = weights.metropolis_matrix(weights.parse_edges('[[1 1 0] [1 1 1] [0 1 1]]'))
+        self.assertTrue(np.allclose(w, [[2/3, 1/3, 0], [1/3, 1/3, 1/3], [0, 1/3, 2/3]]))
+        self.assertEqual(weights.parse_edges('[[1, 0], [0, 1]]'), [[1, 0], [0, 1]])
+        self.assertAlmostEqual(weights.optimal_beta(weights.metropolis_matrix(complete(4))), 1)
+
+    def test_fastest_mixing_matrix(self):
+        edges = ring(7)
+        metropolis = weights.metropolis_matrix(edges)
+        fast = weights.fastest_mixing_matrix(edges)
+        self.assertLess(weights.second_eigenvalue(fast), weights.second_eigenvalue(metropolis))
+        self.assertTrue(np.allclose(fast, fast.T))
+        self.assertTrue(np.allclose(fast.sum(axis=1), 1))
+        self.assertTrue(np.all(fast >= 0))
+        self.assertTrue(np.all(fast[np.array(edges) == 0] == 0), 'Only edges may have weight')
+        self.assertEqual(weights.node_weights(fast, 0, {'b': 1, 'g': 6}),
+                         {'b': fast[0][1], 'g': fast[0][6]})
+
     def test_m2b(self):
         t1 = np.zeros((2, 2))
         t1[0][1] = 5
@@ -56,6 +538,40 @@ class ConsensusTest(unittest.TestCase):
         self.assertEqual(t1[1][1], back[1][1],
                          "Objects should be equal after reconstructing from bytes")
 
+    def test_codec_types(self):
+        for arr in [np.arange(24, dtype=np.int32).reshape(2, 3, 4),
+                    np.ones((3, 2), dtype='>f8'),
+                    np.array(7.5),
+                    np.zeros((0, 5)),
+                    np.arange(10)[::2],
+                    np.array([1 + 2j])]:
+            back = nettools.matrix_from_bytes(nettools.matrix_to_bytes(arr))
+            self.assertEqual(back.dtype, arr.dtype)
+            self.assertEqual(back.shape, arr.shape)
+            self.assertTrue(np.array_equal(back, arr))
+
+    def test_codec_zero_copy(self):
+        buf = bytearray(nettools.matrix_to_bytes(np.ones((4, 4))))
+        back = nettools.matrix_from_bytes(buf)
+        buf[-8:] = np.float64(3).tobytes()
+        self.assertEqual(back[3][3], 3, 'Decoded array should share memory with the buffer')
+
+    def test_codec_malformed(self):
+        good = nettools.matrix_to_bytes(np.ones((2, 2)))
+        bad = [b'', b'AC', pickle.dumps(np.ones((2, 2))), good[:-1], good + b'\x00',
+               good[:2] + b'\x02' + good[3:],
+               good[:5] + b'|O8' + good[8:]]
+        for data in bad:
+            with self.assertRaises(ValueError):
+                nettools.matrix_from_bytes(data)
+        with self.assertRaises(TypeError):
+            nettools.matrix_to_bytes(np.array([object()]))
+
+    def test_pickle_codec(self):
+        codec = nettools.PickleCodec()
+        back = nettools.matrix_from_bytes(nettools.matrix_to_bytes(np.eye(2), codec), codec)
+        self.assertTrue(np.array_equal(back, np.eye(2)))
+
     @patch('requests.get', side_effect=[good_resp(2), good_resp(3), bad_resp()])
     def test_weights(self, mock1):
         neighbors = ['192.168.2.180', '192.168.2.181']
@@ -84,10 +600,15 @@ class ConsensusTest(unittest.TestCase):
         self.assertEqual(
             num1, num, "Should be able to get num from tag byte 1-4")
 
-        id = 257
+        id = 129
         tag1 = consensus.build_tag(id, num)
         self.assertEqual(
-            tag1[0], 1, "id should be modulus 256 of original value")
+            tag1[0], 1, "id should be modulus 128 of original value")
+        tag1 = consensus.build_tag(id, num, control=True)
+        self.assertEqual(tag1[0], 1 | consensus.CONTROL, "control sets the reserved bit")
+        self.assertNotEqual(tag1, consensus.build_tag(id + 128, num))
+        tag1 = consensus.build_tag(127, 2**24 - 1, control=True)
+        self.assertNotEqual(tag1, HEARTBEAT_TAG, "heartbeat tag is reserved")
 
         id = 1
         num = 2**(24) + 2
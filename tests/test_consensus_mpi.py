@@ -0,0 +1,35 @@
+import unittest
+import numpy as np
+from mpi4py import MPI
+
+from adac.consensus import mpi as consensus
+
+
+class MPIConsensusTest(unittest.TestCase):
+
+    def test_neighbor_comm(self):
+        rank = MPI.COMM_WORLD.Get_rank()
+        comm = consensus.neighbor_comm(MPI.COMM_WORLD, [rank])
+        sources, destinations, _ = comm.Get_dist_neighbors()
+        self.assertEqual(sources, [rank])
+        self.assertEqual(destinations, [rank])
+        comm.Free()
+
+    def test_step(self):
+        '''A node linked to itself receives its own value, so the update must not change it'''
+        rank = MPI.COMM_WORLD.Get_rank()
+        data = np.arange(6).reshape(2, 3)
+        engine = consensus.MPIConsensus(data, {rank: 0.5}, MPI.COMM_WORLD)
+        self.addCleanup(engine.close)
+        for _ in range(3):
+            out = engine.step()
+            self.assertTrue(np.array_equal(engine.state.stack[0], data))
+            self.assertTrue(np.allclose(out, data))
+        self.assertEqual(len(engine.requests), 2)
+
+    def test_run(self):
+        data = np.ones((2, 2))
+        out = consensus.run(data, 5, {}, MPI.COMM_WORLD)
+        self.assertTrue(np.array_equal(out, data))
+        out = consensus.run(data, 5, {MPI.COMM_WORLD.Get_rank(): 0.25}, MPI.COMM_WORLD)
+        self.assertTrue(np.array_equal(out, data))
@@ -94,6 +94,49 @@ class test_node_runner(unittest.TestCase):
         neighbors = n.get_neighbors()
         self.assertEqual(len(neighbors), 3, "Neighbors should be 3 on 2.184")
    
+    @patch('adac.nettools.get_ip_address', return_value='192.168.2.180')
+    def test_get_node_id(self, mock1):
+        con = n.ConfigParser()
+        con.read_dict({'network': {'iface': 'eth0'}})
+        self.assertEqual(n.get_node_id(con), '192.168.2.180')
+        con['network']['id'] = 'node1'
+        self.assertEqual(n.get_node_id(con), 'node1')
+
+    def test_get_variant(self):
+        con = n.ConfigParser()
+        con.read_dict({'consensus': {'pipelined': 'False', 'staleness': '0'}})
+        self.assertEqual(n.get_variant(con), None)
+        con['consensus']['staleness'] = '2'
+        self.assertEqual(n.get_variant(con), 'staleness')
+        with self.assertRaises(ValueError):
+            n.get_variant(con, mpi=True)
+        con['consensus']['pipelined'] = 'True'
+        with self.assertRaises(ValueError):
+            n.get_variant(con)
+        con['consensus']['staleness'] = '0'
+        con['consensus']['epsilon'] = '1e-6'
+        with self.assertRaises(ValueError):
+            n.get_variant(con)
+
+    def test_get_diameter(self):
+        self.assertEqual(n.get_diameter(), 2)
+
+    @patch('adac.nettools.get_ip_address', return_value='192.168.2.180')
+    def test_get_config_weights(self, mock1):
+        w = n.get_config_weights(['192.168.2.183'], 'metropolis')
+        self.assertEqual(w, {'192.168.2.183': 1/5})
+        fast = n.get_config_weights(['192.168.2.183'], 'fastest')
+        self.assertGreater(fast['192.168.2.183'], 0)
+        self.assertEqual(n.get_config_weights([1, 3], 'metropolis', rank=0), {1: 0, 3: 1/5})
+        self.assertEqual(n.get_config_weights(None, 'fastest'), {})
+        with self.assertRaises(ValueError):
+            n.get_config_weights([1], 'unknown', rank=0)
+
+    def test_get_beta(self):
+        beta = n.get_beta()
+        self.assertGreater(beta, 1)
+        self.assertLess(beta, 2)
+
     def test_get_indexAndEdges(self):
 
         index, edges = n.get_indexAndEdges()
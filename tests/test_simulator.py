@@ -0,0 +1,106 @@
+import threading
+import unittest
+import numpy as np
+
+from adac import simulator
+from adac.communicator import LoopbackCommunicator
+from adac.consensus import iterative
+from adac.consensus import weights
+
+# test_node_runner replaces iterative.run with a mock for the rest of the session
+run = iterative.run
+
+
+class TestSimulator(unittest.TestCase):
+
+    def test_generate_graph(self):
+        ring = simulator.generate_graph('ring', 10, degree=4)
+        self.assertTrue(all(len(n) == 4 for n in ring))
+        self.assertEqual(ring[0], {1, 2, 8, 9})
+        torus = simulator.generate_graph('torus', 12)
+        self.assertTrue(all(len(n) == 4 for n in torus))
+        rand = simulator.generate_graph('random', 100, degree=6, seed=1)
+        self.assertTrue(all(i in rand[j] for i in range(100) for j in rand[i]), 'Undirected')
+        self.assertGreater(sum(len(n) for n in rand) / 100, 5)
+        with self.assertRaises(ValueError):
+            simulator.generate_graph('star', 10)
+
+    def test_load_graph(self):
+        graph = simulator.load_graph('params2.conf')
+        self.assertEqual(graph, simulator.generate_graph('ring', 7, degree=2))
+
+    def test_simulate(self):
+        '''Matches W^k x with the weights of iterative.get_weights'''
+        neighbors = simulator.generate_graph('random', 30, degree=4, seed=2)
+        values = np.random.RandomState(0).rand(30, 3)
+        res = simulator.simulate(neighbors, values, 15)
+        w_mat = np.eye(30)
+        for i, row in enumerate(simulator.metropolis_weights(neighbors)):
+            for j, w in row.items():
+                w_mat[i][j] = w
+                w_mat[i][i] -= w
+        np.testing.assert_allclose(res['x'], np.linalg.matrix_power(w_mat, 15) @ values)
+        self.assertEqual(len(res['disagreement']), 16)
+        self.assertEqual(len(res['round_time']), 15)
+        self.assertLess(res['disagreement'][-1], res['disagreement'][0])
+
+    def test_simulate_processes(self):
+        neighbors = simulator.generate_graph('ring', 20, degree=2)
+        values = np.arange(20.0).reshape(20, 1)
+        single = simulator.simulate(neighbors, values, 10)
+        sharded = simulator.simulate(neighbors, values, 10, processes=3)
+        np.testing.assert_allclose(single['x'], sharded['x'])
+        np.testing.assert_allclose(single['disagreement'], sharded['disagreement'])
+        self.assertEqual(simulator.rounds_to_eps(single['disagreement'], 100), 0)
+        self.assertEqual(simulator.rounds_to_eps(single['disagreement'], 1e-12), None)
+
+    def test_weight_matrix(self):
+        neighbors = simulator.generate_graph('random', 40, degree=5, seed=4)
+        matrix = simulator.weight_matrix(neighbors)
+        adj = np.zeros((40, 40), dtype=int)
+        for i, neigh in enumerate(neighbors):
+            adj[i, list(neigh)] = 1
+        np.testing.assert_allclose(matrix.toarray(), weights.metropolis_matrix(adj))
+        values = np.random.RandomState(1).rand(40, 2)
+        np.testing.assert_allclose(matrix.dot(values), matrix.toarray() @ values)
+        np.testing.assert_allclose(matrix.dot(values[:, 0]), matrix.toarray() @ values[:, 0])
+        self.assertAlmostEqual(simulator.second_eigenvalue(matrix),
+                               weights.second_eigenvalue(matrix.toarray()))
+        lam, res = simulator.second_eigenvalue(matrix, iterations=5, residual=True)
+        self.assertLessEqual(lam, weights.second_eigenvalue(matrix.toarray()) + 1e-12)
+        self.assertGreaterEqual(lam + res, weights.second_eigenvalue(matrix.toarray()))
+
+    def test_simulate_matrix(self):
+        neighbors = simulator.generate_graph('torus', 16)
+        values = np.random.RandomState(3).rand(16, 2) * 10
+        res = simulator.simulate_matrix(neighbors, values, 30, eps=1e-3)
+        sim = simulator.simulate(neighbors, values, 30)
+        np.testing.assert_allclose(res['x'], sim['x'])
+        np.testing.assert_allclose(res['disagreement'], sim['disagreement'])
+        self.assertAlmostEqual(res['spectral_gap'], 1 - res['lambda'])
+        reached = simulator.rounds_to_eps(res['disagreement'], 1e-3)
+        self.assertIsNotNone(reached)
+        self.assertLessEqual(reached, res['predicted'])
+        self.assertEqual(simulator.predict_iterations(values, 1.0, 1e-3), None)
+
+    def test_matches_run(self):
+        '''Every node running iterative.run on its own thread ends at W^tc x'''
+        neighbors = simulator.load_graph('params2.conf')
+        values = np.random.RandomState(5).rand(len(neighbors), 3)
+        node_weights = simulator.metropolis_weights(neighbors)
+        network = {}
+        comms = [LoopbackCommunicator(i, network) for i in range(len(neighbors))]
+        for comm in comms:
+            comm.listen()
+        results = [None] * len(neighbors)
+
+        def node(i):
+            results[i] = run(values[i], 20, 1, node_weights[i], comms[i])
+
+        thds = [threading.Thread(target=node, args=(i,)) for i in range(len(neighbors))]
+        for thd in thds:
+            thd.start()
+        for thd in thds:
+            thd.join()
+        res = simulator.simulate_matrix(neighbors, values, 20)
+        np.testing.assert_allclose(np.array(results), res['x'])